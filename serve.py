@@ -0,0 +1,63 @@
+import argparse
+
+from snn_maml.serving import AdaptationService, serve
+
+parser = argparse.ArgumentParser("Few-shot adaptation service")
+
+parser.add_argument("checkpoint", type=str, help="Checkpoint of the meta-trained model.")
+parser.add_argument(
+    "--benchmark",
+    type=str,
+    default="doublenmnistsequence",
+    help="Benchmark of the model, as in train.py (default: doublenmnistsequence).",
+)
+parser.add_argument("--folder", type=str, default="./", help="Root folder, as in train.py.")
+parser.add_argument("--params_file", type=str, default=None, help="Parameter file of the model.")
+parser.add_argument("--num-ways", type=int, default=5, help="Number of classes per task (N in N-way).")
+parser.add_argument("--num-shots", type=int, default=1, help="Number of support samples per class.")
+parser.add_argument("--num-steps", type=int, default=1, help="Number of adaptation steps.")
+parser.add_argument(
+    "--step-size",
+    type=float,
+    default=None,
+    help="Step size of the adaptation (default: the step size of the checkpoint).",
+)
+parser.add_argument("--device", type=str, default="cpu", help="Device of the model (default: cpu).")
+parser.add_argument(
+    "--max-tasks",
+    type=int,
+    default=16,
+    help="Number of adapted tasks kept, the least recently used are evicted (default: 16).",
+)
+parser.add_argument(
+    "--max-cache-mb",
+    type=float,
+    default=None,
+    help="Maximum memory of the adapted parameters kept, in MB (default: no limit).",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=None,
+    help="Maximum number of query samples per forward pass (default: all of them).",
+)
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8080)
+
+args = parser.parse_args()
+
+service = AdaptationService.from_checkpoint(
+    args.checkpoint,
+    benchmark=args.benchmark,
+    params_file=args.params_file,
+    num_ways=args.num_ways,
+    num_shots=args.num_shots,
+    num_adaptation_steps=args.num_steps,
+    step_size=args.step_size,
+    device=args.device,
+    folder=args.folder,
+    max_tasks=args.max_tasks,
+    max_bytes=None if args.max_cache_mb is None else int(args.max_cache_mb * 2**20),
+    batch_size=args.batch_size,
+)
+serve(service, host=args.host, port=args.port)
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+
+def params_nbytes(params):
+    """Memory of a dict of tensors, in bytes"""
+    return sum(p.numel() * p.element_size() for p in params.values())
+
+
+def model_version(model):
+    """Changes whenever the parameters of `model` are modified in-place, e.g.
+    by an optimizer step or `load_state_dict`"""
+    return tuple((id(p), p._version) for p in model.parameters())
+
+
+def step_size_key(step_size):
+    if isinstance(step_size, dict):
+        return tuple((name, float(s)) for name, s in step_size.items())
+    return float(step_size)
+
+
+class AdaptationCache(object):
+    """Least-recently-used cache of adapted parameters (the fast weights
+    returned by `adapt`), bounded in number of entries and in bytes.
+
+    Parameters are stored detached, on their device, with an optional `info`
+    object (e.g. the inner-loop statistics of `adapt`). Adding an entry evicts
+    the least recently used ones until both bounds hold; an entry larger than
+    `max_bytes` on its own is not stored.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        Maximum number of parameter sets.
+
+    max_bytes : int, optional
+        Maximum memory of the stored parameters.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        """Keys, from the least to the most recently used"""
+        return list(self._entries)
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key):
+        """`(params, info)` stored under `key`, or `None`"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, params, info=None):
+        """Store `params` under `key`, returns whether it was stored"""
+        params = OrderedDict((name, p.detach()) for name, p in params.items())
+        nbytes = params_nbytes(params)
+        self.pop(key)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return False
+        self._entries[key] = (params, info)
+        self.nbytes += nbytes
+        while (self.max_entries is not None and len(self._entries) > self.max_entries) or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes
+        ):
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.nbytes -= params_nbytes(evicted)
+            self.evictions += 1
+        return True
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.nbytes -= params_nbytes(entry[0])
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
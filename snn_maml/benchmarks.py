@@ -1,3 +1,4 @@
+import os
 import torch.nn.functional as F
 
 from collections import namedtuple
@@ -8,18 +9,62 @@ from torchvision import (
     transforms as trn,
 )  # .transforms import ToTensor, Resize, Compose
 
-from .utils import ToTensor1D
+from .utils import ToTensor1D, load_params
+from .transforms import (
+    CachedClassDataset,
+    EventPairsClassDataset,
+    EventsToFrames,
+    RepeatOneHot,
+    ToEventTensor,
+    ToSparse,
+    TransformedClassDataset,
+    cache_key,
+    prune_cache,
+)
+from .h5store import share_hdf5
 import torch
 
 import pdb
 import numpy as np
 
 
-Benchmark = namedtuple(
-    "Benchmark",
-    "meta_train_dataset meta_val_dataset "
-    "meta_test_dataset model loss_function input_size",
-)
+class LazySplit(object):
+    """Meta-dataset built by `build()` on first access"""
+
+    def __init__(self, build):
+        self.build = build
+        self.dataset = None
+
+    def get(self):
+        if self.dataset is None:
+            self.dataset = self.build()
+        return self.dataset
+
+
+def _resolve(split):
+    return split.get() if isinstance(split, LazySplit) else split
+
+
+class Benchmark(
+    namedtuple(
+        "Benchmark",
+        "meta_train_dataset meta_val_dataset "
+        "meta_test_dataset model loss_function input_size input_transform",
+        defaults=(None,),
+    )
+):
+    """Meta-datasets given as `LazySplit` are only built when first accessed as
+    attributes, e.g. the meta-train dataset is never built by test-only runs."""
+
+    __slots__ = ()
+
+    meta_train_dataset = property(lambda self: _resolve(self[0]))
+    meta_val_dataset = property(lambda self: _resolve(self[1]))
+    meta_test_dataset = property(lambda self: _resolve(self[2]))
+
+
+# Meta-datasets of previous calls of `get_benchmark_by_name`, see `lazy_split`
+_split_cache = {}
 
 
 class Pad(object):
@@ -36,6 +81,70 @@ class Pad(object):
         return np.asarray(F.pad(torch.from_numpy(data), p4d, "constant", 0))
 
 
+def _frame_transforms(
+    transform,
+    name,
+    chunk_size,
+    dt,
+    ds,
+    size,
+    frame_cache=None,
+    frame_cache_size=20,
+    sparse=False,
+    device_binning=False,
+    max_events=16384,
+):
+    """Returns the per-sample transform, the on-device input transform (or
+    `None`) of a `Compose([CropDims, Downsample, ToCountFrame, ...])` pipeline
+    and `wrap_classes(class_dataset, split)` (or `None`), which wraps the
+    dataset of classes of a split, see `ClassDatasetWrapper`"""
+    if device_binning:
+        # Only cropping stays in the workers, the two samples of the double
+        # datasets are joined as events and binned on the device
+        crops = [t for t in transform.transforms if type(t).__name__ == "CropDims"]
+        if len(crops) != 1:
+            raise ValueError("Device binning needs exactly one CropDims transform.")
+        ds_x, ds_y = ds if isinstance(ds, (list, tuple)) else (ds, ds)
+        num_pol, width, height = size
+        shift = (0, 0)
+        if any(isinstance(t, Pad) for t in transform.transforms):
+            # `Pad` appends an empty row and prepends an empty column
+            width, height, shift = width + 1, height + 1, (0, ds_y)
+        to_events = ToEventTensor(max_events, window=chunk_size * dt)
+
+        def wrap_classes(class_dataset, split):
+            return EventPairsClassDataset(class_dataset, width * ds_x, to_events, shift)
+
+        input_transform = EventsToFrames(chunk_size, dt, ds, [num_pol, 2 * width, height])
+        return crops[0], input_transform, wrap_classes
+
+    def wrap_classes(class_dataset, split):
+        # Count frames only depend on (dataset, chunk_size, dt, ds)
+        if frame_cache is not None:
+            prune_cache(frame_cache, frame_cache_size * 2**30)
+            folder = os.path.join(frame_cache, cache_key(name, chunk_size, dt, ds), split)
+            class_dataset = CachedClassDataset(class_dataset, folder)
+        # Double datasets join two dense samples, frames are made sparse after
+        if sparse:
+            class_dataset = TransformedClassDataset(class_dataset, ToSparse())
+        return class_dataset
+
+    return transform, None, wrap_classes
+
+
+def _data_key(params_file):
+    """Entries of `params_file` that the meta-datasets depend on, so that
+    parameter files that only differ in model parameters share datasets"""
+    if not params_file or not os.path.exists(params_file):
+        return params_file
+    params = load_params(params_file)
+    data_params = params.get("network", params)
+    return repr(
+        [data_params.get(k) for k in ("chunk_size_train", "deltat", "input_shape")]
+        + [params.get("synthetic")]
+    )
+
+
 def get_benchmark_by_name(
     name,
     folder,
@@ -50,8 +159,64 @@ def get_benchmark_by_name(
     non_spiking=False,
     chunk_size=None,
     dt=None,
+    frame_cache=None,
+    frame_cache_size=20,
+    sparse_frames=False,
+    device_binning=False,
+    max_events=16384,
+    shared_store=None,
+    synthetic=None,
 ):
 
+    split_key = (
+        name,
+        os.path.realpath(folder),
+        num_ways,
+        num_ways_val,
+        num_shots,
+        num_shots_test,
+        _data_key(params_file),
+        chunk_size,
+        dt,
+        frame_cache,
+        sparse_frames,
+        device_binning,
+        max_events,
+        shared_store,
+        repr(synthetic),
+    )
+
+    def lazy_split(split, build):
+        """Meta-dataset of `split`, built on first access and shared by later
+        calls with the same arguments"""
+        key = split_key + (split,)
+        if key not in _split_cache:
+            _split_cache[key] = LazySplit(lambda: wrap_split(build(), split))
+        return _split_cache[key]
+
+    def wrap_split(meta_dataset, split):
+        """Wraps the dataset of classes of `meta_dataset`, see `_frame_transforms`"""
+        if wrap_classes is not None:
+            meta_dataset.dataset = wrap_classes(meta_dataset.dataset, split)
+        return meta_dataset
+
+    def hdf5_root(path, dataset_class):
+        """Serves `path` to `dataset_class` from a shared memory-mapped store
+        if `shared_store`"""
+        if shared_store is not None:
+            share_hdf5(path, dataset_class, shared_store or None)
+        return path
+
+    input_transform = None
+    wrap_classes = None
+    frame_options = dict(
+        frame_cache=frame_cache,
+        frame_cache_size=frame_cache_size,
+        sparse=sparse_frames,
+        device_binning=device_binning,
+        max_events=max_events,
+    )
+
     dataset_transform = ClassSplitter(
         shuffle=True, num_train_per_class=num_shots, num_test_per_class=num_shots_test
     )
@@ -64,32 +229,43 @@ def get_benchmark_by_name(
         class_augmentations = [Rotation([90, 180, 270])]
         transform = trn.Compose([trn.Resize(28), trn.ToTensor()])
         size = [1, 28, 28]
-        meta_train_dataset = Omniglot(
-            data_dir,
-            transform=transform,
-            target_transform=Categorical(num_ways),
-            num_classes_per_task=num_ways,
-            meta_train=True,
-            class_augmentations=class_augmentations,
-            dataset_transform=dataset_transform,
-            download=True,
-        )
-        meta_val_dataset = Omniglot(
-            data_dir,
-            transform=transform,
-            target_transform=Categorical(num_ways),
-            num_classes_per_task=num_ways,
-            meta_val=True,
-            class_augmentations=class_augmentations,
-            dataset_transform=dataset_transform,
-        )
-        meta_test_dataset = Omniglot(
-            data_dir,
-            transform=transform,
-            target_transform=Categorical(num_ways),
-            num_classes_per_task=num_ways,
-            meta_test=True,
-            dataset_transform=dataset_transform,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: Omniglot(
+                data_dir,
+                transform=transform,
+                target_transform=Categorical(num_ways),
+                num_classes_per_task=num_ways,
+                meta_train=True,
+                class_augmentations=class_augmentations,
+                dataset_transform=dataset_transform,
+                download=True,
+            ),
+        )
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: Omniglot(
+                data_dir,
+                transform=transform,
+                target_transform=Categorical(num_ways),
+                num_classes_per_task=num_ways,
+                meta_val=True,
+                class_augmentations=class_augmentations,
+                dataset_transform=dataset_transform,
+                download=True,
+            ),
+        )
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: Omniglot(
+                data_dir,
+                transform=transform,
+                target_transform=Categorical(num_ways),
+                num_classes_per_task=num_ways,
+                meta_test=True,
+                dataset_transform=dataset_transform,
+                download=True,
+            ),
         )
 
         model = ModelConvOmniglot(num_ways, hidden_size=hidden_size)
@@ -108,7 +284,7 @@ def get_benchmark_by_name(
             ToTensor,
         )
 
-        data_dir = folder + "/data/nmnist/n_mnist.hdf5"
+        data_dir = hdf5_root(folder + "/data/nmnist/n_mnist.hdf5", ClassNMNISTDataset)
 
         transform = None
         target_transform = None
@@ -123,10 +299,7 @@ def get_benchmark_by_name(
 
         print("USING PARAMS FROM", params_file)
 
-        with open(params_file, "r") as f:
-            import yaml
-
-            params = yaml.safe_load(f)
+        params = load_params(params_file)
 
         chunk_size = params["chunk_size_train"] if chunk_size is None else chunk_size
         dt = params["deltat"] if dt is None else dt
@@ -138,6 +311,9 @@ def get_benchmark_by_name(
                 ToTensor(),
             ]
         )
+        transform, input_transform, wrap_classes = _frame_transforms(
+            transform, name, chunk_size, dt, ds, size, **frame_options
+        )
 
         if target_transform is None:
             target_transform = Categorical(num_ways)
@@ -146,43 +322,52 @@ def get_benchmark_by_name(
 
         # print("using num_ways_val")
 
-        meta_train_dataset = ClassSplitter(
-            DoubleNMNIST(
-                root=data_dir,
-                meta_train=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: ClassSplitter(
+                DoubleNMNIST(
+                    root=data_dir,
+                    meta_train=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
-        meta_val_dataset = ClassSplitter(
-            DoubleNMNIST(
-                root=data_dir,
-                meta_val=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways_val,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: ClassSplitter(
+                DoubleNMNIST(
+                    root=data_dir,
+                    meta_val=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways_val,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
-        meta_test_dataset = ClassSplitter(
-            DoubleNMNIST(
-                root=data_dir,
-                meta_test=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways_val,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: ClassSplitter(
+                DoubleNMNIST(
+                    root=data_dir,
+                    meta_test=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways_val,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
         if "cuba" in params.keys():
@@ -221,8 +406,6 @@ def get_benchmark_by_name(
             ToCountFrame,
             ToTensor,
             ToEventSum,
-            Repeat,
-            toOneHot,
         )
         from torchneuromorphic.utils import plot_frames_imshow
         from matplotlib import pyplot as plt
@@ -232,7 +415,7 @@ def get_benchmark_by_name(
         # root = 'data/nmnist/n_mnist.hdf5'
         # Please do not hardcode, make use of the variable folder
         print("data is here", folder)
-        root_dvssign = folder + "/data/ASL-DVS/dvssign.hdf5"
+        root_dvssign = hdf5_root(folder + "/data/ASL-DVS/dvssign.hdf5", ClassDVSSignDataset)
         print("DOUBLE ASL-DVS SPIKING")
 
         if params_file is None:
@@ -240,10 +423,7 @@ def get_benchmark_by_name(
 
         print("USING PARAMS FROM", params_file)
 
-        with open(params_file, "r") as f:
-            import yaml
-
-            params = yaml.safe_load(f)
+        params = load_params(params_file)
 
         chunk_size = 100
         ds = 6  # 60x30
@@ -263,52 +443,64 @@ def get_benchmark_by_name(
                 ToTensor(),
             ]
         )
+        transform, input_transform, wrap_classes = _frame_transforms(
+            transform, name, chunk_size, dt, ds, size, **frame_options
+        )
 
         if target_transform is None:
-            target_transform = Compose([Repeat(chunk_size), toOneHot(num_ways)])
+            target_transform = RepeatOneHot(chunk_size, num_ways)
 
         loss_function = F.cross_entropy
 
         meta_split = folder + "/parameters/doubledvssign_splits_full.json"
 
-        meta_train_dataset = ClassSplitter(
-            DoubleDVSSign(
-                root=root_dvssign,
-                meta_train=True,
-                meta_split=meta_split,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: ClassSplitter(
+                DoubleDVSSign(
+                    root=root_dvssign,
+                    meta_train=True,
+                    meta_split=meta_split,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
-        meta_val_dataset = ClassSplitter(
-            DoubleDVSSign(
-                root=root_dvssign,
-                meta_val=True,
-                meta_split=meta_split,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: ClassSplitter(
+                DoubleDVSSign(
+                    root=root_dvssign,
+                    meta_val=True,
+                    meta_split=meta_split,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
-        meta_test_dataset = ClassSplitter(
-            DoubleDVSSign(
-                root=root_dvssign,
-                meta_test=True,
-                meta_split=meta_split,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: ClassSplitter(
+                DoubleDVSSign(
+                    root=root_dvssign,
+                    meta_test=True,
+                    meta_split=meta_split,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
         # model = build_model_DECOLLE(num_ways, params_file = params_file, device=device, detach_at=detach_at,sg_function_baseline=non_spiking)#,detach=detach)#hidden_size=hidden_size)
@@ -350,8 +542,8 @@ def get_benchmark_by_name(
         from .snn_model import build_model_DECOLLE
 
         pdb.set_trace()
-        data_dir = (
-            folder + "/../data/nomniglot/nomniglot.hdf5"
+        data_dir = hdf5_root(
+            folder + "/../data/nomniglot/nomniglot.hdf5", ClassNOmniglotDataset
         )  # folder+'/data/nomniglot/nomniglot.hdf5'
         print("NOmniglot " + data_dir)
         # params_file = '/home/kennetms/Documents/snn_maml/parameters/decolle_params-CNN-Sign.yml'
@@ -374,50 +566,59 @@ def get_benchmark_by_name(
                 ToTensor(),
             ]
         )
+        transform, input_transform, wrap_classes = _frame_transforms(
+            transform, name, chunk_size, dt, ds, size, **frame_options
+        )
 
         if target_transform is None:
             target_transform = Categorical(num_ways)
 
         loss_function = F.cross_entropy
 
-        meta_train_dataset = NOmniglot(
-            root=data_dir,
-            meta_train=True,
-            transform=transform,
-            target_transform=target_transform,
-            chunk_size=chunk_size * dt,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: NOmniglot(
+                root=data_dir,
+                meta_train=True,
+                transform=transform,
+                target_transform=target_transform,
+                chunk_size=chunk_size * dt,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
-        meta_val_dataset = NOmniglot(
-            root=data_dir,
-            meta_val=True,
-            transform=transform,
-            target_transform=target_transform,
-            chunk_size=chunk_size * dt,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: NOmniglot(
+                root=data_dir,
+                meta_val=True,
+                transform=transform,
+                target_transform=target_transform,
+                chunk_size=chunk_size * dt,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
-        meta_test_dataset = NOmniglot(
-            root=data_dir,
-            meta_test=True,
-            transform=transform,
-            target_transform=target_transform,
-            chunk_size=chunk_size * dt,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: NOmniglot(
+                root=data_dir,
+                meta_test=True,
+                transform=transform,
+                target_transform=target_transform,
+                chunk_size=chunk_size * dt,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
         if "lava" in name:
             from .snn_model_lava import build_model_lava
             import lava.lib.dl.slayer as slayer
 
-            with open(params_file, "r") as f:
-                import yaml
-
-                params = yaml.safe_load(f)
+            params = load_params(params_file)
 
             if params["network"]["analog_readout"]:
                 loss_function = (
@@ -455,7 +656,7 @@ def get_benchmark_by_name(
             ToTensor,
         )
 
-        data_dir = folder + "/data/nmnist/n_mnist.hdf5"
+        data_dir = hdf5_root(folder + "/data/nmnist/n_mnist.hdf5", ClassNMNISTDataset)
 
         transform = None
         target_transform = None
@@ -470,10 +671,7 @@ def get_benchmark_by_name(
 
         print("USING PARAMS FROM", params_file)
 
-        with open(params_file, "r") as f:
-            import yaml
-
-            params = yaml.safe_load(f)
+        params = load_params(params_file)
 
         chunk_size = params["network"]["chunk_size_train"]
         dt = params["network"]["deltat"]
@@ -485,6 +683,9 @@ def get_benchmark_by_name(
                 ToTensor(),
             ]
         )
+        transform, input_transform, wrap_classes = _frame_transforms(
+            transform, name, chunk_size, dt, ds, size, **frame_options
+        )
 
         if target_transform is None:
             target_transform = Categorical(num_ways)
@@ -498,43 +699,52 @@ def get_benchmark_by_name(
 
         # print("using num_ways_val")
 
-        meta_train_dataset = ClassSplitter(
-            DoubleNMNIST(
-                root=data_dir,
-                meta_train=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: ClassSplitter(
+                DoubleNMNIST(
+                    root=data_dir,
+                    meta_train=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
-        meta_val_dataset = ClassSplitter(
-            DoubleNMNIST(
-                root=data_dir,
-                meta_val=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways_val,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: ClassSplitter(
+                DoubleNMNIST(
+                    root=data_dir,
+                    meta_val=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways_val,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
-        meta_test_dataset = ClassSplitter(
-            DoubleNMNIST(
-                root=data_dir,
-                meta_test=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways_val,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: ClassSplitter(
+                DoubleNMNIST(
+                    root=data_dir,
+                    meta_test=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways_val,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
         model = build_model_lava(
@@ -558,7 +768,7 @@ def get_benchmark_by_name(
         )
 
         print("data is here", folder)
-        data_dir = folder + "/data/ASL-DVS/dvssign.hdf5"
+        data_dir = hdf5_root(folder + "/data/ASL-DVS/dvssign.hdf5", ClassDVSSignDataset)
         print("DOUBLE ASL-DVS SPIKING Lava")
 
         print("USING PARAMS FROM", params_file)
@@ -567,10 +777,7 @@ def get_benchmark_by_name(
             print("NEED PARAMS FILE!")
             1 / 0
 
-        with open(params_file, "r") as f:
-            import yaml
-
-            params = yaml.safe_load(f)
+        params = load_params(params_file)
 
         chunk_size = params["network"]["chunk_size_train"]
         ds = 12  # 6
@@ -591,6 +798,9 @@ def get_benchmark_by_name(
                 ToTensor(),
             ]
         )
+        transform, input_transform, wrap_classes = _frame_transforms(
+            transform, name, chunk_size, dt, (16, ds), size, **frame_options
+        )
 
         if target_transform is None:
             target_transform = Categorical(num_ways)
@@ -604,43 +814,52 @@ def get_benchmark_by_name(
 
         # print("using num_ways_val")
 
-        meta_train_dataset = ClassSplitter(
-            DoubleDVSSign(
-                root=data_dir,
-                meta_train=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: ClassSplitter(
+                DoubleDVSSign(
+                    root=data_dir,
+                    meta_train=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
-        meta_val_dataset = ClassSplitter(
-            DoubleDVSSign(
-                root=data_dir,
-                meta_val=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways_val,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: ClassSplitter(
+                DoubleDVSSign(
+                    root=data_dir,
+                    meta_val=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways_val,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
-        meta_test_dataset = ClassSplitter(
-            DoubleDVSSign(
-                root=data_dir,
-                meta_test=True,
-                transform=transform,
-                target_transform=target_transform,
-                chunk_size=chunk_size,
-                num_classes_per_task=num_ways_val,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: ClassSplitter(
+                DoubleDVSSign(
+                    root=data_dir,
+                    meta_test=True,
+                    transform=transform,
+                    target_transform=target_transform,
+                    chunk_size=chunk_size,
+                    num_classes_per_task=num_ways_val,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
             ),
-            num_train_per_class=num_shots,
-            num_test_per_class=num_shots_test,
         )
 
         model = build_model_lava(
@@ -663,18 +882,15 @@ def get_benchmark_by_name(
         from .snn_model import build_model_DECOLLE
         import lava.lib.dl.slayer as slayer
 
-        data_dir = (
-            folder + "/../data/dvs_gesture_meta.hdf5"
+        data_dir = hdf5_root(
+            folder + "/../data/dvs_gesture_meta.hdf5", ClassDVSGestureMetaDataset
         )  # folder+'/data/nomniglot/nomniglot.hdf5'
         print("DVSGesture Meta " + data_dir)
         # params_file = '/home/kennetms/Documents/snn_maml/parameters/decolle_params-CNN-Sign.yml'
         print(params_file)
         # chunk_size = 100
 
-        with open(params_file, "r") as f:
-            import yaml
-
-            params = yaml.safe_load(f)
+        params = load_params(params_file)
 
         if "lava" in name:
             chunk_size = params["network"]["chunk_size_train"]
@@ -698,38 +914,50 @@ def get_benchmark_by_name(
                 ToTensor(),
             ]
         )
+        transform, input_transform, wrap_classes = _frame_transforms(
+            transform, name, chunk_size, dt, ds, size, **frame_options
+        )
 
         if target_transform is None:
             target_transform = Categorical(num_ways)
 
-        meta_train_dataset = DVSGestureMeta(
-            root=data_dir,
-            meta_train=True,
-            transform=transform,
-            target_transform=target_transform,
-            chunk_size=chunk_size * dt,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: DVSGestureMeta(
+                root=data_dir,
+                meta_train=True,
+                transform=transform,
+                target_transform=target_transform,
+                chunk_size=chunk_size * dt,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
-        meta_val_dataset = DVSGestureMeta(
-            root=data_dir,
-            meta_test=True,
-            transform=transform,
-            target_transform=target_transform,
-            chunk_size=chunk_size * dt,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: DVSGestureMeta(
+                root=data_dir,
+                meta_test=True,
+                transform=transform,
+                target_transform=target_transform,
+                chunk_size=chunk_size * dt,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
-        meta_test_dataset = DVSGestureMeta(
-            root=data_dir,
-            meta_test=True,
-            transform=transform,
-            target_transform=target_transform,
-            chunk_size=chunk_size * dt,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: DVSGestureMeta(
+                root=data_dir,
+                meta_test=True,
+                transform=transform,
+                target_transform=target_transform,
+                chunk_size=chunk_size * dt,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
         if "lava" in name:
@@ -773,41 +1001,47 @@ def get_benchmark_by_name(
         from .snn_model import build_model_DECOLLE
         import lava.lib.dl.slayer as slayer
 
-        data_dir = (
-            folder + "/../data/emg_meta.hdf5"
+        data_dir = hdf5_root(
+            folder + "/../data/emg_meta.hdf5", ClassEMGMetaDataset
         )  # folder+'/data/nomniglot/nomniglot.hdf5'
         print("EMG Meta " + data_dir)
         # params_file = '/home/kennetms/Documents/snn_maml/parameters/decolle_params-CNN-Sign.yml'
         print(params_file)
 
-        with open(params_file, "r") as f:
-            import yaml
-
-            params = yaml.safe_load(f)
+        params = load_params(params_file)
 
         size = params["input_shape"]
 
         target_transform = Categorical(num_ways)
 
-        meta_train_dataset = EMGMeta(
-            root=data_dir,
-            meta_train=True,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_train_dataset = lazy_split(
+            "train",
+            lambda: EMGMeta(
+                root=data_dir,
+                meta_train=True,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
-        meta_val_dataset = EMGMeta(
-            root=data_dir,
-            meta_test=True,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_val_dataset = lazy_split(
+            "val",
+            lambda: EMGMeta(
+                root=data_dir,
+                meta_test=True,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
-        meta_test_dataset = EMGMeta(
-            root=data_dir,
-            meta_test=True,
-            num_classes_per_task=num_ways,
-            dataset_transform=dataset_transform,
+        meta_test_dataset = lazy_split(
+            "test",
+            lambda: EMGMeta(
+                root=data_dir,
+                meta_test=True,
+                num_classes_per_task=num_ways,
+                dataset_transform=dataset_transform,
+            ),
         )
 
         if "lava" in name:
@@ -835,6 +1069,68 @@ def get_benchmark_by_name(
                 sg_function_baseline=non_spiking,
             )  # ,detach=detach)#hidden_size=hidden_size)
 
+    elif "synthetic" in name:
+        from .synthetic import SyntheticSpikes
+
+        if params_file is None:
+            params_file = folder + "/parameters/decolle_params-CNN.yml"
+
+        print("USING PARAMS FROM", params_file)
+
+        params = load_params(params_file)
+
+        # Lava parameter files nest the data options under "network"
+        data_params = params["network"] if "lava" in name else params
+        chunk_size = data_params["chunk_size_train"] if chunk_size is None else chunk_size
+        size = list(data_params["input_shape"])
+
+        # Generator options: "synthetic" section of the parameter file, then `synthetic`
+        synthetic_options = dict(params.get("synthetic", {}))
+        synthetic_options.update(synthetic or {})
+
+        def synthetic_dataset(num_ways, **split):
+            return ClassSplitter(
+                SyntheticSpikes(
+                    size,
+                    chunk_size,
+                    num_classes_per_task=num_ways,
+                    target_transform=Categorical(num_ways),
+                    **split,
+                    **synthetic_options,
+                ),
+                num_train_per_class=num_shots,
+                num_test_per_class=num_shots_test,
+            )
+
+        meta_train_dataset = lazy_split("train", lambda: synthetic_dataset(num_ways, meta_train=True))
+        meta_val_dataset = lazy_split("val", lambda: synthetic_dataset(num_ways_val, meta_val=True))
+        meta_test_dataset = lazy_split("test", lambda: synthetic_dataset(num_ways_val, meta_test=True))
+
+        if "lava" in name:
+            from .snn_model_lava import build_model_lava
+            import lava.lib.dl.slayer as slayer
+
+            if params["network"]["analog_readout"]:
+                loss_function = F.cross_entropy
+            else:
+                loss_function = slayer.loss.SpikeMax(mode="logsoftmax").to(device)
+
+            model = build_model_lava(
+                num_ways, params_file=params_file, device=device, detach_at=detach_at
+            )
+        else:
+            from .snn_model import build_model_DECOLLE
+
+            loss_function = F.cross_entropy
+
+            model = build_model_DECOLLE(
+                num_ways,
+                params_file=params_file,
+                device=device,
+                detach_at=detach_at,
+                sg_function_baseline=non_spiking,
+            )
+
     else:
         raise NotImplementedError("Unknown dataset `{0}`.".format(name))
 
@@ -845,4 +1141,5 @@ def get_benchmark_by_name(
         model=model,
         loss_function=loss_function,
         input_size=size,
+        input_transform=input_transform,
     )
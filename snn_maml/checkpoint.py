@@ -0,0 +1,245 @@
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# Marks files written by `CheckpointManager`, as opposed to a bare model `state_dict`
+BUNDLE_FORMAT = "snn_maml.checkpoint/1"
+
+
+def snapshot(obj):
+    """Copy of `obj` (nested dicts, lists and tuples of tensors) in host
+    memory, detached from the training state so it can be written later"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, OrderedDict):
+        return OrderedDict((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    return obj
+
+
+def _atomic_write(path, write):
+    """Call `write(f)` on a temporary file next to `path`, then rename it to
+    `path`, so that `path` is either the old or the complete new file"""
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_save(obj, path):
+    _atomic_write(path, lambda f: torch.save(obj, f))
+
+
+def load_checkpoint(path, map_location=None):
+    """Load a checkpoint bundle written by `CheckpointManager`, or a model
+    `state_dict` in the older format, with `optim.th` and `stepsize.th` next
+    to it. Returns a dict with `model` and, if found, `optimizer` and
+    `step_size`."""
+    state = torch.load(path, map_location=map_location)
+    if isinstance(state, dict) and state.get("format") == BUNDLE_FORMAT:
+        return state
+
+    bundle = {"model": state}
+    folder = os.path.dirname(path)
+    for key, name in (("optimizer", "optim.th"), ("step_size", "stepsize.th")):
+        filename = os.path.join(folder, name)
+        if os.path.exists(filename):
+            bundle[key] = torch.load(filename, map_location=map_location)
+    return bundle
+
+
+def restore_step_size(metalearner, step_size):
+    """Copy a saved (possibly per-parameter) step size into `metalearner`"""
+    if isinstance(metalearner.step_size, dict):
+        for name, value in step_size.items():
+            metalearner.step_size[name].data.copy_(value)
+    elif isinstance(metalearner.step_size, torch.Tensor):
+        metalearner.step_size.data.copy_(step_size)
+    else:
+        metalearner.step_size = step_size
+
+
+def seed_everything(seed):
+    """Seed the Python, NumPy and torch (CPU and CUDA) generators"""
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    torch.manual_seed(seed)
+
+
+def rng_state():
+    """States of the Python, NumPy and torch (CPU and CUDA) generators"""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def resume_iterator(dataloader, start_batch, state=None):
+    """Iterator over `dataloader` positioned after its first `start_batch`
+    batches, which are drawn (so that samplers and workers advance exactly as
+    in the interrupted epoch) and dropped. The generators are then set to
+    `state`, their state when the epoch was interrupted."""
+    iterator = iter(dataloader)
+    for _ in range(start_batch):
+        next(iterator)
+    if state is not None:
+        set_rng_state(state)
+    return iterator
+
+
+class CheckpointManager(object):
+    """Writes training checkpoints in a background thread.
+
+    `save` copies the state to host memory on the calling thread and returns;
+    serialization and the (atomic) file writes happen in a single writer
+    thread. Each checkpoint is one bundle file, `last-<step>.th`, of which the
+    `keep_last` most recent are kept, and the best one so far (highest
+    `metric`) is also written to `best.th`. At most `max_pending` snapshots
+    wait in host memory, after which `save` blocks. Errors of the writer
+    thread are raised by the next call to `save`, `wait` or `close`.
+
+    Parameters
+    ----------
+    folder : str
+        Folder of the checkpoints.
+
+    keep_last : int (default: 2)
+        Number of rotating `last-<step>.th` checkpoints.
+
+    max_pending : int (default: 1)
+        Number of snapshots waiting to be written before `save` blocks.
+    """
+
+    LAST_PATTERN = re.compile(r"^last-(\d+)\.th$")
+
+    def __init__(self, folder, keep_last=2, max_pending=1):
+        if keep_last < 1:
+            raise ValueError("At least one checkpoint must be kept (keep_last >= 1).")
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.keep_last = keep_last
+        self.best_metric = None
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def last_path(self):
+        """Path of the most recent `last-<step>.th` on disk, or `None`"""
+        steps = self._last_steps()
+        if not steps:
+            return None
+        return os.path.join(self.folder, "last-{0}.th".format(steps[-1]))
+
+    @property
+    def best_path(self):
+        return os.path.join(self.folder, "best.th")
+
+    def save(self, step, model, optimizer=None, step_size=None, metric=None, **extra):
+        """Snapshot a checkpoint at `step` (e.g. the epoch) and queue it.
+        `extra` entries are stored in the bundle as they are."""
+        self._raise_error()
+        state = {
+            "format": BUNDLE_FORMAT,
+            "step": step,
+            "model": model.state_dict(),
+            "metric": metric,
+        }
+        if optimizer is not None:
+            state["optimizer"] = optimizer.state_dict()
+        if step_size is not None:
+            state["step_size"] = step_size
+        state.update(extra)
+
+        is_best = metric is not None and (self.best_metric is None or metric > self.best_metric)
+        if is_best:
+            self.best_metric = metric
+        self._queue.put(("checkpoint", (step, snapshot(state), is_best)))
+
+    def save_array(self, path, array):
+        """Write a numpy array (`np.save`) in the background"""
+        self._raise_error()
+        self._queue.put(("array", (path, np.array(array))))
+
+    def wait(self):
+        """Block until all queued writes are done"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _last_steps(self):
+        steps = []
+        for name in os.listdir(self.folder):
+            match = self.LAST_PATTERN.match(name)
+            if match is not None:
+                steps.append(int(match.group(1)))
+        return sorted(steps)
+
+    def _write_checkpoint(self, step, state, is_best):
+        path = os.path.join(self.folder, "last-{0}.th".format(step))
+        atomic_save(state, path)
+        if is_best:
+            atomic_save(state, self.best_path)
+        for old in self._last_steps()[: -self.keep_last]:
+            os.remove(os.path.join(self.folder, "last-{0}.th".format(old)))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                kind, args = item
+                if self._error is None:
+                    if kind == "checkpoint":
+                        self._write_checkpoint(*args)
+                    else:
+                        path, array = args
+                        _atomic_write(path, lambda f: np.save(f, array))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed.") from error
@@ -0,0 +1,171 @@
+import collections
+import itertools
+
+import torch
+
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from torchmeta.utils.data import MetaDataLoader
+from torchmeta.utils.data.dataloader import BatchMetaCollate
+
+from .checkpoint import rng_state, seed_everything, set_rng_state
+from .sampling import MetaBatchDataset, MetaBatchIndexSampler
+from .utils import tensors_to_device
+
+# Marks files written by `TaskPool.save`
+TASK_POOL_FORMAT = "snn_maml.task_pool/1"
+
+
+def sparse_collate(batch):
+    """Same as `default_collate`, but stacks sparse tensors instead of failing"""
+    elem = batch[0]
+    if isinstance(elem, torch.Tensor) and elem.is_sparse:
+        return torch.stack(batch, 0)
+    elif isinstance(elem, collections.abc.Mapping):
+        return type(elem)([(key, sparse_collate([d[key] for d in batch])) for key in elem])
+    elif isinstance(elem, (tuple, list)) and any(
+        isinstance(e, torch.Tensor) and e.is_sparse for e in elem
+    ):
+        return [sparse_collate(samples) for samples in zip(*batch)]
+    return default_collate(batch)
+
+
+class SparseBatchMetaDataLoader(MetaDataLoader):
+    """`BatchMetaDataLoader` for datasets whose inputs are sparse tensors (see
+    `snn_maml.transforms.ToSparse`). Batches stay sparse through collation and
+    pinning; `tensors_to_device` densifies them once they reach the device.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size=1,
+        shuffle=True,
+        sampler=None,
+        num_workers=0,
+        pin_memory=False,
+        drop_last=False,
+        timeout=0,
+        worker_init_fn=None,
+    ):
+        collate_fn = BatchMetaCollate(sparse_collate)
+
+        super(SparseBatchMetaDataLoader, self).__init__(
+            dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            sampler=sampler,
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+            pin_memory=pin_memory,
+            drop_last=drop_last,
+            timeout=timeout,
+            worker_init_fn=worker_init_fn,
+        )
+
+
+class TaskIndexDataLoader(DataLoader):
+    """Drop-in replacement of `BatchMetaDataLoader` for meta-datasets wrapped
+    with `ClassSplitter`. Whole meta-batches are sampled at once by
+    `MetaBatchDataset` from a precomputed per-class index, instead of task by
+    task. Iteration never ends, so that each pass draws new tasks; use
+    `max_batches` to bound it (as `train_iter` and `evaluate_iter` do).
+    `shuffle` is accepted for compatibility only, tasks are always random.
+    Sparse inputs are supported.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size=1,
+        shuffle=True,
+        num_workers=0,
+        pin_memory=False,
+        timeout=0,
+        worker_init_fn=None,
+        seed=0,
+    ):
+        super(TaskIndexDataLoader, self).__init__(
+            MetaBatchDataset(dataset, batch_size, seed=seed),
+            batch_size=None,
+            sampler=MetaBatchIndexSampler(),
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            timeout=timeout,
+            worker_init_fn=worker_init_fn,
+        )
+
+
+_pool_keys = itertools.count()
+
+
+class TaskPool(object):
+    """Fixed list of meta-batches, drawn once from a dataloader and iterated
+    in the same order every time, e.g. to validate every epoch on the same
+    tasks. Batches are kept as they come out of the loader, with the dataset
+    transforms applied; after `to`, they are already on the device and
+    iterating costs no data loading nor transfers. Pools too large for the
+    device can stay in host memory (`pin_memory`) or, loaded with `mmap`, on
+    disk; `evaluate` then moves each batch to the device as it does for
+    dataloaders. Iterating yields the batches, so a pool can replace the
+    dataloader of `evaluate`. `key` identifies the pool in the process, so
+    that its tasks can be told apart without reading them (see
+    `AdaptationCache`).
+    """
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.key = next(_pool_keys)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    @classmethod
+    def sample(cls, dataloader, num_batches, seed=0):
+        """Pool of the first `num_batches` batches of `dataloader`, drawn with
+        the generators seeded by `seed`. The generators are restored
+        afterwards, so sampling does not change the rest of the run."""
+        state = rng_state()
+        seed_everything(seed)
+        try:
+            batches = [batch for _, batch in zip(range(num_batches), dataloader)]
+        finally:
+            set_rng_state(state)
+        return cls(batches)
+
+    def to(self, device):
+        """Move (and densify) the batches to `device`, returns the pool"""
+        self.batches = [tensors_to_device(batch, device=device) for batch in self.batches]
+        return self
+
+    def pin_memory(self):
+        """Pin the (dense) batches in host memory for faster transfers, returns
+        the pool"""
+        if torch.cuda.is_available():
+            self.batches = [_pin(batch) for batch in self.batches]
+        return self
+
+    def save(self, path):
+        torch.save({"format": TASK_POOL_FORMAT, "batches": self.batches}, path)
+
+    @classmethod
+    def load(cls, path, map_location=None, mmap=False):
+        """Pool saved at `path`. With `mmap`, the batches are mapped from the
+        file and read from disk when used."""
+        state = torch.load(path, map_location=map_location, mmap=mmap)
+        if not isinstance(state, dict) or state.get("format") != TASK_POOL_FORMAT:
+            raise ValueError("{0} is not a task pool.".format(path))
+        return cls(state["batches"])
+
+
+def _pin(tensors):
+    if isinstance(tensors, torch.Tensor):
+        return tensors if tensors.is_sparse else tensors.pin_memory()
+    elif isinstance(tensors, (list, tuple)):
+        return type(tensors)(_pin(tensor) for tensor in tensors)
+    elif isinstance(tensors, dict):
+        return type(tensors)([(name, _pin(tensor)) for (name, tensor) in tensors.items()])
+    return tensors
@@ -0,0 +1,168 @@
+import os
+
+import numpy as np
+import torch
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def quantize_weight(block, weight):
+    """Weight (or a stack of weights) of `block` as deployed on Loihi, i.e.
+    quantized and descaled by the synapse pre-hook, as in `gen_loihi_params`.
+    Pooling weights are fixed and kept as they are."""
+    synapse = block.synapse
+    if type(synapse).__name__ == "Pool" or not hasattr(synapse, "_pre_hook_fx"):
+        return weight
+    return synapse._pre_hook_fx(weight, descale=True)
+
+
+def _squeeze_stack(w):
+    return w.reshape((w.shape[0],) + tuple(d for d in w.shape[1:] if d != 1))
+
+
+def neuron_params(block):
+    """Neuron parameters of `block`, in device units when lava-dl provides them"""
+    neuron = block.neuron
+    params = getattr(neuron, "device_params", None)
+    if params is None:
+        params = {
+            k: getattr(neuron, k)
+            for k in ("threshold", "current_decay", "voltage_decay", "tau_grad", "scale_grad")
+            if hasattr(neuron, k)
+        }
+    return {k: (v if isinstance(v, str) else _to_numpy(v)) for k, v in params.items()}
+
+
+def network_arrays(model):
+    """Per-block arrays and attributes of a lava-dl network (`MetaLavaNet`):
+    `{block_id: (arrays, attrs)}`, with the quantized `weight` and `delay`"""
+    out = {}
+    with torch.no_grad():
+        for i, b in enumerate(model.blocks):
+            if not hasattr(b, "synapse") or not hasattr(b.synapse, "weight"):
+                continue
+            arrays = {"weight": _to_numpy(quantize_weight(b, b.synapse.weight)).squeeze()}
+            if getattr(b, "delay", None):
+                arrays["delay"] = _to_numpy(quantize_weight(b, b.delay.delay))
+            attrs = {"type": type(b).__name__, "synapse": type(b.synapse).__name__}
+            attrs.update(neuron_params(b))
+            out[i] = (arrays, attrs)
+    return out
+
+
+def _task_batches(model, task_params, batch_size):
+    """Stacks of up to `batch_size` task parameter sets, quantized per block:
+    `(n, {block_id: [n, ...]})`"""
+    keys = {
+        i: "blocks.{0}.synapse.weight".format(i)
+        for i, b in enumerate(model.blocks)
+        if hasattr(b, "synapse") and hasattr(b.synapse, "weight")
+    }
+    batch = []
+
+    def flush():
+        with torch.no_grad():
+            stacked = {
+                i: _squeeze_stack(
+                    _to_numpy(quantize_weight(model.blocks[i], torch.stack([p[k] for p in batch])))
+                )
+                for i, k in keys.items()
+                if k in batch[0]
+            }
+        n = len(batch)
+        batch.clear()
+        return n, stacked
+
+    for params in task_params:
+        batch.append(params)
+        if len(batch) == batch_size:
+            yield flush()
+    if batch:
+        yield flush()
+
+
+def export_network(filename, model, task_params=(), compression="gzip", batch_size=64):
+    """Write a lava-dl network for deployment in a single file, in one pass.
+
+    The file holds, for every block with a synapse, the quantized `weight`,
+    the quantized `delay` (if any) and the neuron parameters (as attributes),
+    under `layer/<block_id>`. Optionally, the weights of many adapted
+    task-specific parameter sets (e.g. the outputs of `adapt`) are stacked
+    under `tasks/<block_id>/weight`, of shape `[num_tasks, ...]`.
+
+    Parameters
+    ----------
+    filename : str
+        `.h5`/`.hdf5` (chunked, compressed HDF5) or `.npz` (compressed numpy
+        archive, flat keys `layer/<block_id>/weight`, ...).
+
+    model : `MetaLavaNet` instance
+        The network.
+
+    task_params : iterable of `OrderedDict`
+        Task-specific parameters, keyed like `model.meta_named_parameters()`.
+        They are quantized and written `batch_size` at a time (HDF5), so a
+        generator does not need to be materialized.
+
+    compression : str or None (default: "gzip")
+        HDF5 compression filter.
+
+    batch_size : int (default: 64)
+        Number of task parameter sets quantized and written at once.
+    """
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    layers = network_arrays(model)
+    batches = _task_batches(model, task_params, batch_size)
+
+    if filename.endswith(".npz"):
+        arrays = {}
+        for i, (layer, attrs) in layers.items():
+            for k, v in layer.items():
+                arrays["layer/{0}/{1}".format(i, k)] = v
+            for k, v in attrs.items():
+                arrays["layer/{0}/attrs/{1}".format(i, k)] = np.asarray(v)
+        tasks = {}
+        for _, stacked in batches:
+            for i, w in stacked.items():
+                tasks.setdefault(i, []).append(w)
+        for i, ws in tasks.items():
+            arrays["tasks/{0}/weight".format(i)] = np.concatenate(ws)
+        np.savez_compressed(filename, **arrays)
+        return filename
+
+    import h5py
+
+    with h5py.File(filename, "w") as f:
+        group = f.create_group("layer")
+        for i, (layer, attrs) in layers.items():
+            g = group.create_group(str(i))
+            for k, v in layer.items():
+                g.create_dataset(k, data=v, compression=compression)
+            for k, v in attrs.items():
+                g.attrs[k] = v
+
+        num_tasks = 0
+        for n, stacked in batches:
+            for i, w in stacked.items():
+                name = "tasks/{0}/weight".format(i)
+                if name not in f:
+                    f.create_dataset(
+                        name,
+                        shape=(0,) + w.shape[1:],
+                        maxshape=(None,) + w.shape[1:],
+                        chunks=(1,) + w.shape[1:],
+                        dtype=w.dtype,
+                        compression=compression,
+                    )
+                d = f[name]
+                d.resize(num_tasks + n, axis=0)
+                d[num_tasks:] = w
+            num_tasks += n
+        f.attrs["num_tasks"] = num_tasks
+    return filename
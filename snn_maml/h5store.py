@@ -0,0 +1,332 @@
+import errno
+import glob
+import os
+import hashlib
+import pickle
+import shutil
+import sys
+import warnings
+
+import h5py
+import numpy as np
+
+
+def default_store_dir():
+    """`$XDG_CACHE_HOME/snn_maml/h5store` (`~/.cache/...` by default). Stores
+    are mapped from disk, so their pages stay in the (shared, evictable) page
+    cache instead of being pinned in a RAM-backed folder like `/dev/shm`."""
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "snn_maml", "h5store")
+
+
+class SharedH5Store(object):
+    """Read-only copy of an HDF5 file, packed into one flat memory-mapped file.
+
+    All numeric datasets are written once, back to back, into
+    `<store_dir>/<name>.bin`; the group tree, attributes, shapes and offsets go
+    to `<name>.idx`. Every process (all data-loader workers of all splits) maps
+    the same file, so the data is held once by the page cache instead of being
+    read and cached by each worker's own HDF5 handle. Stores are keyed by path,
+    size and modification time of the source file and reused across runs;
+    packing a new version of a file deletes the stores of its older versions.
+
+    Parameters
+    ----------
+    path : str
+        The HDF5 file.
+
+    store_dir : str, optional
+        Folder of the packed store (default: `default_store_dir()`).
+
+    Raises `OSError` (`ENOSPC`) if the store does not fit in the free space
+    of `store_dir`.
+    """
+
+    def __init__(self, path, store_dir=None):
+        self.path = os.path.realpath(path)
+        store_dir = store_dir or default_store_dir()
+        os.makedirs(store_dir, exist_ok=True)
+        stat = os.stat(self.path)
+        # <name>.<path hash>.<version hash>, the versions of a file share a prefix
+        prefix = os.path.join(
+            store_dir,
+            "{0}.{1}".format(
+                os.path.basename(self.path),
+                hashlib.blake2b(self.path.encode(), digest_size=4).hexdigest(),
+            ),
+        )
+        version = hashlib.blake2b(
+            str((stat.st_size, stat.st_mtime_ns)).encode(), digest_size=4
+        ).hexdigest()
+        base = "{0}.{1}".format(prefix, version)
+        self.data_path, self.index_path = base + ".bin", base + ".idx"
+        self._data = None
+
+        if not os.path.exists(self.index_path):
+            self._remove_stale(prefix)
+            self._check_space(store_dir)
+            self._pack()
+        with open(self.index_path, "rb") as f:
+            self.index = pickle.load(f)
+
+    def _remove_stale(self, prefix):
+        """Delete the stores of older versions of the file"""
+        for filename in glob.glob(glob.escape(prefix) + ".*"):
+            if filename.endswith((".bin", ".idx")) and filename not in (
+                self.data_path,
+                self.index_path,
+            ):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+    def _check_space(self, store_dir):
+        size = 0
+        with h5py.File(self.path, "r") as src:
+
+            def visit(name, node):
+                nonlocal size
+                if isinstance(node, h5py.Dataset) and node.shape and not node.dtype.hasobject:
+                    size += -(-node.nbytes // 64) * 64
+
+            src.visititems(visit)
+        free = shutil.disk_usage(store_dir).free
+        if size > free:
+            raise OSError(
+                errno.ENOSPC,
+                "The store of {0} needs {1} bytes, {2} are free".format(self.path, size, free),
+                store_dir,
+            )
+
+    def _pack(self):
+        tmp_suffix = ".{0}.tmp".format(os.getpid())
+        offset = 0
+        with h5py.File(self.path, "r") as src, open(self.data_path + tmp_suffix, "wb") as dst:
+
+            def pack(node):
+                nonlocal offset
+                entry = {"attrs": {k: v for k, v in node.attrs.items()}}
+                if isinstance(node, h5py.Dataset):
+                    array = node[()]
+                    if not isinstance(array, np.ndarray) or array.dtype.hasobject:
+                        # Scalars, strings and variable-length data stay in the index
+                        entry["value"] = np.asarray(array)
+                        return entry
+                    offset = -(-offset // 64) * 64
+                    dst.seek(offset)
+                    dst.write(np.ascontiguousarray(array).tobytes())
+                    entry.update(offset=offset, dtype=array.dtype.str, shape=array.shape)
+                    offset += array.nbytes
+                else:
+                    entry["children"] = {name: pack(child) for name, child in node.items()}
+                return entry
+
+            index = pack(src)
+            dst.truncate(max(offset, 1))
+
+        with open(self.index_path + tmp_suffix, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Data first, so that a store with an index is always complete
+        os.replace(self.data_path + tmp_suffix, self.data_path)
+        os.replace(self.index_path + tmp_suffix, self.index_path)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        return self._data
+
+    def open(self):
+        return File(self)
+
+    def __getstate__(self):
+        # Workers map the file themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+
+class Dataset(object):
+    """h5py-like read-only view of a dataset of a `SharedH5Store`"""
+
+    def __init__(self, store, entry, name):
+        self.store = store
+        self.name = name
+        self.attrs = entry["attrs"]
+        if "value" in entry:
+            self._array = entry["value"]
+        else:
+            dtype = np.dtype(entry["dtype"])
+            count = int(np.prod(entry["shape"]))
+            if count == 0:
+                self._array = np.empty(entry["shape"], dtype=dtype)
+            else:
+                self._array = np.frombuffer(
+                    store.data, dtype=dtype, count=count, offset=entry["offset"]
+                ).reshape(entry["shape"])
+
+    @property
+    def shape(self):
+        return np.shape(self._array)
+
+    @property
+    def dtype(self):
+        return np.asarray(self._array).dtype
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, key):
+        out = self._array[key]
+        # h5py returns copies, callers may modify them in place
+        return out.copy() if isinstance(out, np.ndarray) else out
+
+    def __repr__(self):
+        return '<Shared HDF5 dataset "{0}": shape {1}, type "{2}">'.format(
+            self.name, self.shape, self.dtype.str
+        )
+
+
+class Group(object):
+    """h5py-like read-only view of a group of a `SharedH5Store`"""
+
+    def __init__(self, store, entry, name="/"):
+        self.store = store
+        self.name = name
+        self.attrs = entry["attrs"]
+        self._children = entry["children"]
+
+    def __getitem__(self, key):
+        node = self
+        for part in str(key).strip("/").split("/"):
+            entry = node._children[part]
+            name = node.name.rstrip("/") + "/" + part
+            if "children" in entry:
+                node = Group(node.store, entry, name)
+            else:
+                node = Dataset(node.store, entry, name)
+        return node
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._children.keys()
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+
+class File(Group):
+    """h5py-like read-only view of a `SharedH5Store`. Closing is a no-op"""
+
+    def __init__(self, store):
+        super(File, self).__init__(store, store.index)
+        self.filename = store.path
+        self.mode = "r"
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_stores = {}
+# Modules whose `h5py` global is replaced by `share_hdf5`
+_patched = set()
+
+
+def _open(name, mode="r", *args, **kwargs):
+    if mode == "r" and isinstance(name, (str, os.PathLike)):
+        store = _stores.get(os.path.realpath(name))
+        if store is not None:
+            return store.open()
+    return h5py.File(name, mode, *args, **kwargs)
+
+
+class _SharedH5py(object):
+    """`h5py` as seen by the modules of `share_hdf5`: `File` serves read-only
+    opens of shared files from their store, everything else is `h5py`'s"""
+
+    File = staticmethod(_open)
+
+    def __getattr__(self, name):
+        return getattr(h5py, name)
+
+
+_shared_h5py = _SharedH5py()
+
+
+def _package_modules(dataset_class):
+    """Loaded modules of the package of `dataset_class` that use `h5py`. The
+    class that opens the file is often not `dataset_class` nor one of its
+    bases, e.g. `ClassNMNISTDataset` reads through `NMNISTDataset`."""
+    package = dataset_class.__module__.split(".")[0]
+    return [
+        module
+        for name, module in list(sys.modules.items())
+        if (name == package or name.startswith(package + "."))
+        and getattr(module, "h5py", None) in (h5py, _shared_h5py)
+    ]
+
+
+def share_hdf5(path, dataset_class, store_dir=None):
+    """Serve the read-only opens of `path` by `dataset_class` from a
+    `SharedH5Store`.
+
+    Builds (or reuses) the store of `path` and replaces the `h5py` global of
+    the loaded modules of the package of `dataset_class` (e.g. all of
+    torchneuromorphic), so that dataset classes that open the file on every
+    `__getitem__` read from the shared memory map instead. Other files, and
+    writes, still go to `h5py.File`. `h5py` itself
+    is left untouched; `unshare_hdf5` restores the modules. Must be called
+    before the data loader workers are forked (the default start method on
+    Linux): spawned workers import the modules again, unpatched, and read
+    the file directly.
+
+    Returns the store, or `None` (with a warning) if it does not fit in
+    `store_dir`, in which case the file is read as usual.
+    """
+    key = os.path.realpath(path)
+    if key not in _stores:
+        try:
+            _stores[key] = SharedH5Store(path, store_dir)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            warnings.warn("Not sharing {0}: {1}".format(path, e.strerror))
+            return None
+    for module in _package_modules(dataset_class):
+        module.h5py = _shared_h5py
+        _patched.add(module)
+    return _stores[key]
+
+
+def unshare_hdf5():
+    """Undo `share_hdf5`: the patched modules use `h5py` again and the stores
+    are released. Their files are kept on disk for later runs, until the
+    source file changes (see `SharedH5Store`)."""
+    for module in _patched:
+        module.h5py = h5py
+    _patched.clear()
+    _stores.clear()
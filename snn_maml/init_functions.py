@@ -0,0 +1,164 @@
+import torch
+
+from torch.nn import init
+
+
+def _statistics(u, s):
+    """Variance and mean of `u` and mean of `s`, computed on the device and
+    transferred with a single synchronization"""
+    return torch.stack([u.var(unbiased=False), u.mean(), s.float().mean()]).tolist()
+
+
+def target_mean(act_rate, threshold=0.0, var=1.0):
+    """Mean of a normal membrane potential (of scale `var`) that crosses
+    `threshold` with probability `act_rate`. Closed form of the `fmin` search of
+    `decolle.init_functions.init_LSUV_actrate`."""
+    from scipy.stats import norm
+
+    return float(threshold - var * norm.ppf(1 - act_rate))
+
+
+def _run_decolle_layer(net, i, inputs, keep_outputs=False):
+    lif = net.LIF_layers[i]
+    lif.state = None
+    outputs = []
+    for x in inputs:
+        s, u = net.step_layer(i, x)
+        if keep_outputs:
+            outputs.append(s)
+    return s, u, (torch.stack(outputs) if keep_outputs else None)
+
+
+def init_LSUV_decolle(net, data_batch, tgt_mu=0.0, tgt_var=1.0, max_iter=100):
+    """
+    Layer-sequential LSUV initialization of a DECOLLE network (Mishkin D and
+    Matas J. All you need is a good init. arXiv:1511.06422 [cs], February 2016).
+
+    Same updates as `decolle.init_functions.init_LSUV`, on the membrane
+    potential of the last timestep. Each layer is converged alone on the cached
+    output sequence of the previous one, instead of re-running the whole
+    network at every iteration. `net` must provide `step_layer` (see
+    `MetaLenetDECOLLE`). `data_batch` is `[batch_size, time] + input_shape`.
+    """
+    with torch.no_grad():
+        net.init_parameters(data_batch)
+        for l in net.LIF_layers:
+            if l.base_layer.bias is not None:
+                l.base_layer.bias.data *= 0
+            init.orthogonal_(l.base_layer.weight)
+
+        inputs = data_batch.transpose(0, 1)
+        for i, l in enumerate(net.LIF_layers):
+            weight, bias = l.base_layer.weight, l.base_layer.bias
+            for count in range(max_iter):
+                s, u, _ = _run_decolle_layer(net, i, inputs)
+                v, m, mus = _statistics(u, s)
+                print(
+                    "Layer: {0}, Variance: {1:.3}, Mean U: {2:.3}, Mean S: {3:.3}".format(
+                        i, v, m, mus
+                    )
+                )
+                if v != v or m != m:
+                    raise ValueError("Nan encountered during init")
+
+                done = True
+                if abs(v - tgt_var) > 0.1:
+                    weight.data /= max(v, 1e-2) ** 0.5
+                    weight.data *= tgt_var ** 0.5
+                    done = False
+                if abs(m - tgt_mu) > 0.2 and bias is not None:
+                    bias.data -= 0.5 * (m - tgt_mu)
+                    done = False
+                if done:
+                    break
+
+            print("Initialization finalized:")
+            print(
+                "Layer: {0}, Variance: {1:.3}, Mean U: {2:.3}, Mean S: {3:.3}".format(i, v, m, mus)
+            )
+            if i + 1 < len(net.LIF_layers):
+                inputs = _run_decolle_layer(net, i, inputs, keep_outputs=True)[2]
+
+        for l in net.LIF_layers:
+            l.state = None
+
+
+def _run_lava_block(block, spike):
+    from lava.lib.dl.slayer.synapse.layer import MetaDense
+
+    if isinstance(block.synapse, MetaDense) and len(spike.shape) > 3:
+        spike = spike.flatten(1, 3)
+    return block(spike)
+
+
+def init_LSUV_lava(model, data_batch, block_ids, tgt_mu=0.0, tgt_var=1.0, max_iter=100):
+    """
+    Layer-sequential LSUV initialization of the blocks `block_ids` of a lava-dl
+    network (`MetaLavaNet`), with the updates of `torch_init_LSUV`.
+
+    The input of each block is computed once, from the cached output of the
+    previous block, and each block is converged with its own forward only.
+    Statistics are computed on the device. `data_batch` is `[batch_size, time]
+    + input_shape`.
+    """
+    block_ids = sorted(block_ids)
+    with torch.no_grad():
+        for block_id in block_ids:
+            init.orthogonal_(model.blocks[block_id].synapse.weight.data)
+
+        spike = data_batch.permute(0, 2, 3, 4, 1)
+        for block_id, block in enumerate(model.blocks[: block_ids[-1] + 1]):
+            if block_id not in block_ids:
+                spike, _ = _run_lava_block(block, spike)
+                continue
+
+            weight = block.synapse.weight
+            prev_value = block.neuron.return_internal_state
+            block.neuron.return_internal_state = True
+            for count in range(max_iter):
+                out, volt = _run_lava_block(block, spike)
+                v, m, mus = _statistics(volt, out)
+                print(
+                    "Layer: {0}, Variance: {1:.3}, Mean U: {2:.3}, Mean S: {3:.3}".format(
+                        block_id, v, m, mus
+                    )
+                )
+                if v != v or m != m:
+                    raise ValueError("Nan encountered during init")
+
+                done = True
+                if abs(v - tgt_var) > 0.2:
+                    # smaller steps than plain LSUV
+                    weight.data /= 0.8 + 0.2 * v ** 0.5
+                    weight.data *= 0.8 + 0.2 * tgt_var ** 0.5
+                    done = False
+                if abs(m - tgt_mu) > 0.3:
+                    weight.data -= 0.0001 * (m - tgt_mu)
+                    done = False
+                if done:
+                    break
+            block.neuron.return_internal_state = prev_value
+
+            print("Initialization finalized:")
+            print("Layer: {0}, Variance: {1:.3}, Mean U: {2:.3}".format(block_id, v, m))
+            print("-------------------------------------")
+            spike, _ = _run_lava_block(block, spike)
+
+
+def init_LSUV_actrate(net, data_batch, act_rate, threshold=0.0, var=1.0, block_ids=None):
+    """LSUV initialization of `net` (DECOLLE or lava-dl) with a mean membrane
+    potential that gives an activity rate of `act_rate`"""
+    tgt_mu = target_mean(act_rate, threshold, var)
+    if hasattr(net, "blocks"):
+        if block_ids is None:
+            # blocks with meta-parameters, `blocks.<id>.synapse.weight`
+            block_ids = sorted(
+                {int(name.split(".")[1]) for name, _ in net.meta_named_parameters()}
+            )
+        init_LSUV_lava(net, data_batch, block_ids, tgt_mu=tgt_mu, tgt_var=var)
+    elif hasattr(net, "step_layer"):
+        init_LSUV_decolle(net, data_batch, tgt_mu=tgt_mu, tgt_var=var)
+    else:
+        from decolle.init_functions import init_LSUV
+
+        init_LSUV(net, data_batch, tgt_mu=tgt_mu, tgt_var=var)
@@ -0,0 +1,235 @@
+import numpy as np
+import torch
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .readout import Readout
+from .utils import FIXED_POINT_FORMATS, tensors_to_device
+
+
+def _to_fixed(x, fl, lo=None, hi=None, dtype=np.int64):
+    """Round `x` to the nearest multiple of `2 ** -fl` (as `FixedPointQuantizer`)
+    and return the integer mantissas"""
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu().numpy()
+    x = np.floor(np.asarray(x, dtype=np.float64) * 2.0**fl + 0.5)
+    if lo is not None:
+        x = np.clip(x, lo, hi)
+    return x.astype(dtype)
+
+
+def _rshift(x, n):
+    """Arithmetic right shift by `n` bits, rounding half up"""
+    if n <= 0:
+        return x << -n
+    return (x + (1 << (n - 1))) >> n
+
+
+class IntegerLIFLayer(object):
+    """Fixed-point version of a `MetaLIFLayer`, with its pooling.
+
+    Weights are integers in the format `(wl, fl, symmetric)` of
+    `utils.FIXED_POINT_FORMATS` (int8 up to 8 bits, else int16). The states
+    `P`, `Q`, `R` and the membrane potential are integers with `state_fl`
+    fraction bits, and the decays `alpha`, `beta` and `alpharp` have
+    `decay_bits` fraction bits. Products are accumulated in int64 and shifted
+    back with rounding.
+    """
+
+    def __init__(
+        self, lif, pool, weight, bias, weight_format="8", state_fl=12, decay_bits=12, flatten=False
+    ):
+        wl, fl, symmetric = FIXED_POINT_FORMATS[weight_format]
+        hi = 2 ** (wl - 1) - 1
+        lo = -hi if symmetric else -(2 ** (wl - 1))
+        self.weight = _to_fixed(weight, fl, lo, hi, np.int8 if wl <= 8 else np.int16)
+        self.weight_fl = fl
+        rows = self.weight.reshape(len(self.weight), -1).astype(np.int64)
+        self.weight_l1 = int(np.abs(rows).sum(1).max())
+        # Bias is added to the accumulator, which has `fl + state_fl` fraction bits
+        self.bias = None if bias is None else _to_fixed(bias, fl + state_fl)
+        self.state_fl = state_fl
+        self.decay_bits = decay_bits
+        self.flatten = flatten
+
+        base = lif.base_layer
+        self.conv = hasattr(base, "out_channels")
+        if self.conv:
+            self.stride = tuple(base.stride)
+            self.padding = tuple(base.padding)
+            if tuple(base.dilation) != (1, 1):
+                raise ValueError("Dilated convolutions are not supported.")
+
+        one = 1 << decay_bits
+        self.alpha = int(round(float(lif.alpha) * one))
+        self.beta = int(round(float(lif.beta) * one))
+        self.alpharp = int(round(float(lif.alpharp) * one))
+        self.in_gain = int(_to_fixed((one - self.beta) / one * float(lif.gain), state_fl))
+        self.rp = int(_to_fixed((one - self.alpharp) / one * float(lif.wrp), state_fl))
+
+        kernel = getattr(pool, "kernel_size", 1)
+        self.pool = kernel if isinstance(kernel, tuple) else (kernel, kernel)
+        self.state = None
+
+    def reset(self):
+        self.state = None
+
+    def _matmul(self, x, W):
+        # Integer products summed in float64 are exact below 2 ** 53, and use BLAS
+        if float(np.abs(x).max(initial=0)) * self.weight_l1 < 2.0**53:
+            return np.rint(x.astype(np.float64) @ W.astype(np.float64)).astype(np.int64)
+        return x @ W.astype(np.int64)
+
+    def synapse(self, P):
+        W = self.weight
+        if self.conv:
+            ph, pw = self.padding
+            P = np.pad(P, ((0, 0), (0, 0), (ph, ph), (pw, pw)))
+            windows = sliding_window_view(P, W.shape[2:], axis=(2, 3))
+            windows = windows[:, :, :: self.stride[0], :: self.stride[1]]
+            B, C, H, Wd = windows.shape[:4]
+            cols = windows.transpose(0, 2, 3, 1, 4, 5).reshape(B * H * Wd, -1)
+            out = self._matmul(cols, W.reshape(W.shape[0], -1).T)
+            out = out.reshape(B, H, Wd, -1).transpose(0, 3, 1, 2)
+            if self.bias is not None:
+                out = out + self.bias[None, :, None, None]
+        else:
+            out = self._matmul(P, W.T)
+            if self.bias is not None:
+                out = out + self.bias
+        return out
+
+    def avg_pool(self, U):
+        kh, kw = self.pool
+        if kh == 1 and kw == 1:
+            return U
+        B, C, H, W = U.shape
+        U = U[:, :, : H - H % kh, : W - W % kw]
+        s = U.reshape(B, C, H // kh, kh, W // kw, kw).sum(axis=(3, 5))
+        n = kh * kw
+        return (s + n // 2) // n
+
+    def step(self, x):
+        """One step on the integer input `x` (spikes or spike counts). Returns
+        the output spikes and the pooled membrane potential (`state_fl` bits)."""
+        if self.flatten:
+            x = x.reshape(x.shape[0], -1)
+        if self.state is None:
+            zeros = np.zeros(x.shape, dtype=np.int64)
+            self.state = (zeros, zeros, 0, 0)
+        P, Q, R, S = self.state
+        db = self.decay_bits
+        one = 1 << db
+
+        Q_new = _rshift(self.beta * Q, db) + self.in_gain * x
+        P_new = _rshift(self.alpha * P + (one - self.alpha) * Q, db)
+        R_new = _rshift(self.alpharp * R, db) - self.rp * S
+        U = _rshift(self.synapse(P_new), self.weight_fl) + R_new
+        S_new = (U > 0).astype(np.int64)
+        self.state = (P_new, Q_new, R_new, S_new)
+
+        U_p = self.avg_pool(U)
+        return (U_p > 0).astype(np.int64), U_p
+
+
+class IntegerDECOLLE(object):
+    """Integer fixed-point inference of a `MetaLenetDECOLLE`, on CPU with numpy.
+
+    Runs the same LIF dynamics as the float model, including the `burnin`
+    steps, and returns the membrane potential of the output layer (or its
+    `readout`), as floats. Build it with `from_model`, optionally with
+    task-specific (adapted) parameters. Neurons whose float membrane potential
+    is within rounding of the threshold may spike differently.
+    """
+
+    def __init__(self, layers, burnin, state_fl, readout=None):
+        self.layers = layers
+        self.burnin = burnin
+        self.state_fl = state_fl
+        self.readout = readout or Readout("last")
+
+    @classmethod
+    def from_model(cls, net, params=None, weight_format="8", state_fl=12, decay_bits=12):
+        """Quantize `net`, using the weights of `params` (e.g. the output of
+        `adapt`) where given"""
+        if getattr(net, "non_spiking_baseline", False):
+            raise ValueError("The non-spiking baseline has no integer equivalent.")
+        params = params or {}
+        layers = []
+        for i, (lif, pool) in enumerate(zip(net.LIF_layers, net.pool_layers)):
+            prefix = "LIF_layers.{0}.base_layer.".format(i)
+            weight = params.get(prefix + "weight", lif.base_layer.weight)
+            bias = params.get(prefix + "bias", lif.base_layer.bias)
+            layers.append(
+                IntegerLIFLayer(
+                    lif,
+                    pool,
+                    weight,
+                    bias,
+                    weight_format=weight_format,
+                    state_fl=state_fl,
+                    decay_bits=decay_bits,
+                    flatten=(i == net.num_conv_layers),
+                )
+            )
+        return cls(layers, net.burnin, state_fl, readout=getattr(net, "readout", None))
+
+    def __call__(self, inputs):
+        """Outputs for `inputs` of shape `[batch_size, time] + input_shape`"""
+        if isinstance(inputs, torch.Tensor):
+            inputs = inputs.detach().cpu().numpy()
+        inputs = np.rint(inputs).astype(np.int64)
+        for layer in self.layers:
+            layer.reset()
+
+        acc = self.readout.accumulator()
+        scale = 2.0**-self.state_fl
+        for t in range(inputs.shape[1]):
+            x = inputs[:, t]
+            for layer in self.layers:
+                x, u = layer.step(x)
+            if t >= self.burnin:
+                acc.update(u * scale)
+        return acc.value()
+
+    def predict(self, inputs):
+        return np.argmax(self(inputs), axis=-1)
+
+
+def evaluate_integer(metalearner, dataloader, max_batches=100, weight_format="8", **kwargs):
+    """Accuracy of integer inference on the test samples of the tasks of
+    `dataloader`, with the base model (`accuracies_before`) and with the
+    parameters adapted (in float) by `metalearner` (`accuracies_after`).
+    Extra arguments are passed to `IntegerDECOLLE.from_model`."""
+    model = metalearner.model
+    model.eval()
+    before, after = [], []
+    for _, batch in zip(range(max_batches), dataloader):
+        batch = tensors_to_device(batch, device=metalearner.device)
+        # With streamed events, adaptation takes the events and integer inference the frames
+        support = list(batch["train"])
+        batch = metalearner.transform_inputs(batch)
+        if not metalearner.stream_events:
+            support = batch["train"]
+        base = IntegerDECOLLE.from_model(model, weight_format=weight_format, **kwargs)
+        for train_inputs, train_targets, test_inputs, test_targets in zip(
+            *support, *batch["test"]
+        ):
+            test_targets = test_targets.cpu().numpy()
+            before.append(np.mean(base.predict(test_inputs) == test_targets))
+
+            params, _ = metalearner.adapt(
+                train_inputs,
+                train_targets,
+                is_classification_task=True,
+                num_adaptation_steps=metalearner.num_adaptation_steps,
+                num_adaptation_samples=metalearner.num_adaptation_samples,
+                step_size=metalearner.step_size,
+                first_order=True,
+            )
+            adapted = IntegerDECOLLE.from_model(
+                model, params=params, weight_format=weight_format, **kwargs
+            )
+            after.append(np.mean(adapted.predict(test_inputs) == test_targets))
+
+    return {"accuracies_before": float(np.mean(before)), "accuracies_after": float(np.mean(after))}
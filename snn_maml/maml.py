@@ -4,8 +4,12 @@ import numpy as np
 from tqdm import tqdm
 from snn_maml.utils import quantize_parameters
 from collections import OrderedDict
+from contextlib import nullcontext
 from . import plasticity_rules
-from .utils import tensors_to_device, compute_accuracy
+from .utils import tensors_to_device, compute_accuracy, confidence_interval, time_chunks
+from .utils import batch_one_hot, undo_onehot
+from .profiler import NullProfiler
+from .adaptation_cache import model_version, step_size_key
 
 __all__ = ["ModelAgnosticMetaLearning", "MAML", "FOMAML"]
 
@@ -15,29 +19,14 @@ import pdb
 
 # default `log_dir` is "runs" - we'll be more specific here
 
+# Autocast types of the `amp` modes
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
 get_postfix = lambda pbar: (
     dict([s.split("=") for s in pbar.postfix.split(", ")]) if pbar.postfix is not None else {}
 )
 
 
-def batch_one_hot(targets, num_classes=10):
-    one_hot = torch.zeros((targets.shape[0], num_classes))
-    # print("targets shape", targets.shape)
-    for i in range(targets.shape[0]):
-        one_hot[i][targets[i]] = 1
-
-    return one_hot
-
-
-def undo_onehot(targets):
-    not_hot = torch.zeros((targets.shape[0]))
-
-    for i in range(targets.shape[0]):
-        not_hot[i] = torch.nonzero(targets[0])[0][0].item()
-
-    return not_hot.to(targets.device)
-
-
 class ModelAgnosticMetaLearning(object):
     """Meta-learner class for Model-Agnostic Meta-Learning [1].
 
@@ -80,6 +69,49 @@ class ModelAgnosticMetaLearning(object):
     device : `torch.device` instance, optional
         The device on which the model is defined.
 
+    input_transform : callable, optional
+        Transform applied to the inputs of every batch once they are on the
+        device, e.g. `snn_maml.transforms.EventsToFrames` to bin raw events
+        into count frames.
+
+    stream_chunk_size : int, optional
+        If set, models with a `forward_stream` method (`MetaLenetDECOLLE`) are
+        fed their inputs in time chunks of this length instead of as a whole,
+        with LIF states carried across chunks. If `input_transform` bins
+        events by chunks (`EventsToFrames`), the inputs stay raw events and
+        each chunk is binned when the model needs it, so that the frames of
+        the whole sequence are never in memory. Otherwise the frames are
+        already on the device and are only sliced (see `tbptt`).
+
+    tbptt : bool (default: False)
+        If `True`, LIF states are detached between streamed chunks (truncated
+        backpropagation through time). Has no impact unless
+        `stream_chunk_size` is set.
+
+    profiler : `snn_maml.profiler.PhaseProfiler` instance, optional
+        Records the time spent in each phase of the meta-learning loop
+        (`data`, `h2d`, `eval_before`, `inner_forward`, `inner_grad`,
+        `query_forward`, `outer_backward`, `optimizer_step`).
+
+    adaptation_cache : `snn_maml.adaptation_cache.AdaptationCache` instance, optional
+        When evaluating on a `TaskPool`, the adapted parameters of each task
+        are cached under the version of the model parameters, the position of
+        the task in the pool and the step size, so that re-evaluating the
+        pool only runs the query forward passes. Every optimizer step changes
+        the version, so hits only happen while the model is frozen, e.g. when
+        only testing. The samples of a repeated task are not re-drawn, so the
+        adaptation order of `num_adaptation_samples` and stream mode is the
+        one of its first evaluation.
+
+    amp : str, optional
+        Mixed precision, `"bf16"` or `"fp16"`: the forward passes of the inner
+        and outer loops run under `torch.autocast` (with the native bf16
+        kernels on CPU), while parameters, step sizes, inner-loop updates,
+        losses and LIF states stay in fp32. With `"fp16"`, the inner-loop
+        gradients and the outer backward pass are scaled by a dynamic
+        `torch.amp.GradScaler` (`grad_scaler`); steps with non-finite
+        gradients are skipped. Second-order gradients are supported.
+
     References
     ----------
     .. [1] Finn C., Abbeel P., and Levine, S. (2017). Model-Agnostic Meta-Learning
@@ -112,6 +144,12 @@ class ModelAgnosticMetaLearning(object):
         boil=False,
         outer_loop_quantizer=None,
         inner_loop_quantizer=None,
+        input_transform=None,
+        stream_chunk_size=None,
+        tbptt=False,
+        profiler=None,
+        adaptation_cache=None,
+        amp=None,
     ):
         self.model = model.to(device=device)
         self.outer_loop_quantizer = outer_loop_quantizer
@@ -126,6 +164,27 @@ class ModelAgnosticMetaLearning(object):
         self.device = device
         self.custom_inner_update_fn = custom_inner_update_fn
         self.custom_outer_update_fn = custom_outer_update_fn
+        self.input_transform = input_transform
+        self.stream_chunk_size = stream_chunk_size
+        self.tbptt = tbptt
+        # Inputs stay events, binned chunk by chunk in `forward_model`
+        self.stream_events = (
+            stream_chunk_size is not None
+            and hasattr(model, "forward_stream")
+            and hasattr(input_transform, "chunks")
+        )
+        self.profiler = profiler or NullProfiler()
+        self.adaptation_cache = adaptation_cache
+        if amp is not None and amp not in AMP_DTYPES:
+            raise ValueError(
+                "Unknown mixed precision `{0}`, use one of {1}.".format(amp, list(AMP_DTYPES))
+            )
+        self.amp_dtype = AMP_DTYPES.get(amp)
+        self.device_type = torch.device(device).type if device is not None else "cpu"
+        self.grad_scaler = None
+        if amp == "fp16":
+            # The inner-loop gradients are scaled too, start lower than the default 2**16
+            self.grad_scaler = torch.amp.GradScaler(self.device_type, init_scale=2.0**8)
 
         if per_param_step_size or boil:
             self.step_size = OrderedDict(
@@ -170,12 +229,54 @@ class ModelAgnosticMetaLearning(object):
                     group.setdefault("initial_lr", group["lr"])
                 # self.scheduler.base_lrs([group['initial_lr'] for group in self.optimizer.param_groups])
 
+    def transform_inputs(self, batch):
+        """Apply `input_transform` to the inputs of the train and test splits.
+        The training and evaluation loops skip it when events are streamed."""
+        if self.input_transform is None:
+            return batch
+        for split in ("train", "test"):
+            if split in batch:
+                inputs, targets = batch[split]
+                batch[split] = [self.input_transform(inputs), targets]
+        return batch
+
+    def autocast(self):
+        """Context of the forward passes, mixed precision if `amp` is set"""
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(self.device_type, dtype=self.amp_dtype)
+
+    def forward_model(self, inputs, params=None):
+        """Run the model on `inputs`, in time chunks if `stream_chunk_size` is set.
+        With `amp`, the model runs under autocast and the outputs are cast
+        back to fp32 for the loss."""
+        with self.autocast():
+            if self.stream_chunk_size is None or not hasattr(self.model, "forward_stream"):
+                outputs = self.model(inputs, params=params)
+            else:
+                if self.stream_events:
+                    chunks = self.input_transform.chunks(inputs, self.stream_chunk_size)
+                else:
+                    chunks = time_chunks(inputs, self.stream_chunk_size)
+                outputs = self.model.forward_stream(chunks, params=params, tbptt=self.tbptt)
+        if self.amp_dtype is not None and torch.is_tensor(outputs):
+            outputs = outputs.float()
+        return outputs
+
+    def forward_query(self, inputs, params=None):
+        """Run the model on the query (test) samples of a task, `[num_samples,
+        time] + input_shape` as in the batches. The sample axis is kept as is,
+        so a single sample is a batch of one."""
+        return self.forward_model(inputs, params=params)
+
     def get_outer_loss(self, batch, **kwargs):
         if "test" not in batch:
             raise RuntimeError("The batch does not contain any test dataset.")
 
         stream_mode = kwargs.get("stream_mode", True)
         save_graph = kwargs.get("save_graph", False)
+        # Identifies the batch among those of a `TaskPool`, see `evaluate_iter`
+        batch_key = kwargs.get("batch_key", None)
 
         _, test_targets = batch["test"]
         num_tasks = test_targets.size(0)
@@ -214,11 +315,12 @@ class ModelAgnosticMetaLearning(object):
                 pbar.set_postfix(desc)
 
             # Test Before Adaptation
-            test_inputs, test_targets = test_inputs.to(self.device), test_targets.to(self.device)
-            test_logits = self.model(test_inputs.squeeze().transpose(0, 1), params=None)
-            outer_loss = self.loss_function(test_logits, test_targets)
-            if isinstance(outer_loss, tuple):
-                outer_loss = outer_loss[0]
+            with self.profiler.phase("eval_before"):
+                test_inputs, test_targets = test_inputs.to(self.device), test_targets.to(self.device)
+                test_logits = self.forward_query(test_inputs, params=None)
+                outer_loss = self.loss_function(test_logits, test_targets)
+                if isinstance(outer_loss, tuple):
+                    outer_loss = outer_loss[0]
 
             if is_classification_task:
                 results["accuracies_before"][task_id] = compute_accuracy(
@@ -227,27 +329,44 @@ class ModelAgnosticMetaLearning(object):
                     first_spike_fn=getattr(self.model, "first_spike_fn", None),
                 )
 
-            # Adaptation
-            params, adaptation_results = self.adapt(
-                train_inputs,
-                train_targets,
-                is_classification_task=is_classification_task,
-                num_adaptation_steps=self.num_adaptation_steps,
-                num_adaptation_samples=self.num_adaptation_samples,
-                step_size=self.step_size,
-                first_order=self.first_order,
-                stream_mode=stream_mode,
-                save_graph=save_graph,
-                pbar=pbar,
-            )
+            # Adaptation, or adapted parameters of the same task
+            cache_key, cached = None, None
+            if self.adaptation_cache is not None and batch_key is not None and not self.model.training:
+                cache_key = (
+                    model_version(self.model),
+                    batch_key,
+                    task_id,
+                    step_size_key(self.step_size),
+                    self.num_adaptation_steps,
+                    self.num_adaptation_samples,
+                    stream_mode,
+                )
+                cached = self.adaptation_cache.get_entry(cache_key)
+            if cached is not None:
+                params, adaptation_results = cached
+            else:
+                params, adaptation_results = self.adapt(
+                    train_inputs,
+                    train_targets,
+                    is_classification_task=is_classification_task,
+                    num_adaptation_steps=self.num_adaptation_steps,
+                    num_adaptation_samples=self.num_adaptation_samples,
+                    step_size=self.step_size,
+                    first_order=self.first_order,
+                    stream_mode=stream_mode,
+                    save_graph=save_graph,
+                    pbar=pbar,
+                )
+                if cache_key is not None:
+                    self.adaptation_cache.put(cache_key, params, adaptation_results)
 
             results["inner_losses"][:, task_id] = adaptation_results["inner_losses"]
 
             # Test After Adaptation and Compute Outer Loss
-            with torch.set_grad_enabled(self.model.training):
+            with torch.set_grad_enabled(self.model.training), self.profiler.phase("query_forward"):
 
                 test_inputs, test_targets = test_inputs.to(self.device), test_targets.to(self.device)
-                test_logits = self.model(test_inputs.squeeze().transpose(0, 1), params=params)
+                test_logits = self.forward_query(test_inputs, params=params)
                 outer_loss = self.loss_function(test_logits, test_targets)
                 if isinstance(outer_loss, tuple):
                     outer_loss = outer_loss[0]
@@ -302,29 +421,35 @@ class ModelAgnosticMetaLearning(object):
 
             def process_inputs(inputs, targets, params):
                 single_results = {}
-                inputs, targets = inputs.to(self.device), targets.to(self.device)
-                logits = self.model(inputs, params=params)
-                if len(targets.shape) == 0:
-                    targets = torch.tensor([targets]).to(self.device)
-
-                inner_loss = self.loss_function(logits, targets)
-                if isinstance(inner_loss, tuple):
-                    inner_loss = inner_loss[0]
+                inner_acc = None
+                with self.profiler.phase("inner_forward"):
+                    inputs, targets = inputs.to(self.device), targets.to(self.device)
+                    logits = self.forward_model(inputs, params=params)
+                    if len(targets.shape) == 0:
+                        targets = torch.tensor([targets]).to(self.device)
+
+                    inner_loss = self.loss_function(logits, targets)
+                    if isinstance(inner_loss, tuple):
+                        inner_loss = inner_loss[0]
                 # pdb.set_trace()
-                if (step == num_adaptation_steps - 1) and is_classification_task:
+                if is_classification_task:
                     inner_acc = compute_accuracy(logits, targets)
 
                 # print("updating params...")
                 self.model.zero_grad()
-                params = plasticity_rules.custom_sgd(
-                    self.model,
-                    inner_loss,
-                    step_size=step_size,
-                    params=params,
-                    first_order=(not self.model.training) or first_order,
-                    custom_update_fn=self.custom_inner_update_fn,
-                    save_graph=save_graph,
-                )
+                with self.profiler.phase("inner_grad"):
+                    params = plasticity_rules.custom_sgd(
+                        self.model,
+                        inner_loss,
+                        step_size=step_size,
+                        params=params,
+                        first_order=(not self.model.training) or first_order,
+                        custom_update_fn=self.custom_inner_update_fn,
+                        save_graph=save_graph,
+                        grad_scale=(
+                            self.grad_scaler.get_scale() if self.grad_scaler is not None else None
+                        ),
+                    )
 
                 if self.inner_loop_quantizer is not None:
                     params = quantize_parameters(params, self.inner_loop_quantizer)
@@ -339,17 +464,18 @@ class ModelAgnosticMetaLearning(object):
             indices = np.random.choice(inputs.size(0), n_samples, replace=False)
 
             if stream_mode:
-                results["inner_losses"] = [[] for _ in range(num_adaptation_steps)]
-                results["inner_accuracies"] = [[] for _ in range(num_adaptation_steps)]
+                if step == 0:
+                    results["inner_losses"] = [[] for _ in range(num_adaptation_steps)]
+                    results["inner_accuracies"] = [[] for _ in range(num_adaptation_steps)]
                 for i, (input, target) in enumerate(zip(inputs[indices], targets[indices])):
                     self.model.i = i
-                    params, inner_loss, inner_acc = process_inputs(input, target, params)
+                    # one sample, as a batch of one
+                    params, inner_loss, inner_acc = process_inputs(input.unsqueeze(0), target, params)
                     results["inner_losses"][step].append(inner_loss.item())
                     results["inner_accuracies"][step].append(inner_acc)
                 results["inner_losses"][step] = np.mean(results["inner_losses"][step])
                 results["inner_accuracies"][step] = np.mean(results["inner_accuracies"][step])
             else:
-                inputs = inputs.squeeze().transpose(0, 1)
                 params, inner_loss, inner_acc = process_inputs(inputs[indices], targets[indices], params)
                 results["inner_losses"] = inner_loss.item()
                 results["inner_accuracies"] = inner_acc
@@ -361,10 +487,31 @@ class ModelAgnosticMetaLearning(object):
 
         return params, results
 
-    def train(self, dataloader, max_batches=500, verbose=True, epoch=-1, **kwargs):
+    def train(
+        self,
+        dataloader,
+        max_batches=500,
+        verbose=True,
+        epoch=-1,
+        start_batch=0,
+        on_batch_end=None,
+        **kwargs
+    ):
+        """Meta-train on batches `start_batch` to `max_batches` of the epoch.
+        `start_batch > 0` resumes an epoch, with `dataloader` already past the
+        first `start_batch` batches (e.g. `checkpoint.resume_iterator`); the
+        mean results only cover the remaining batches.
+        `on_batch_end(num_batches)` is called after every update."""
         mean_outer_loss, mean_accuracy_af, count, mean_accuracy_bf = 0.0, 0.0, 0, 0.0
-        with tqdm(total=max_batches, disable=False, **kwargs) as pbar:
-            for results in self.train_iter(dataloader, max_batches=max_batches, epoch=epoch, pbar=pbar):
+        with tqdm(total=max_batches, initial=start_batch, disable=False, **kwargs) as pbar:
+            for results in self.train_iter(
+                dataloader,
+                max_batches=max_batches,
+                epoch=epoch,
+                pbar=pbar,
+                start_batch=start_batch,
+                on_batch_end=on_batch_end,
+            ):
                 pbar.update(1)
                 count += 1
                 mean_outer_loss += (results["mean_outer_loss"] - mean_outer_loss) / count
@@ -387,7 +534,16 @@ class ModelAgnosticMetaLearning(object):
         return mean_results
 
     # Outer loop
-    def train_iter(self, dataloader, max_batches=500, epoch=-1, pbar=None, **kwargs):
+    def train_iter(
+        self,
+        dataloader,
+        max_batches=500,
+        epoch=-1,
+        pbar=None,
+        start_batch=0,
+        on_batch_end=None,
+        **kwargs
+    ):
         if self.optimizer is None:
             raise RuntimeError(
                 "Trying to call `train_iter`, while the "
@@ -396,27 +552,44 @@ class ModelAgnosticMetaLearning(object):
                 "(eg. `{0}(model, optimizer=torch.optim.SGD(model."
                 "parameters(), lr=0.01), ...).".format(__class__.__name__)
             )
-        num_batches = 0
+        num_batches = start_batch
         self.model.train()
 
         # print(self.model)
 
-        for batch, _ in zip(dataloader, range(max_batches)):
+        # `range` first: `zip` must not pull a batch past the last one from a
+        # shared iterator (e.g. the cycling loader of a sweep `Trial`)
+        batches = zip(range(start_batch, max_batches), dataloader)
+        for _, batch in self.profiler.iterate(batches, "data"):
 
             self.optimizer.zero_grad()
 
-            batch = tensors_to_device(batch, device=self.device)
+            with self.profiler.phase("h2d"):
+                batch = tensors_to_device(batch, device=self.device)
+                if not self.stream_events:
+                    batch = self.transform_inputs(batch)
             outer_loss, results = self.get_outer_loss(batch, pbar=pbar)
             yield results
             # pdb.set_trace()
-            outer_loss.backward()
+            with self.profiler.phase("outer_backward"):
+                if self.grad_scaler is not None:
+                    self.grad_scaler.scale(outer_loss).backward()
+                    self.grad_scaler.unscale_(self.optimizer)
+                else:
+                    outer_loss.backward()
             # pdb.set_trace()
             # self.model.grad_flow('./')
             # pdb.set_trace()
             if self.custom_outer_update_fn is not None:
                 self.custom_outer_update_fn(self.model)
 
-            self.optimizer.step()
+            with self.profiler.phase("optimizer_step"):
+                if self.grad_scaler is not None:
+                    # Skipped if the gradients are not finite
+                    self.grad_scaler.step(self.optimizer)
+                    self.grad_scaler.update()
+                else:
+                    self.optimizer.step()
             if hasattr(self.step_size, "__len__"):
                 if len(self.step_size.shape) > 0:
                     for name, value in self.step_size.items():
@@ -432,15 +605,23 @@ class ModelAgnosticMetaLearning(object):
                 self.scheduler.step()
 
             num_batches += 1
+            if on_batch_end is not None:
+                on_batch_end(num_batches)
 
     def evaluate(self, dataloader, max_batches=500, verbose=True, **kwargs):
+        """Mean loss and accuracies over `max_batches` batches, with the 95%
+        confidence intervals of the accuracies over tasks (`<key>_ci95`)"""
         mean_outer_loss, mean_accuracy_af, count, mean_accuracy_bf = 0.0, 0.0, 0, 0.0
+        task_accuracies = {"accuracies_after": [], "accuracies_before": []}
         with tqdm(total=max_batches, disable=False, **kwargs) as pbar:
             for results in self.evaluate_iter(dataloader, max_batches=max_batches, pbar=pbar):
                 pbar.update(1)
                 count += 1
                 mean_outer_loss += (results["mean_outer_loss"] - mean_outer_loss) / count
                 postfix = {"loss": "{0:.4f}".format(mean_outer_loss)}
+                for key in task_accuracies:
+                    if key in results:
+                        task_accuracies[key].extend(np.ravel(results[key]))
                 if "accuracies_after" in results:
                     mean_accuracy_af += (np.mean(results["accuracies_after"]) - mean_accuracy_af) / count
                     postfix["after in-loop"] = "{0:.4f}".format(np.mean(mean_accuracy_af))
@@ -456,16 +637,24 @@ class ModelAgnosticMetaLearning(object):
             mean_results["accuracies_after"] = mean_accuracy_af
         if "accuracies_before" in results:
             mean_results["accuracies_before"] = mean_accuracy_bf
+        for key, accuracies in task_accuracies.items():
+            if accuracies:
+                mean_results[key + "_ci95"] = confidence_interval(accuracies)
 
         return mean_results
 
     def evaluate_iter(self, dataloader, max_batches=500, pbar=None, **kwargs):
         num_batches = 0
         self.model.eval()
-        for batch, _ in zip(dataloader, range(max_batches)):
-
-            batch = tensors_to_device(batch, device=self.device)
-            _, results = self.get_outer_loss(batch, pbar=pbar)
+        pool_key = getattr(dataloader, "key", None)
+        for batch_id, batch in self.profiler.iterate(zip(range(max_batches), dataloader), "data"):
+
+            with self.profiler.phase("h2d"):
+                batch = tensors_to_device(batch, device=self.device)
+                if not self.stream_events:
+                    batch = self.transform_inputs(batch)
+            batch_key = None if pool_key is None else (pool_key, batch_id)
+            _, results = self.get_outer_loss(batch, pbar=pbar, batch_key=batch_key)
             yield results
 
 
@@ -7,10 +7,26 @@ from snn_maml.utils import quantize_parameters
 from collections import OrderedDict
 from . import plasticity_rules
 from .utils import tensors_to_device, compute_accuracy
+from .readout import Readout
 
 
 
 class MAMLCustom(ModelAgnosticMetaLearning):
+    """`ModelAgnosticMetaLearning` with the custom inner loop of
+    `plasticity_rules`. Output sequences `[batch_size, num_classes, time]` are
+    reduced to logits with `readout` (default: mean from timestep 50 on).
+    Outputs already reduced by the model (e.g. with a `readout` in its
+    parameter file) are used as they are.
+    """
+    def __init__(self, *args, readout=None, **kwargs):
+        super(MAMLCustom, self).__init__(*args, **kwargs)
+        self.readout = Readout('mean', start=50) if readout is None else readout
+
+    def reduce_logits(self, logits):
+        if logits.dim() == 2:
+            return logits
+        return self.readout.reduce(logits, dim=2)
+
     def get_outer_loss(self, batch, hard_clamp = False):
         if 'test' not in batch:
             raise RuntimeError('The batch does not contain any test dataset.')
@@ -48,18 +64,18 @@ class MAMLCustom(ModelAgnosticMetaLearning):
                 results['accuracies_before'][task_id] = adaptation_results['accuracy_before']
 
             with torch.set_grad_enabled(self.model.training):
-                test_logits = self.model(test_inputs, params=params)
+                test_logits = self.forward_model(test_inputs, params=params)
                 if self.loss_function is F.mse_loss:
-                    outer_loss = self.loss_function(test_logits, batch_one_hot(test_targets.to(test_targets.device), test_logits.shape[1]).cuda()) 
+                    outer_loss = self.loss_function(self.reduce_logits(test_logits), batch_one_hot(test_targets, test_logits.shape[1])) 
                 else:
-                    outer_loss = self.loss_function(test_logits[:,:,50:].mean(axis=2), test_targets)
+                    outer_loss = self.loss_function(self.reduce_logits(test_logits), test_targets)
                     
                 results['outer_losses'][task_id] = outer_loss.item()
                 mean_outer_loss += outer_loss
 
             if is_classification_task:
                 results['accuracies_after'][task_id] = compute_accuracy(
-                    test_logits[:,:,50:].mean(axis=2), test_targets)
+                    self.reduce_logits(test_logits), test_targets)
 
 
         mean_outer_loss.div_(num_tasks)
@@ -82,14 +98,14 @@ class MAMLCustom(ModelAgnosticMetaLearning):
 
         for step in range(num_adaptation_steps):
             
-            logits = self.model(inputs, params=params)
+            logits = self.forward_model(inputs, params=params)
             if self.loss_function == F.mse_loss:
-                inner_loss = self.loss_function(logits, batch_one_hot(targets, logits.shape[1]).cuda()) 
+                inner_loss = self.loss_function(self.reduce_logits(logits), batch_one_hot(targets, logits.shape[1])) 
             else:
-                inner_loss = self.loss_function(logits[:,:,50:].mean(axis=2), targets)
+                inner_loss = self.loss_function(self.reduce_logits(logits), targets)
             results['inner_losses'][step] = inner_loss.item()
             if (step == num_adaptation_steps-1) and is_classification_task: 
-                results['accuracy_before'] = compute_accuracy(logits[:,:,50:].mean(axis=2), targets)
+                results['accuracy_before'] = compute_accuracy(self.reduce_logits(logits), targets)
 
             #print("updating params...")
             self.model.zero_grad()
@@ -134,6 +150,8 @@ class MAMLCustom(ModelAgnosticMetaLearning):
                 self.optimizer.zero_grad()
 
                 batch = tensors_to_device(batch, device=self.device)
+                if not self.stream_events:
+                    batch = self.transform_inputs(batch)
                 outer_loss, results = self.get_outer_loss(batch)    
                 yield results
                 outer_loss.backward()
@@ -170,6 +188,8 @@ class MAMLCustom(ModelAgnosticMetaLearning):
                     break
 
                 batch = tensors_to_device(batch, device=self.device)
+                if not self.stream_events:
+                    batch = self.transform_inputs(batch)
                 _, results = self.get_outer_loss(batch)
                 yield results
 
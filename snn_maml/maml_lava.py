@@ -6,6 +6,7 @@ from snn_maml.utils import quantize_parameters
 from collections import OrderedDict
 from . import plasticity_rules
 from .utils import tensors_to_device, compute_accuracy, compute_accuracy_lava
+from .utils import batch_one_hot, undo_onehot
 from .maml import ModelAgnosticMetaLearning
 
 __all__ = ['ModelAgnosticMetaLearning', 'MAML', 'FOMAML']
@@ -16,23 +17,6 @@ import pdb
 
 # default `log_dir` is "runs" - we'll be more specific here
 
-def batch_one_hot(targets, num_classes=10):
-    one_hot = torch.zeros((targets.shape[0],num_classes))
-    #print("targets shape", targets.shape)
-    for i in range(targets.shape[0]):
-        one_hot[i][targets[i]] = 1
-        
-    return one_hot
-
-def undo_onehot(targets):
-    not_hot = torch.zeros((targets.shape[0]))
-    
-    for i in range(targets.shape[0]):
-        not_hot[i] = torch.nonzero(targets[0])[0][0].item()
-        
-    return not_hot.to(targets.device)
-
-
 class ModelAgnosticMetaLearning_Lava(ModelAgnosticMetaLearning):
     """Meta-learner class for Model-Agnostic Meta-Learning [1].
 
@@ -98,7 +82,8 @@ class ModelAgnosticMetaLearning_Lava(ModelAgnosticMetaLearning):
                  outer_loop_quantizer = None,
                  inner_loop_quantizer = None,
                  use_soel=False,
-                 learning_engine=None):
+                 learning_engine=None,
+                 input_transform=None):
         
         self.threshold = torch.tensor([.05], requires_grad=True, dtype=torch.float).to(device)
         print("Using quantiziation, delay, and spike rates with compute_accuracy_lava")
@@ -121,10 +106,14 @@ class ModelAgnosticMetaLearning_Lava(ModelAgnosticMetaLearning):
             boil=boil,
             outer_loop_quantizer = outer_loop_quantizer,
             inner_loop_quantizer = inner_loop_quantizer,
+            input_transform = input_transform,
             )
         
         
-    def get_outer_loss(self, batch):
+    def forward_query(self, inputs, params=None):
+        return self.model(inputs, params=params)
+
+    def get_outer_loss(self, batch, **kwargs):
         if 'test' not in batch:
             raise RuntimeError('The batch does not contain any test dataset.')
 
@@ -192,7 +181,7 @@ class ModelAgnosticMetaLearning_Lava(ModelAgnosticMetaLearning):
             #pdb.set_trace()
             #print("test phase")
             with torch.set_grad_enabled(self.model.training):
-                test_logits = self.model(test_inputs, params=params)
+                test_logits = self.forward_query(test_inputs, params=params)
                 #test_logits = self.model(train_inputs, params=params)
                 #pdb.set_trace()
                 #print("test")
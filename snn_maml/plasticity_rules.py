@@ -61,6 +61,7 @@ def custom_sgd(
     first_order=False,
     custom_update_fn=None,
     save_graph=False,
+    grad_scale=None,
 ):
     """Update of the meta-parameters with one step of gradient descent on the
     loss function.
@@ -86,6 +87,10 @@ def custom_sgd(
     first_order : bool (default: `False`)
         If `True`, then the first order approximation of MAML is used.
 
+    grad_scale : float, optional
+        Scale of the loss during the backward pass, removed from the
+        gradients, so that half-precision gradients do not underflow.
+
     Returns
     -------
     updated_params : `collections.OrderedDict` instance
@@ -111,11 +116,13 @@ def custom_sgd(
         make_dot(loss, params).render(str(path) + "/loss_graph")
 
     grads = torch.autograd.grad(
-        loss,
+        loss if grad_scale is None else loss * grad_scale,
         params.values(),
         create_graph=not first_order,
         allow_unused=True,
     )
+    if grad_scale is not None:
+        grads = tuple(g / grad_scale if g is not None else None for g in grads)
     for n, g in zip(params.keys(), grads):
         if g is None:
             print(f"grad is None for {n} at input {getattr(model, 'i', None)}")
@@ -0,0 +1,191 @@
+import json
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class NullProfiler(object):
+    """Profiler that records nothing, the default of the meta-learners"""
+
+    enabled = False
+
+    def phase(self, name):
+        return nullcontext()
+
+    def iterate(self, iterable, name="data"):
+        return iterable
+
+    def end_epoch(self, epoch=None):
+        return {}
+
+
+class PhaseProfiler(object):
+    """Wall time, counts and memory high-water marks of the named phases of
+    the meta-learning loop (data loading, inner-loop forward, ...).
+
+    Phases are opened with `with profiler.phase(name):` and may be nested.
+    Statistics are aggregated until `end_epoch`, which stores and returns
+    them, and can be exported with `export_json` (per-epoch summaries) and
+    `export_chrome_trace` (every phase as an event, for `chrome://tracing` or
+    Perfetto).
+
+    CUDA kernels run asynchronously, so without `cuda_events` the wall time
+    of a phase only includes the GPU work it waits for. With `cuda_events`,
+    each phase also records CUDA events, resolved (with one synchronization)
+    at `end_epoch`, for the GPU time of the phase.
+
+    Parameters
+    ----------
+    device : `torch.device` instance, optional
+        Device of the model, for CUDA events and memory statistics.
+
+    cuda_events : bool (default: False)
+        Record the GPU time of each phase with CUDA events.
+
+    memory : bool (default: True)
+        Record the peak allocated CUDA memory of each phase. The peak
+        statistics of the device are reset at the start of every phase, so
+        the peak of an enclosing phase only covers the part after its last
+        nested phase started.
+
+    trace : bool (default: False)
+        Keep every phase as an event for `export_chrome_trace`, up to
+        `max_events`.
+
+    max_events : int (default: 1000000)
+        Maximum number of trace events kept.
+    """
+
+    enabled = True
+
+    def __init__(
+        self, device=None, cuda_events=False, memory=True, trace=False, max_events=1000000
+    ):
+        device = torch.device(device) if device is not None else torch.device("cpu")
+        is_cuda = device.type == "cuda" and torch.cuda.is_available()
+        self.device = device
+        self.cuda_events = cuda_events and is_cuda
+        self.memory = memory and is_cuda
+        self.trace = trace
+        self.max_events = max_events
+        self.epochs = []
+        self.events = []
+        self._origin = time.perf_counter()
+        self._epoch = 0
+        self._reset()
+
+    def _reset(self):
+        self._stats = OrderedDict()
+        self._pending = []
+
+    def _stat(self, name):
+        stat = self._stats.get(name)
+        if stat is None:
+            stat = self._stats[name] = {
+                "count": 0,
+                "total_s": 0.0,
+                "max_s": 0.0,
+                "cuda_total_s": 0.0,
+                "peak_memory_bytes": 0,
+            }
+        return stat
+
+    @contextmanager
+    def phase(self, name):
+        if self.cuda_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        if self.memory:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            stat = self._stat(name)
+            stat["count"] += 1
+            stat["total_s"] += end - start
+            stat["max_s"] = max(stat["max_s"], end - start)
+            if self.cuda_events:
+                end_event.record()
+                self._pending.append((name, start_event, end_event))
+            if self.memory:
+                peak = torch.cuda.max_memory_allocated(self.device)
+                stat["peak_memory_bytes"] = max(stat["peak_memory_bytes"], peak)
+            if self.trace and len(self.events) < self.max_events:
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self._origin) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": 0,
+                        "tid": 0,
+                        "args": {"epoch": self._epoch},
+                    }
+                )
+
+    def iterate(self, iterable, name="data"):
+        """Iterate over `iterable`, timing each item fetch as phase `name`"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        """Statistics of the current epoch, `{phase: {...}}`"""
+        if self._pending:
+            torch.cuda.synchronize(self.device)
+            for name, start_event, end_event in self._pending:
+                self._stats[name]["cuda_total_s"] += start_event.elapsed_time(end_event) / 1000
+            self._pending = []
+
+        summary = OrderedDict()
+        for name, stat in self._stats.items():
+            s = dict(stat)
+            s["mean_s"] = s["total_s"] / s["count"]
+            if not self.cuda_events:
+                del s["cuda_total_s"]
+            if not self.memory:
+                del s["peak_memory_bytes"]
+            summary[name] = s
+        return summary
+
+    def end_epoch(self, epoch=None):
+        """Store and return the statistics of the epoch, and start a new one"""
+        summary = self.summary()
+        epoch = self._epoch if epoch is None else epoch
+        self.epochs.append({"epoch": epoch, "phases": summary})
+        self._epoch = epoch + 1
+        self._reset()
+        return summary
+
+    def format(self, summary=None):
+        """Table of `summary` (default: the current epoch), by total time"""
+        summary = self.summary() if summary is None else summary
+        lines = ["{0:<20} {1:>8} {2:>10} {3:>10}".format("phase", "count", "total s", "mean ms")]
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]["total_s"]):
+            lines.append(
+                "{0:<20} {1:>8} {2:>10.3f} {3:>10.3f}".format(
+                    name, s["count"], s["total_s"], 1000 * s["mean_s"]
+                )
+            )
+        return "\n".join(lines)
+
+    def export_json(self, filename):
+        if self._stats:
+            self.end_epoch()
+        with open(filename, "w") as f:
+            json.dump({"epochs": self.epochs}, f, indent=2)
+
+    def export_chrome_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
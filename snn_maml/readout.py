@@ -0,0 +1,136 @@
+from collections import deque
+
+import torch
+
+
+class Readout(object):
+    """Reduction of the per-timestep outputs of a spiking network to logits.
+
+    Outputs are reduced as they are produced (`accumulator`), so that the
+    `[batch_size, num_classes, time]` output sequence is never stored. Models
+    that compute all timesteps at once can use `reduce` on the full sequence
+    instead; both give the same result.
+
+    Parameters
+    ----------
+    mode : str (default: "mean")
+        `"last"`: output of the last timestep. `"mean"` / `"sum"`: mean / sum
+        over the window `[start, end)`. `"last_k"`: mean over the last `k`
+        timesteps. `"ewma"`: exponentially weighted average over the window,
+        `y_t = decay * y_{t-1} + (1 - decay) * x_t`, starting from `y = x` at
+        the first timestep of the window.
+
+    start : int (default: 0)
+        First timestep of the window, e.g. to skip the initial transient.
+
+    end : int, optional
+        End (excluded) of the window. Defaults to the last timestep.
+
+    k : int (default: 1)
+        Number of timesteps of `"last_k"`.
+
+    decay : float (default: 0.9)
+        Decay of `"ewma"`.
+    """
+
+    MODES = ("last", "mean", "sum", "last_k", "ewma")
+
+    def __init__(self, mode="mean", start=0, end=None, k=1, decay=0.9):
+        if mode not in self.MODES:
+            raise ValueError("Unknown readout mode `{0}`.".format(mode))
+        if mode == "last_k" and k < 1:
+            raise ValueError("The number of timesteps `k` must be positive.")
+        self.mode = mode
+        self.start = start
+        self.end = end
+        self.k = k
+        self.decay = decay
+
+    @classmethod
+    def from_params(cls, params):
+        """`Readout` from the `readout` section of a parameter file, or `None`"""
+        if params is None:
+            return None
+        if isinstance(params, str):
+            return cls(params)
+        return cls(**params)
+
+    def accumulator(self):
+        return ReadoutAccumulator(self)
+
+    def reduce(self, outputs, dim=-1):
+        """Reduce a whole output sequence, with time along `dim`"""
+        length = outputs.size(dim)
+        if self.mode == "last":
+            return outputs.select(dim, length - 1)
+        if self.mode == "last_k":
+            k = min(self.k, length)
+            return outputs.narrow(dim, length - k, k).mean(dim)
+
+        end = length if self.end is None else min(self.end, length)
+        if end <= self.start:
+            raise ValueError(
+                "The readout window [{0}, {1}) is empty.".format(self.start, end)
+            )
+        window = outputs.narrow(dim, self.start, end - self.start)
+        if self.mode == "mean":
+            return window.mean(dim)
+        if self.mode == "sum":
+            return window.sum(dim)
+
+        n = window.size(dim)
+        weights = self.decay ** torch.arange(
+            n - 1, -1, -1, dtype=outputs.dtype, device=outputs.device
+        )
+        weights[1:] *= 1 - self.decay
+        return torch.tensordot(window.movedim(dim, -1), weights, dims=1)
+
+    def __repr__(self):
+        return "{0}(mode={1!r}, start={2}, end={3}, k={4}, decay={5})".format(
+            self.__class__.__name__, self.mode, self.start, self.end, self.k, self.decay
+        )
+
+
+class ReadoutAccumulator(object):
+    """Running reduction of `Readout`, fed one timestep at a time. Only the
+    running value (or the last `k` outputs for `"last_k"`) is kept."""
+
+    def __init__(self, readout):
+        self.readout = readout
+        self.t = 0
+        self.count = 0
+        self.total = None
+        self.buffer = deque(maxlen=readout.k) if readout.mode == "last_k" else None
+
+    def update(self, output):
+        readout = self.readout
+        t = self.t
+        self.t += 1
+        if readout.mode == "last":
+            self.total = output
+            return
+        if readout.mode == "last_k":
+            self.buffer.append(output)
+            return
+        if t < readout.start or (readout.end is not None and t >= readout.end):
+            return
+
+        if self.total is None:
+            self.total = output
+        elif readout.mode == "ewma":
+            self.total = readout.decay * self.total + (1 - readout.decay) * output
+        else:
+            self.total = self.total + output
+        self.count += 1
+
+    def value(self):
+        mode = self.readout.mode
+        if mode == "last_k":
+            if not self.buffer:
+                raise ValueError("The readout did not receive any timestep.")
+            return sum(self.buffer) / len(self.buffer)
+        if self.total is None:
+            raise ValueError("No timestep fell in the readout window.")
+        if mode == "mean":
+            return self.total / self.count
+        return self.total
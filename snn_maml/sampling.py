@@ -0,0 +1,213 @@
+import copy
+import itertools
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from torch.utils.data import Dataset, Sampler
+from torchmeta.transforms import Categorical
+from torchmeta.transforms.utils import wrap_transform
+
+
+class ClassIndex(object):
+    """Precomputed per-class sample index of a torchmeta `ClassDataset`.
+
+    Sample `j` of class `c` has the global id `offsets[c] + j`. Per-class
+    datasets are built once per process and reused, instead of once per task as
+    `CombinationMetaDataset.__getitem__` does.
+
+    Parameters
+    ----------
+    class_dataset : `torchmeta.utils.data.ClassDataset` instance
+        The dataset of classes, e.g. `DoubleNMNIST(...).dataset`.
+    """
+
+    def __init__(self, class_dataset):
+        self.class_dataset = class_dataset
+        self._datasets = {}
+        self.sizes = np.array([len(self.get(c)) for c in range(len(class_dataset))], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+
+    def get(self, c):
+        """Dataset of class `c`"""
+        c = int(c)
+        if c not in self._datasets:
+            self._datasets[c] = self.class_dataset[c]
+        return self._datasets[c]
+
+    def sample_ids(self, c):
+        """Global ids of the samples of class `c`"""
+        return self.offsets[c] + np.arange(self.sizes[c])
+
+    def __getitem__(self, sample_id):
+        c = np.searchsorted(self.offsets, sample_id, side="right") - 1
+        return self.get(c)[int(sample_id - self.offsets[c])]
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def __getstate__(self):
+        # Per-class datasets may hold open file handles, rebuild them in workers
+        state = self.__dict__.copy()
+        state["_datasets"] = {}
+        return state
+
+
+class TaskIndexSampler(object):
+    """Draws whole meta-batches of N-way, K-shot tasks at once.
+
+    Returns `classes` of shape `[batch_size, num_ways]` (classes of a task are
+    distinct) and the within-class sample indices `support` and `query`, of
+    shapes `[batch_size, num_ways, num_shots]` and `[batch_size, num_ways,
+    num_shots_test]`. Support and query samples never overlap.
+
+    Parameters
+    ----------
+    class_sizes : array
+        Number of samples of each class, see `ClassIndex.sizes`.
+
+    num_ways : int
+        Number of classes per task.
+
+    num_shots : int
+        Number of support samples per class.
+
+    num_shots_test : int
+        Number of query samples per class.
+    """
+
+    def __init__(self, class_sizes, num_ways, num_shots, num_shots_test):
+        self.class_sizes = np.asarray(class_sizes, dtype=np.int64)
+        self.num_ways = num_ways
+        self.num_shots = num_shots
+        self.num_shots_test = num_shots_test
+
+        num_samples = num_shots + num_shots_test
+        if len(self.class_sizes) < num_ways:
+            raise ValueError(
+                "The number of classes ({0}) is smaller than the number of "
+                "classes per task ({1}).".format(len(self.class_sizes), num_ways)
+            )
+        if self.class_sizes.min() < num_samples:
+            raise ValueError(
+                "The number of samples for class `{0}` ({1}) is smaller than the "
+                "minimum number of samples per class ({2}).".format(
+                    self.class_sizes.argmin(), self.class_sizes.min(), num_samples
+                )
+            )
+
+    def __call__(self, batch_size, rng):
+        num_samples = self.num_shots + self.num_shots_test
+
+        # Random keys + argsort draws without replacement for all tasks at once
+        classes = np.argsort(rng.random((batch_size, len(self.class_sizes))), axis=1)
+        classes = classes[:, : self.num_ways]
+
+        sizes = self.class_sizes[classes]
+        keys = rng.random((batch_size, self.num_ways, sizes.max()))
+        keys[np.arange(sizes.max()) >= sizes[..., None]] = np.inf
+        samples = np.argpartition(keys, num_samples - 1, axis=-1)[..., :num_samples]
+        order = np.argsort(np.take_along_axis(keys, samples, axis=-1), axis=-1)
+        samples = np.take_along_axis(samples, order, axis=-1)
+
+        return classes, samples[..., : self.num_shots], samples[..., self.num_shots :]
+
+
+def _reset_categorical(transform):
+    transform.reset()
+    return transform
+
+
+class MetaBatchDataset(Dataset):
+    """Index-addressable dataset of meta-batches.
+
+    Item `i` is a whole meta-batch, drawn with `TaskIndexSampler` from a random
+    generator seeded by `(seed, i)`, in the same format as the output of
+    `BatchMetaDataLoader`: `{"train": [inputs, targets], "test": [inputs,
+    targets]}`. Inputs are grouped by class. Targets go through the target
+    transform of the meta-dataset, as in the tasks of `ClassSplitter`, with
+    `Categorical` transforms reset for each task (and shared by its support
+    and query sets). The torch generator is seeded from `(seed, i)` while
+    they are applied, so random label assignments are reproducible too.
+
+    Parameters
+    ----------
+    meta_dataset : `torchmeta.utils.data.CombinationMetaDataset` instance
+        A meta-dataset wrapped with `ClassSplitter`.
+
+    batch_size : int
+        Number of tasks per meta-batch.
+
+    seed : int (default: 0)
+        Seed of the task sampling.
+    """
+
+    def __init__(self, meta_dataset, batch_size, seed=0):
+        splits = meta_dataset.dataset_transform.splits
+        self.index = ClassIndex(meta_dataset.dataset)
+        self.sampler = TaskIndexSampler(
+            self.index.sizes, meta_dataset.num_classes_per_task, splits["train"], splits["test"]
+        )
+        self.batch_size = batch_size
+        self.seed = seed
+        self.target_transform = meta_dataset.target_transform
+
+    def _task_target_transform(self):
+        """Target transform of a new task, see `CombinationMetaDataset.__getitem__`"""
+        return wrap_transform(
+            copy.deepcopy(self.target_transform), _reset_categorical, transform_type=Categorical
+        )
+
+    def _load(self, task_classes, task_samples, target_transform):
+        inputs, targets = [], []
+        for c, class_samples in zip(task_classes, task_samples):
+            for j in class_samples:
+                input, target = self.index.get(c)[int(j)]
+                if target_transform is not None:
+                    target = target_transform(target)
+                inputs.append(torch.as_tensor(input))
+                targets.append(torch.as_tensor(target))
+        return torch.stack(inputs), torch.stack(targets)
+
+    def __getitem__(self, index):
+        rng = np.random.default_rng([self.seed, index])
+        classes, support, query = self.sampler(self.batch_size, rng)
+        train, test = [], []
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(int(rng.integers(2**63)))
+            for task_classes, task_support, task_query in zip(classes, support, query):
+                target_transform = self._task_target_transform()
+                train.append(self._load(task_classes, task_support, target_transform))
+                test.append(self._load(task_classes, task_query, target_transform))
+        return OrderedDict(
+            [
+                ("train", [torch.stack(split) for split in zip(*train)]),
+                ("test", [torch.stack(split) for split in zip(*test)]),
+            ]
+        )
+
+    def __len__(self):
+        return np.iinfo(np.int64).max
+
+
+class MetaBatchIndexSampler(Sampler):
+    """Yields meta-batch indices `start, start + 1, ...` without end. Successive
+    iterations continue where the previous one stopped, so every pass over the
+    data loader draws new tasks. The position is saved and restored with
+    `state_dict` and `load_state_dict`."""
+
+    def __init__(self, start=0):
+        self.next_index = start
+
+    def __iter__(self):
+        for index in itertools.count(self.next_index):
+            self.next_index = index + 1
+            yield index
+
+    def state_dict(self):
+        return {"next_index": self.next_index}
+
+    def load_state_dict(self, state):
+        self.next_index = state["next_index"]
@@ -0,0 +1,274 @@
+import base64
+import io
+import json
+import math
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from .adaptation_cache import AdaptationCache
+from .benchmarks import get_benchmark_by_name
+from .checkpoint import load_checkpoint, restore_step_size
+
+
+class AdaptationService(object):
+    """Few-shot inference with a trained meta-model: adapt once per task,
+    predict many times.
+
+    `adapt` runs the inner loop of the meta-learner once on the support set of
+    a task and caches the adapted parameters under its task id; `predict`
+    classifies query samples with them, in batches of `batch_size`. Adapted
+    parameters are kept in an `AdaptationCache`, evicting the least recently
+    used tasks beyond `max_tasks` or `max_bytes`.
+
+    The model keeps its spiking state in its layers, so calls are serialized
+    with a lock and the service can be shared by the threads of a server.
+
+    Parameters
+    ----------
+    metalearner : `ModelAgnosticMetaLearning` instance
+        Meta-learner of the trained model, e.g. from `from_checkpoint`.
+
+    max_tasks : int (default: 16)
+        Maximum number of adapted tasks kept.
+
+    max_bytes : int, optional
+        Maximum memory of the adapted parameters kept.
+
+    batch_size : int, optional
+        Maximum number of query samples per forward pass.
+
+    stream_mode : bool (default: True)
+        Adapt on the support samples one at a time, as in `get_outer_loss`.
+    """
+
+    def __init__(self, metalearner, max_tasks=16, max_bytes=None, batch_size=None, stream_mode=True):
+        self.metalearner = metalearner
+        self.model = metalearner.model
+        self.batch_size = batch_size
+        self.stream_mode = stream_mode
+        self.cache = AdaptationCache(max_entries=max_tasks, max_bytes=max_bytes)
+        self.lock = threading.Lock()
+        self.is_lava = hasattr(self.model, "blocks")
+        self.model.eval()
+
+    @classmethod
+    def from_checkpoint(
+        cls,
+        checkpoint,
+        benchmark="doublenmnistsequence",
+        params_file=None,
+        num_ways=5,
+        num_shots=1,
+        num_adaptation_steps=1,
+        step_size=None,
+        device="cpu",
+        folder=".",
+        **kwargs,
+    ):
+        """Service of the model of `benchmark` (built as in `train.py`, its
+        datasets are not loaded) with the weights of `checkpoint`. The step
+        size is the one saved in the checkpoint unless `step_size` is set."""
+        benchmark = get_benchmark_by_name(
+            benchmark,
+            folder,
+            num_ways,
+            num_ways,
+            num_shots,
+            num_shots,
+            params_file=params_file,
+            device=device,
+        )
+        state = load_checkpoint(checkpoint, map_location=device)
+        benchmark.model.load_state_dict(state["model"])
+
+        if hasattr(benchmark.model, "blocks"):
+            from .maml_lava import ModelAgnosticMetaLearning_Lava as metalearner_class
+        else:
+            from .maml import ModelAgnosticMetaLearning as metalearner_class
+        metalearner = metalearner_class(
+            benchmark.model,
+            step_size=1.0 if step_size is None else step_size,
+            num_adaptation_steps=num_adaptation_steps,
+            loss_function=benchmark.loss_function,
+            device=device,
+            input_transform=benchmark.input_transform,
+        )
+        if step_size is None and "step_size" in state:
+            restore_step_size(metalearner, state["step_size"])
+        return cls(metalearner, **kwargs)
+
+    def _inputs(self, inputs):
+        inputs = torch.as_tensor(inputs).to(self.metalearner.device)
+        if self.metalearner.stream_events:
+            # Events are binned chunk by chunk by the meta-learner
+            return inputs
+        if self.metalearner.input_transform is not None:
+            # Input transforms work on batches of tasks
+            inputs = self.metalearner.input_transform(inputs.unsqueeze(0))[0]
+        return inputs.to(next(self.model.parameters()).dtype)
+
+    def adapt(self, task_id, inputs, targets):
+        """Adapt the model to the support set `inputs` (`[num_samples, ...]`,
+        as in the batches of the benchmark) with labels `targets`, and cache
+        the parameters under `task_id`. Returns the inner-loop statistics."""
+        start = time.time()
+        inputs = self._inputs(inputs)
+        targets = torch.as_tensor(targets, dtype=torch.long).to(self.metalearner.device)
+        ml = self.metalearner
+        with self.lock, torch.enable_grad():
+            if self.is_lava:
+                params, results = ml.adapt(
+                    inputs,
+                    targets,
+                    0,
+                    num_adaptation_steps=ml.num_adaptation_steps,
+                    step_size=ml.step_size,
+                    first_order=True,
+                )
+            else:
+                params, results = ml.adapt(
+                    inputs,
+                    targets,
+                    num_adaptation_steps=ml.num_adaptation_steps,
+                    step_size=ml.step_size,
+                    first_order=True,
+                    stream_mode=self.stream_mode,
+                )
+            stored = self.cache.put(task_id, params)
+        if not stored:
+            raise MemoryError("The adapted parameters are larger than the cache.")
+        return {
+            "task_id": task_id,
+            "inner_losses": np.asarray(results["inner_losses"]).tolist(),
+            "time": time.time() - start,
+        }
+
+    def _predictions(self, logits):
+        if self.is_lava:
+            rate = logits.mean(dim=-1)
+            return rate.reshape(rate.shape[0], -1).argmax(dim=1)
+        first_spike_fn = getattr(self.model, "first_spike_fn", None)
+        if first_spike_fn is not None:
+            return first_spike_fn(logits).argmin(dim=-1)
+        return logits.argmax(dim=-1)
+
+    def predict(self, task_id, inputs, return_logits=False):
+        """Classes of the query samples `inputs` (`[num_samples, ...]`) with
+        the parameters adapted to `task_id`, and their logits if
+        `return_logits`. Raises `KeyError` if the task is not (or no longer)
+        adapted."""
+        with self.lock:
+            params = self.cache.get(task_id)
+        if params is None:
+            raise KeyError(task_id)
+        inputs = self._inputs(inputs)
+        num_chunks = 1
+        if self.batch_size is not None:
+            num_chunks = math.ceil(inputs.shape[0] / self.batch_size)
+        predictions, logits = [], []
+        with self.lock, torch.no_grad():
+            for chunk in torch.tensor_split(inputs, num_chunks):
+                chunk_logits = self.metalearner.forward_query(chunk, params=params)
+                predictions.append(self._predictions(chunk_logits))
+                if return_logits:
+                    logits.append(chunk_logits)
+        predictions = torch.cat(predictions)
+        if return_logits:
+            return predictions, torch.cat(logits)
+        return predictions
+
+    def forget(self, task_id):
+        with self.lock:
+            return self.cache.pop(task_id) is not None
+
+    def tasks(self):
+        with self.lock:
+            return self.cache.keys()
+
+
+def _decode_array(payload, name):
+    """Array `name` of a request, as a JSON (nested) list or as a base64 `.npy`
+    file under `<name>_npy`"""
+    if name + "_npy" in payload:
+        return np.load(io.BytesIO(base64.b64decode(payload[name + "_npy"])))
+    if name in payload:
+        return np.asarray(payload[name])
+    raise ValueError("Missing {0}.".format(name))
+
+
+def make_handler(service):
+    """HTTP request handler of `service`:
+
+    - `POST /tasks/<id>/adapt` with `inputs` and `targets`
+    - `POST /tasks/<id>/predict` with `inputs` (and `logits: true` for the logits)
+    - `DELETE /tasks/<id>`
+    - `GET /tasks` for the adapted tasks and the cache statistics
+    """
+    route = re.compile(r"^/tasks/([^/]+)(?:/(adapt|predict))?/?$")
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _payload(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/tasks":
+                return self._reply(404, {"error": "Not found."})
+            self._reply(200, {"tasks": service.tasks(), "cache": service.cache.stats()})
+
+        def do_POST(self):
+            match = route.match(self.path)
+            if match is None or match.group(2) is None:
+                return self._reply(404, {"error": "Not found."})
+            task_id, action = match.groups()
+            try:
+                payload = self._payload()
+                inputs = _decode_array(payload, "inputs")
+                if action == "adapt":
+                    body = service.adapt(task_id, inputs, _decode_array(payload, "targets"))
+                else:
+                    result = service.predict(task_id, inputs, return_logits=payload.get("logits"))
+                    if payload.get("logits"):
+                        predictions, logits = result
+                        body = {"predictions": predictions.tolist(), "logits": logits.tolist()}
+                    else:
+                        body = {"predictions": result.tolist()}
+            except KeyError:
+                return self._reply(404, {"error": "Task {0} is not adapted.".format(task_id)})
+            except (ValueError, TypeError, RuntimeError, MemoryError) as e:
+                return self._reply(400, {"error": str(e)})
+            self._reply(200, body)
+
+        def do_DELETE(self):
+            match = route.match(self.path)
+            if match is None or match.group(2) is not None:
+                return self._reply(404, {"error": "Not found."})
+            self._reply(200, {"forgotten": service.forget(match.group(1))})
+
+    return Handler
+
+
+def serve(service, host="127.0.0.1", port=8080):
+    """Serve `service` over HTTP until interrupted, see `make_handler`"""
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print("Serving on http://{0}:{1}".format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -21,6 +21,7 @@ from torchmeta.modules import (
     MetaLinear,
 )
 
+import torch
 import torch.nn as nn
 
 from decolle.utils import get_output_shape
@@ -32,6 +33,8 @@ import numpy as np
 
 import warnings
 
+from .readout import Readout
+
 m = nn.Sigmoid()
 
 
@@ -71,7 +74,7 @@ class MetaModuleNg(MetaModule):
 
 class MetaLenetDECOLLE(LenetDECOLLE, MetaModuleNg):
     def __init__(
-        self, burnin, detach_at=-1, sg_function_baseline=False, *args, **kwargs
+        self, burnin, detach_at=-1, sg_function_baseline=False, readout=None, *args, **kwargs
     ):
         self.non_spiking_baseline = sg_function_baseline
         if self.non_spiking_baseline is True:
@@ -79,6 +82,9 @@ class MetaLenetDECOLLE(LenetDECOLLE, MetaModuleNg):
         super(MetaLenetDECOLLE, self).__init__(*args, **kwargs)
         self.burnin = burnin
         self.detach_at = detach_at
+        # `Readout` of the output layer, applied step by step. `None` returns the
+        # last timestep, as `DECOLLEBase.forward` does
+        self.readout = readout
 
     def build_conv_stack(
         self,
@@ -201,43 +207,100 @@ class MetaLenetDECOLLE(LenetDECOLLE, MetaModuleNg):
 
         return (output_shape,)
 
-    def step(self, input, params=None):
+    def forward(self, data_batch, params=None, readout_state="u", **kwargs):
+        if kwargs.get("return_sequence", False):
+            return super(MetaLenetDECOLLE, self).forward(
+                data_batch, params=params, readout_state=readout_state, **kwargs
+            )
+        if kwargs.get("doinit", True):
+            self.init(data_batch)
+        acc = (self.readout or Readout("last")).accumulator()
+        layer_params = self.layer_params(params)
+        for t in range(self.burnin, data_batch.shape[1]):
+            out_ = self.step(data_batch[:, t], layer_params=layer_params)
+            acc.update(out_[self.output_statenames[readout_state]][-1])
+        return acc.value()
+
+    def forward_stream(self, chunks, params=None, tbptt=False, readout_state="u"):
+        """Same as `forward`, but the sequence is an iterable of `[batch_size,
+        chunk_time] + input_shape` chunks (e.g. `utils.time_chunks`), so that it
+        never needs to be in memory as a whole.
+
+        LIF states carry across chunks. With `tbptt`, they are detached at chunk
+        boundaries (truncated backpropagation through time). The burnin steps
+        are taken from the first chunk, which must be at least `burnin` long.
+        """
+        acc = (self.readout or Readout("last")).accumulator()
+        layer_params = self.layer_params(params)
+        for k, chunk in enumerate(chunks):
+            if k == 0:
+                if chunk.shape[1] < max(self.burnin, 1):
+                    raise ValueError(
+                        "The first chunk ({0} steps) is shorter than the burnin ({1} steps).".format(
+                            chunk.shape[1], self.burnin
+                        )
+                    )
+                self.init(chunk)
+                start = self.burnin
+            else:
+                start = 0
+                if tbptt:
+                    for lif in self.LIF_layers:
+                        lif.state = type(lif.state)(*[s.detach() for s in lif.state])
+            for t in range(start, chunk.shape[1]):
+                out_ = self.step(chunk[:, t], layer_params=layer_params)
+                acc.update(out_[self.output_statenames[readout_state]][-1])
+
+        return acc.value()
+
+    def layer_params(self, params=None):
+        """Parameters of each LIF layer in `params`, so that the subdicts are
+        resolved once per sequence rather than at every step"""
+        return [
+            self.get_subdict(params, "LIF_layers.{0}.base_layer".format(i))
+            for i in range(len(self.LIF_layers))
+        ]
+
+    def step(self, input, params=None, layer_params=None):
+        if layer_params is None:
+            layer_params = self.layer_params(params)
         s_out = []
         r_out = []
         u_out = []
-        i = 0
-        for lif, pool, ro, do in zip(
-            self.LIF_layers, self.pool_layers, self.readout_layers, self.dropout_layers
-        ):
-            if i == self.num_conv_layers:
-                input = input.view(input.size(0), -1)
-            s, u = lif(
-                input, self.get_subdict(params, "LIF_layers.{0}.base_layer".format(i))
-            )
-            if i == self.detach_at:
-                warnings.warn("detaching layer {0}".format(lif))
-                s = s.detach()
-                u = u.detach()
-            u_p = pool(u)
-            if i + 1 == self.num_layers and self.with_output_layer:
-                s_ = sigmoid(u_p)
-                # sd_ = u_p
-                # r_ = ro(sd_.reshape(sd_.size(0), -1))
-            elif self.non_spiking_baseline:
-                s_ = fast_sigmoid(u_p)  # m(u_p) #Fastsigmoid
-            else:
-                s_ = lif.sg_function(u_p)
-                # sd_ = do(s_)
-                # r_ = ro(sd_.reshape(sd_.size(0), -1))
-
+        for i, lif in enumerate(self.LIF_layers):
+            s_, u_p = self.step_layer(i, input, params=layer_params[i])
             s_out.append(s_)
             # r_out.append(r_)
             u_out.append(u_p)
             input = s_.detach() if lif.do_detach else s_
-            i += 1
 
         return s_out, r_out, u_out
 
+    def step_layer(self, i, input, params=None):
+        """One step of layer `i` alone, given the output of layer `i - 1` and the
+        parameters of the layer (see `layer_params`). Returns the output of the
+        layer and its pooled membrane potential."""
+        lif = self.LIF_layers[i]
+        if i == self.num_conv_layers:
+            input = input.view(input.size(0), -1)
+        s, u = lif(input, params)
+        if i == self.detach_at:
+            warnings.warn("detaching layer {0}".format(lif))
+            s = s.detach()
+            u = u.detach()
+        u_p = self.pool_layers[i](u)
+        if i + 1 == self.num_layers and self.with_output_layer:
+            s_ = sigmoid(u_p)
+            # sd_ = u_p
+            # r_ = ro(sd_.reshape(sd_.size(0), -1))
+        elif self.non_spiking_baseline:
+            s_ = fast_sigmoid(u_p)  # m(u_p) #Fastsigmoid
+        else:
+            s_ = lif.sg_function(u_p)
+            # sd_ = do(s_)
+            # r_ = ro(sd_.reshape(sd_.size(0), -1))
+        return s_, u_p
+
 
 class MetaRecLIFLayer(LIFLayer, MetaModuleNg):
     def __init__(*args, **kwargs):
@@ -248,11 +311,13 @@ class MetaRecLIFLayer(LIFLayer, MetaModuleNg):
 
 class MetaLIFLayer(LIFLayer, MetaModuleNg):
     def forward(self, Sin_t, params=None, *args, **kwargs):
+        # States take the type of the input, keep them in fp32 under autocast
+        state_input = Sin_t.float() if Sin_t.dtype in (torch.float16, torch.bfloat16) else Sin_t
         if self.state is None:
-            self.init_state(Sin_t)
+            self.init_state(state_input)
         if Sin_t.shape[0] != self.state.P.shape[0]:
             warnings.warn("Reinitializing state")
-            self.init_state(Sin_t)
+            self.init_state(state_input)
 
         state = self.state
         Q = self.beta * state.Q + (1 - self.beta) * Sin_t * self.gain
@@ -497,11 +562,9 @@ def build_model_DECOLLE(
     import torch
     import torch.nn.functional as F
 
-    params_file = params_file
-    with open(params_file, "r") as f:
-        import yaml
+    from .utils import load_params
 
-        params = yaml.safe_load(f)
+    params = load_params(params_file)
     verbose = True
 
     reg_l = params["reg_l"] if "reg_l" in params else None
@@ -531,6 +594,7 @@ def build_model_DECOLLE(
         burnin=params["burnin_steps"],
         detach_at=detach_at,
         sg_function_baseline=sg_function_baseline,
+        readout=Readout.from_params(params.get("readout")),
     ).to(device)
 
     net.LIF_layers[0].gain = 10
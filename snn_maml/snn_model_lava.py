@@ -34,6 +34,8 @@ from matplotlib import pyplot as plt
 
 import random
 
+from .readout import Readout
+
 m = nn.Sigmoid() 
 
 class FastSigmoid(torch.autograd.Function): 
@@ -87,69 +89,14 @@ def torch_init_LSUV(model, data_batch, block_ids, tgt_mu=0.0, tgt_var=1.0):
     '''
     Initialization inspired from Mishkin D and Matas J. All you need is a good init. arXiv:1511.06422 [cs],
 February 2016.
+    See snn_maml.init_functions.init_LSUV_lava
     '''
-    import torch
-    from torch.nn import init
-
-    device = model.blocks[block_ids[0]].neuron.device
-    ##Initialize
-    with torch.no_grad():
-        #def lsuv(model, data_batch):
-        for block_id in block_ids:
-            init.orthogonal_(model.blocks[block_id].synapse.weight.data)
-
-        for block_id in block_ids:
-            count=0
-            alldone = False
-            while not alldone:
-                alldone = True
-                state_layer = get_voltage_current_slayer_network(data_batch, model, block_id)
-                synapse = model.blocks[block_id].synapse
-                weight = model.blocks[block_id].synapse.weight
-                current = state_layer[1].cpu()
-                spikes = state_layer[0].cpu()
-                #pdb.set_trace()
-                v = np.var(current.flatten().numpy())
-                m = np.mean(current.flatten().numpy())
-                mus=np.mean(spikes.flatten().numpy()) 
-                print("Layer: {0}, Variance: {1:.3}, Mean U: {2:.3}, Mean S: {3:.3}".format(block_id, v, m, mus))
-                if np.isnan(v) or np.isnan(m):
-                    print('Nan encountered during init')
-                    done = False
-                    raise
-                if np.abs(v - tgt_var) > .2:#.2:
-                    if block_id >= 0:#0:
-                        # smaller steps for deeper layers
-                        weight.data /= (0.8 + .2 * np.sqrt(v))#(0.80 + .2 * np.sqrt(v))
-                        weight.data *= (0.8 + .2 * np.sqrt(tgt_var))#(0.80 + .2 * np.sqrt(tgt_var))
-                    else:
-                        weight.data *= np.sqrt(tgt_var) / (np.sqrt(v) + 1e-8)
-                    done = False
-                else:
-                    done = True
-                alldone *= done
-
-                if np.abs(m - tgt_mu) > .3:#.3:
-                    weight.data -= torch.tensor(.0001 * (m - tgt_mu), dtype=weight.dtype)#.0001
-                    done = False
-                else:
-                    done = True
-                alldone *= done
-                
-                count+=1
-                if count >= 100:
-                    alldone=True
-
-            if alldone:
-                print("Initialization finalized:")
-                print("Layer: {0}, Variance: {1:.3}, Mean U: {2:.3}".format(block_id, v, m))
-                print("-------------------------------------")
+    from .init_functions import init_LSUV_lava
+    init_LSUV_lava(model, data_batch, block_ids, tgt_mu=tgt_mu, tgt_var=tgt_var)
                 
 def init_LSUV_actrate(net, data_batch, act_rate, threshold=0., var=1.0):
-    from scipy.stats import norm
-    import scipy.optimize
-    tgt_mu = scipy.optimize.fmin(lambda loc: (act_rate-(1-norm.cdf(threshold,loc,var)))**2, x0=0.)[0]
-    init_LSUV(net, data_batch, tgt_mu=tgt_mu, tgt_var=var)
+    from .init_functions import init_LSUV_actrate
+    init_LSUV_actrate(net, data_batch, act_rate, threshold=threshold, var=var)
                 
         
 class LavaNet(nn.Module):
@@ -435,10 +382,13 @@ class MetaLavaNet(MetaModuleNg):
         if self.analog_readout:
             self.blocks[-1].neuron.return_internal_state = True
             
+        # optional `readout` section of the network params, see snn_maml.readout.Readout
+        self.readout = Readout.from_params(self.network_params.get('readout'))
         
         for block in self.blocks:
             block.neuron.quantize = self.neuron_params['quantize']
             
+        self.plan = self.build_plan()
             
         # use data initialization
         
@@ -479,7 +429,6 @@ class MetaLavaNet(MetaModuleNg):
                                    
     def build_mlp_stack(self):
         # slayer.block.cuba.Dense(neuron_params, 34*34*2, 512, weight_norm=True, delay=True) example for reference
-        pdb.set_trace()
         for mhid in range(len(self.network_params['Mhid'])):
             if not self.input_given:
                 if self.network_params['Nhid']:
@@ -526,63 +475,47 @@ class MetaLavaNet(MetaModuleNg):
 #             slayer.block.cuba.Dense(neuron_params, 512, 10, weight_norm=True),
 #         ])
     
+    def build_plan(self):
+        '''
+        Static execution plan of forward: one (parameter key, flatten) entry per block.
+        Conv and dense blocks take their weight from params, pooling blocks take none. Flatten
+        is set on the first dense block after the (spatial) input or conv stack. The plan does
+        not hold the blocks, so it stays valid when MetaLavaNetALIF rebuilds them (same layout).
+        '''
+        plan = []
+        n_conv = len(self.network_params['Nhid']) if self.network_params['Nhid'] else 0
+        spatial = True
+        for i in range(len(self.blocks)):
+            if i < 2*n_conv:
+                # conv, pool, conv, pool, ...
+                key = f'blocks.{i}.synapse.weight' if i%2==0 else None
+                plan.append((key, False))
+            else:
+                plan.append((f'blocks.{i}.synapse.weight', spatial))
+                spatial = False
+        return plan
+    
     def forward(self, spike, params=None):
         #self.analog_readout=False
         #self.blocks[-1].neuron.return_internal_state = False
         #spike = self.transpose_torchneuromorphic_to_SLAYER(spike)
+        if params is None:
+            params = OrderedDict(self.meta_named_parameters())
         
-        spike_input = spike.permute(0,2,3,4,1)
+        spike = spike.permute(0,2,3,4,1)
         
-        if not self.network_params['Nhid']:
-            # first layer is mlp, flatten input
-            spike = spike.flatten(1,3)
-            # try something like burnin which skips a certain number of steps
-            #spike = spike[:,:,70:]
-            
-        params_wb = OrderedDict()
-            
-        for k in range(1): # really simple way of doing a burnin type thing
-            spike = spike_input
-            i = 0
-            j = 0
-            for block in self.blocks:
-                if self.network_params['Nhid']:
-                    if i%2==0 and j!=(len(self.network_params['Nhid'])):
-                        spike, volt = block(spike, params=params[f'blocks.{i}.synapse.weight'])
-                        j+=1
-                    elif i<(len(self.network_params['Nhid'])*2):
-                        # should be pooling layer
-                        spike, volt = block(spike)
-                    else:
-#                       should be mlp or output layer, need to flatten input
-                        if len(spike.shape)>3:
-                            spike = spike.flatten(1,3)
-                        spike, volt = block(spike, params=params[f'blocks.{i}.synapse.weight'])
-#                     elif i==(len(self.blocks)-1):
-#                         # should be mlp or output layer, need to flatten input
-#                         spike = spike.flatten(1,3)
-#                         spike, volt = block(spike, params=params[f'blocks.{i}.synapse.weight'])
-#                     else:
-#                         # should be pooling layer
-#                         spike, volt = block(spike)
-
-
-                else:
-
-                    if len(spike.shape)>3:
-                        spike = spike.flatten(1,3)
-                    if block.neuron.return_internal_state:
-                        #pdb.set_trace()
-                        spike, volt = block(spike, params[f'blocks.{i}.synapse.weight'])
-                        #print("returning internal state")
-                        #pdb.set_trace()
-                    else:
-                        #pdb.set_trace()
-                        spike, volt = block(spike, params[f'blocks.{i}.synapse.weight'])
-                        #print("before final layer")
-                        #pdb.set_trace
+        for block, (key, flatten) in zip(self.blocks, self.plan):
+            if flatten:
+                spike = spike.flatten(1,3)
+            if key is None:
+                # pooling layer
+                spike, volt = block(spike)
+            else:
+                spike, volt = block(spike, params=params[key])
 
-                i+=1
+        if self.readout is not None:
+            # reduce right away so the [N, C, T] output is not returned and kept by the caller
+            return self.readout.reduce(spike if self.analog_readout else volt, dim=-1)
 
         if self.analog_readout:
             #pdb.set_trace()
@@ -647,6 +580,12 @@ class MetaLavaNet(MetaModuleNg):
 
         return grad
 
+    def export_loihi(self, filename, task_params=()):
+        # all quantized weights, delays and neuron params (and optionally adapted task weights) in one file,
+        # see snn_maml.export.export_network
+        from .export import export_network
+        return export_network(filename, self, task_params=task_params)
+
     def export_hdf5(self, filename):
         # network export to hdf5 format
         # compatable with netx for use with loihi 2 (1 could work too)
@@ -760,10 +699,9 @@ def build_model_lava(out_features, params_file, device, detach_at, sg_function_b
     import torch
     import torch.nn.functional as F
 
-    params_file = params_file 
-    with open(params_file, 'r') as f:
-        import yaml
-        params = yaml.safe_load(f)
+    from .utils import load_params
+
+    params = load_params(params_file)
     verbose = True
     
     # params['neuron_model']['current_decay'] = round(random.uniform(0.01,0.99),2)
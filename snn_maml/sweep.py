@@ -0,0 +1,601 @@
+import copy
+import hashlib
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import time
+import traceback
+
+import numpy as np
+import torch
+
+from torchmeta.utils.data import BatchMetaDataLoader
+
+from .benchmarks import get_benchmark_by_name
+from .checkpoint import (
+    BUNDLE_FORMAT,
+    atomic_save,
+    load_checkpoint,
+    restore_step_size,
+    seed_everything,
+)
+from .utils import load_params, tensors_to_device
+
+# Configuration entries that are options of the meta-learning, as in train.py.
+# Other entries override the parameter file (dotted paths for nested entries).
+TRAINING_OPTIONS = ("meta_lr", "step_size", "num_steps", "first_order", "batch_size", "params_file")
+
+# Short names of entries of the parameter files, per model type: lava files
+# (with a `neuron_model` section) and DECOLLE files, where `alpha` and `beta`
+# are the voltage and current decays (as retention factors, e.g. 0.95, not
+# as the decay rates of lava). Names without an entry for the model of the
+# file are rejected by `apply_overrides`.
+PARAM_ALIASES = {
+    "lava": {
+        "current_decay": "neuron_model.current_decay",
+        "voltage_decay": "neuron_model.voltage_decay",
+        "threshold": "neuron_model.threshold",
+        "tau_grad": "neuron_model.tau_grad",
+        "scale_grad": "neuron_model.scale_grad",
+    },
+    "decolle": {
+        "current_decay": "beta",
+        "voltage_decay": "alpha",
+        "refractory_decay": "alpharp",
+    },
+}
+
+DEFAULT_OPTIONS = {
+    "benchmark": "doublenmnistsequence",
+    "folder": "./",
+    "params_file": "parameters/decolle_params-CNN.yml",
+    "num_ways": 5,
+    "num_shots": 1,
+    "num_shots_test": 10,
+    "batch_size": 1,
+    "num_steps": 1,
+    "first_order": False,
+    "meta_lr": 2e-3,
+    "step_size": 1.0,
+    "num_epochs": 10,
+    "num_batches": 100,
+    "num_batches_test": 20,
+    "num_workers": 0,
+    "shared_store": None,
+    "seed": 0,
+}
+
+# Options that do not change the results of a configuration, left out of its id
+RUNTIME_OPTIONS = ("num_workers", "shared_store")
+
+
+def config_id(config, options=None):
+    """Short stable identifier of a configuration trained with `options`
+    (missing ones take their default value), so that the results and
+    checkpoints of a store are only reused with the same benchmark, parameter
+    file and budget"""
+    settings = dict(DEFAULT_OPTIONS)
+    settings.update(options or {})
+    settings = {k: v for k, v in settings.items() if k not in RUNTIME_OPTIONS}
+    text = json.dumps({"config": config, "options": settings}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:10]
+
+
+def grid(space):
+    """All the configurations of `space`, `{name: [values]}`"""
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def sample(space, num_samples, seed=0):
+    """`num_samples` random configurations of `space`. Entries are lists of
+    values, or `{"low": ..., "high": ..., "log": bool}` ranges."""
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(num_samples):
+        config = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, dict):
+                low, high = values["low"], values["high"]
+                if values.get("log", False):
+                    config[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    config[name] = rng.uniform(low, high)
+            else:
+                config[name] = rng.choice(values)
+        configs.append(config)
+    return configs
+
+
+def apply_overrides(params, overrides):
+    """Copy of `params` with the (dotted) entries of `overrides` replaced.
+    Names are first resolved with the `PARAM_ALIASES` of the model type of
+    `params`. Entries must exist in `params`, so that a misspelled or
+    unsupported name does not silently leave the model unchanged. Scalars
+    replacing a per-layer list are given as a one-element list, which DECOLLE
+    models broadcast to all layers."""
+    params = copy.deepcopy(params)
+    aliases = PARAM_ALIASES["lava" if "neuron_model" in params else "decolle"]
+    for name, value in overrides.items():
+        path = aliases.get(name, name).split(".")
+        node = params
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                raise ValueError(
+                    "`{0}` is not an entry of the parameter file.".format(".".join(path))
+                )
+            parent, node = node, node[key]
+        if isinstance(node, list) and not isinstance(value, (list, tuple)):
+            value = [value]
+        parent[path[-1]] = value
+    return params
+
+
+def write_params(params_file, overrides, filename):
+    """Write `params_file` with `overrides` to `filename`, returns `filename`"""
+    import yaml
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        yaml.safe_dump(apply_overrides(load_params(params_file), overrides), f)
+    return filename
+
+
+class ResultsStore(object):
+    """Results of a sweep, one JSON record per line in `filename`. Records are
+    appended as they come, so an interrupted sweep keeps its results and can
+    skip the configurations already done (`completed`)."""
+
+    def __init__(self, filename):
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.filename = filename
+
+    def append(self, record):
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def records(self):
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def completed(self):
+        """Identifiers of the configurations with a result (not an error)"""
+        return {r["id"] for r in self.records() if "error" not in r}
+
+    def best(self, key="accuracy", ids=None):
+        """Record with the highest `key`, among the configurations `ids` if
+        given (e.g. those of the current options, see `config_id`)"""
+        records = [r for r in self.records() if r.get(key) is not None]
+        if ids is not None:
+            records = [r for r in records if r["id"] in ids]
+        return max(records, key=lambda r: r[key]) if records else None
+
+
+class Trial(object):
+    """One configuration, built in-process: benchmark (sharing the meta-datasets
+    of the process, see `get_benchmark_by_name`), model and meta-learner.
+    `train` and `evaluate` can be called repeatedly, training continues where
+    it stopped. `save` writes the model, optimizer and step size, from which a
+    later `Trial(..., checkpoint=path)` continues (with a new data order)."""
+
+    def __init__(self, config, options=None, device="cpu", folder=".", checkpoint=None):
+        self.config = dict(config)
+        self.id = config_id(self.config, options)
+        settings = dict(DEFAULT_OPTIONS)
+        settings.update(options or {})
+        overrides = {}
+        for name, value in self.config.items():
+            if name in TRAINING_OPTIONS:
+                settings[name] = value
+            else:
+                overrides[name] = value
+        self.settings = settings
+
+        params_file = settings["params_file"]
+        if overrides:
+            params_file = write_params(
+                params_file, overrides, os.path.join(folder, "params", self.id + ".yml")
+            )
+        self.params = load_params(params_file)
+        seed_everything(settings["seed"])
+
+        self.benchmark = get_benchmark_by_name(
+            settings["benchmark"],
+            settings["folder"],
+            settings["num_ways"],
+            settings["num_ways"],
+            settings["num_shots"],
+            settings["num_shots_test"],
+            params_file=params_file,
+            device=device,
+            shared_store=settings["shared_store"],
+        )
+        model = self.benchmark.model
+        optimizer = torch.optim.Adam(model.parameters(), lr=settings["meta_lr"])
+        if hasattr(model, "blocks"):
+            from .maml_lava import ModelAgnosticMetaLearning_Lava as metalearner_class
+        else:
+            from .maml import ModelAgnosticMetaLearning as metalearner_class
+        self.metalearner = metalearner_class(
+            model,
+            optimizer,
+            first_order=settings["first_order"],
+            num_adaptation_steps=settings["num_steps"],
+            step_size=settings["step_size"],
+            loss_function=self.benchmark.loss_function,
+            device=device,
+            input_transform=self.benchmark.input_transform,
+        )
+        self.batches_trained = 0
+        self._train_batches = self._cycle(self.benchmark.meta_train_dataset)
+        self._devnull = open(os.devnull, "w")
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._restore(checkpoint, device)
+        else:
+            self._init_model(device)
+
+    def _restore(self, path, device):
+        state = load_checkpoint(path, map_location=device)
+        self.benchmark.model.load_state_dict(state["model"])
+        self.metalearner.optimizer.load_state_dict(state["optimizer"])
+        restore_step_size(self.metalearner, state["step_size"])
+        self.batches_trained = state["step"]
+
+    def save(self, path):
+        atomic_save(
+            {
+                "format": BUNDLE_FORMAT,
+                "step": self.batches_trained,
+                "model": self.benchmark.model.state_dict(),
+                "optimizer": self.metalearner.optimizer.state_dict(),
+                "step_size": self.metalearner.step_size,
+                "config": self.config,
+            },
+            path,
+        )
+
+    def _dataloader(self, dataset):
+        return BatchMetaDataLoader(
+            dataset,
+            batch_size=self.settings["batch_size"],
+            shuffle=True,
+            num_workers=self.settings["num_workers"],
+        )
+
+    def _cycle(self, dataset):
+        while True:
+            for batch in self._dataloader(dataset):
+                yield batch
+
+    def _init_model(self, device):
+        """LSUV initialization, as in train.py"""
+        from .init_functions import init_LSUV_actrate
+
+        model = self.benchmark.model
+        if not (hasattr(model, "LIF_layers") or hasattr(model, "blocks")):
+            return
+        batch = next(self._train_batches)
+        batch = self.metalearner.transform_inputs(tensors_to_device(batch, device=device))
+        data_batch = batch["train"][0]
+        data_batch = data_batch.reshape(-1, *data_batch.shape[2:])
+        act_rate = self.params.get("act_rate", 0.5)
+        init_LSUV_actrate(model, data_batch, act_rate)
+
+    def train(self, num_batches):
+        results = self.metalearner.train(
+            self._train_batches, max_batches=num_batches, verbose=False, file=self._devnull
+        )
+        self.batches_trained += num_batches
+        return results
+
+    def evaluate(self, num_batches):
+        return self.metalearner.evaluate(
+            self._dataloader(self.benchmark.meta_val_dataset),
+            max_batches=num_batches,
+            verbose=False,
+            file=self._devnull,
+        )
+
+    def close(self):
+        self._devnull.close()
+
+
+def run_config(config, options, device="cpu", folder="."):
+    """Train and validate `config` for `num_epochs` epochs, returns its record"""
+    start = time.time()
+    trial = Trial(config, options, device=device, folder=folder)
+    history = []
+    for epoch in range(trial.settings["num_epochs"]):
+        trial.train(trial.settings["num_batches"])
+        results = trial.evaluate(trial.settings["num_batches_test"])
+        history.append(results.get("accuracies_after"))
+    trial.close()
+    return {
+        "id": trial.id,
+        "config": config,
+        "accuracy": history[-1] if history else None,
+        "history": history,
+        "batches": trial.batches_trained,
+        "time": time.time() - start,
+    }
+
+
+def preload(options, configs=()):
+    """Build the meta-datasets of `options` in this process, on the CPU, so that
+    forked workers share them instead of loading them again. The parameter
+    files of `configs` that set `params_file` are loaded too."""
+    settings = dict(DEFAULT_OPTIONS)
+    settings.update(options or {})
+    params_files = [settings["params_file"]]
+    for config in configs:
+        if config.get("params_file") not in (None, *params_files):
+            params_files.append(config["params_file"])
+    for params_file in params_files:
+        benchmark = get_benchmark_by_name(
+            settings["benchmark"],
+            settings["folder"],
+            settings["num_ways"],
+            settings["num_ways"],
+            settings["num_shots"],
+            settings["num_shots_test"],
+            params_file=params_file,
+            device="cpu",
+            shared_store=settings["shared_store"],
+        )
+        benchmark.meta_train_dataset
+        benchmark.meta_val_dataset
+
+
+def _worker(function, jobs, results, device, threads):
+    torch.set_num_threads(threads)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        key, args = job
+        try:
+            record = function(*args, device=device)
+        except Exception:
+            record = {"error": traceback.format_exc()}
+        results.put((key, record))
+
+
+def run_parallel(function, jobs, num_workers=None, threads_per_worker=1, devices=("cpu",)):
+    """Run `function(*args, device=device)` for every `(key, args)` of `jobs` in
+    forked worker processes, and yield the `(key, result)` pairs as they come.
+
+    Workers are forked from this process, so they share what it has loaded
+    (e.g. with `preload`). They use `threads_per_worker` torch threads each, and
+    by default as many workers as fit on the cores. Worker `i` runs on
+    `devices[i % len(devices)]`; CUDA must not be initialized in this process
+    before forking. Failed jobs give `{"error": traceback}`.
+    """
+    import multiprocessing
+
+    jobs = list(jobs)
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    num_workers = max(1, min(num_workers, len(jobs)))
+
+    context = multiprocessing.get_context("fork")
+    job_queue = context.Queue()
+    result_queue = context.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(num_workers):
+        job_queue.put(None)
+
+    # Not daemonic, so that workers can have data-loading processes
+    workers = [
+        context.Process(
+            target=_worker,
+            args=(function, job_queue, result_queue, devices[i % len(devices)], threads_per_worker),
+        )
+        for i in range(num_workers)
+    ]
+    for w in workers:
+        w.start()
+
+    pending = {key for key, _ in jobs}
+    try:
+        while pending:
+            try:
+                key, record = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    for key in sorted(pending):
+                        yield key, {"error": "Worker process died."}
+                    return
+                continue
+            pending.discard(key)
+            yield key, record
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+
+
+def sweep(configs, options, folder, num_workers=None, threads_per_worker=1, devices=("cpu",)):
+    """Evaluate `configs` with `run_config` in parallel, writing the records to
+    `folder/results.jsonl` as they complete. Configurations with a result in
+    the store (with the same options, see `config_id`) are skipped. Returns
+    the store."""
+    store = ResultsStore(os.path.join(folder, "results.jsonl"))
+    done = store.completed()
+    jobs = [(config_id(c, options), (c, options)) for c in configs]
+    jobs = [job for job in jobs if job[0] not in done]
+    if not jobs:
+        return store
+
+    preload(options, configs)
+
+    def run(config, options, device="cpu"):
+        return run_config(config, options, device=device, folder=folder)
+
+    configs_by_id = {key: args[0] for key, args in jobs}
+    for key, record in run_parallel(run, jobs, num_workers, threads_per_worker, devices):
+        record.setdefault("id", key)
+        record.setdefault("config", configs_by_id[key])
+        store.append(record)
+        print("Configuration {0}: {1}".format(key, record.get("accuracy", "error")))
+    return store
+
+
+def run_rung(config, options, num_batches, checkpoint, device="cpu", folder="."):
+    """Train `config` up to `num_batches` batches in total, continuing from
+    `checkpoint` if it exists, and validate it. Returns its record."""
+    start = time.time()
+    os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+    trial = Trial(config, options, device=device, folder=folder, checkpoint=checkpoint)
+    if num_batches > trial.batches_trained:
+        trial.train(num_batches - trial.batches_trained)
+        trial.save(checkpoint)
+    results = trial.evaluate(trial.settings["num_batches_test"])
+    trial.close()
+    return {
+        "id": trial.id,
+        "config": config,
+        "accuracy": results.get("accuracies_after"),
+        "batches": trial.batches_trained,
+        "time": time.time() - start,
+    }
+
+
+def successive_halving(
+    configs,
+    options,
+    folder,
+    min_batches=10,
+    max_batches=None,
+    eta=3,
+    num_workers=None,
+    threads_per_worker=1,
+    devices=("cpu",),
+    bracket=0,
+):
+    """Successive halving over `configs`: train all of them for `min_batches`
+    batches, keep the best `1 / eta` of them (by validation accuracy), train
+    the survivors `eta` times longer, and so on until one remains or the
+    budget reaches `max_batches` (default: `num_epochs * num_batches`).
+
+    The rungs run in parallel with `run_parallel`. Survivors continue from
+    their checkpoints in `folder/trials` (`<bracket>-<id>.th`), and the records of every rung are
+    appended to `folder/halving.jsonl`, with the rung and `bracket` (an index
+    separating the runs of `hyperband`). Rungs
+    already recorded there with the same options and budget are not run
+    again, so an interrupted run resumes.
+    Returns the records of the last rung, best first.
+    """
+    settings = dict(DEFAULT_OPTIONS)
+    settings.update(options or {})
+    if max_batches is None:
+        max_batches = settings["num_epochs"] * settings["num_batches"]
+    store = ResultsStore(os.path.join(folder, "halving.jsonl"))
+    done = {
+        (r["bracket"], r["rung"], r["id"], r.get("budget")): r
+        for r in store.records()
+        if "error" not in r and "rung" in r
+    }
+
+    def run(config, options, num_batches, checkpoint, device="cpu"):
+        return run_rung(config, options, num_batches, checkpoint, device=device, folder=folder)
+
+    preloaded = False
+    survivors = list({config_id(c, options): c for c in configs}.values())
+    rung = 0
+    num_batches = min(min_batches, max_batches)
+    while True:
+        records = {}
+        jobs = []
+        for config in survivors:
+            key = config_id(config, options)
+            if (bracket, rung, key, num_batches) in done:
+                records[key] = done[(bracket, rung, key, num_batches)]
+            else:
+                checkpoint = os.path.join(folder, "trials", "{0}-{1}.th".format(bracket, key))
+                jobs.append((key, (config, options, num_batches, checkpoint)))
+        if jobs and not preloaded:
+            preload(options, survivors)
+            preloaded = True
+        configs_by_id = {key: args[0] for key, args in jobs}
+        for key, record in run_parallel(run, jobs, num_workers, threads_per_worker, devices):
+            record.setdefault("id", key)
+            record.setdefault("config", configs_by_id[key])
+            record.update(bracket=bracket, rung=rung, budget=num_batches)
+            store.append(record)
+            records[key] = record
+            print(
+                "Bracket {0}, rung {1} ({2} batches), configuration {3}: {4}".format(
+                    bracket, rung, num_batches, key, record.get("accuracy", "error")
+                )
+            )
+
+        ranked = sorted(
+            records.values(),
+            key=lambda r: -r["accuracy"] if r.get("accuracy") is not None else math.inf,
+        )
+        num_survivors = max(1, len(ranked) // eta)
+        if len(ranked) <= 1 or num_batches >= max_batches:
+            return ranked
+        survivors = [r["config"] for r in ranked[:num_survivors] if "error" not in r]
+        if not survivors:
+            return ranked
+        num_batches = min(num_batches * eta, max_batches)
+        rung += 1
+
+
+def hyperband(
+    space,
+    options,
+    folder,
+    min_batches=10,
+    max_batches=None,
+    eta=3,
+    seed=0,
+    num_workers=None,
+    threads_per_worker=1,
+    devices=("cpu",),
+):
+    """Hyperband: successive halving brackets over random configurations of
+    `space` (see `sample`), from many configurations starting at `min_batches`
+    to a few trained for `max_batches` from the start, hedging against
+    configurations that only do well with longer training. Returns the best
+    record of the last rungs."""
+    settings = dict(DEFAULT_OPTIONS)
+    settings.update(options or {})
+    if max_batches is None:
+        max_batches = settings["num_epochs"] * settings["num_batches"]
+    num_brackets = int(math.log(max_batches / min_batches, eta) + 1e-9) + 1
+
+    best = None
+    for bracket in range(num_brackets):
+        s = num_brackets - 1 - bracket
+        num_configs = int(math.ceil(num_brackets / (s + 1) * eta**s))
+        configs = sample(space, num_configs, seed=seed + bracket)
+        ranked = successive_halving(
+            configs,
+            options,
+            folder,
+            min_batches=max_batches // eta**s,
+            max_batches=max_batches,
+            eta=eta,
+            num_workers=num_workers,
+            threads_per_worker=threads_per_worker,
+            devices=devices,
+            bracket=bracket,
+        )
+        if ranked and ranked[0].get("accuracy") is not None:
+            if best is None or ranked[0]["accuracy"] > best["accuracy"]:
+                best = ranked[0]
+    return best
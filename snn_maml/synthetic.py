@@ -0,0 +1,222 @@
+import numpy as np
+import torch
+
+from torchmeta.utils.data import ClassDataset, CombinationMetaDataset, Dataset
+
+
+SPLIT_IDS = {"train": 0, "val": 1, "test": 2}
+NUM_CLASSES = {"train": 64, "val": 16, "test": 20}
+
+
+def _seed(*keys):
+    return int(np.random.SeedSequence([int(k) for k in keys]).generate_state(1)[0])
+
+
+class SyntheticSpikeGenerator(object):
+    """Generates spike count frames of shape `[chunk_size] + input_shape` for
+    synthetic spiking classes, deterministically from `(seed, split, class,
+    sample)`. Nothing is read from disk.
+
+    Parameters
+    ----------
+    input_shape : list
+        `[polarities, width, height]` of the frames.
+
+    chunk_size : int
+        Number of timesteps.
+
+    mode : str (default: "poisson")
+        `"poisson"`: each class is a sparse map of active pixels firing with
+        probability `rate` at every step. `"pattern"`: each class is a fixed
+        spatio-temporal spike pattern, shifted in time by up to `jitter` steps
+        and with a fraction `dropout` of its spikes removed in each sample.
+
+    sparsity : float (default: 0.1)
+        Fraction of active pixels of a class.
+
+    rate : float (default: 0.2)
+        Spike probability per step of active pixels.
+
+    noise : float (default: 0.01)
+        Spike probability per step of the background (all pixels).
+
+    jitter : int (default: 5)
+        Maximum time shift of `"pattern"` samples.
+
+    dropout : float (default: 0.1)
+        Fraction of the spikes of the pattern removed in `"pattern"` samples.
+
+    seed : int (default: 0)
+        Seed of the classes and samples.
+    """
+
+    def __init__(
+        self,
+        input_shape,
+        chunk_size,
+        mode="poisson",
+        sparsity=0.1,
+        rate=0.2,
+        noise=0.01,
+        jitter=5,
+        dropout=0.1,
+        seed=0,
+    ):
+        if mode not in ("poisson", "pattern"):
+            raise ValueError("Unknown synthetic mode `{0}`.".format(mode))
+        self.input_shape = list(input_shape)
+        self.chunk_size = chunk_size
+        self.mode = mode
+        self.sparsity = sparsity
+        self.rate = rate
+        self.noise = noise
+        self.jitter = jitter
+        self.dropout = dropout
+        self.seed = seed
+        self._prototypes = {}
+
+    def prototype(self, split, label):
+        """Firing probability map (`"poisson"`) or spike pattern (`"pattern"`)"""
+        key = (split, label)
+        if key not in self._prototypes:
+            g = torch.Generator().manual_seed(_seed(self.seed, SPLIT_IDS[split], label))
+            active = torch.rand(self.input_shape, generator=g) < self.sparsity
+            if self.mode == "poisson":
+                prototype = self.noise + self.rate * active.float()
+            else:
+                spikes = torch.rand([self.chunk_size] + self.input_shape, generator=g)
+                prototype = (spikes < self.rate) & active
+            self._prototypes[key] = prototype
+        return self._prototypes[key]
+
+    def __call__(self, split, label, index):
+        g = torch.Generator().manual_seed(_seed(self.seed, SPLIT_IDS[split], label, index + 1))
+        shape = [self.chunk_size] + self.input_shape
+        prototype = self.prototype(split, label)
+        if self.mode == "poisson":
+            return (torch.rand(shape, generator=g) < prototype).float()
+
+        shift = int(torch.randint(-self.jitter, self.jitter + 1, (1,), generator=g))
+        spikes = torch.roll(prototype, shift, dims=0)
+        spikes = spikes & (torch.rand(shape, generator=g) >= self.dropout)
+        spikes = spikes | (torch.rand(shape, generator=g) < self.noise)
+        return spikes.float()
+
+
+class SyntheticClass(Dataset):
+    def __init__(
+        self, index, split, label, num_samples, generator, transform=None, target_transform=None
+    ):
+        super(SyntheticClass, self).__init__(
+            index, transform=transform, target_transform=target_transform
+        )
+        self.split = split
+        self.label = label
+        self.num_samples = num_samples
+        self.generator = generator
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        data = self.generator(self.split, self.label, index)
+        target = self.label
+
+        if self.transform is not None:
+            data = self.transform(data)
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return data, target
+
+
+class SyntheticClassDataset(ClassDataset):
+    def __init__(
+        self,
+        generator,
+        num_classes=None,
+        samples_per_class=100,
+        meta_train=False,
+        meta_val=False,
+        meta_test=False,
+        meta_split=None,
+        transform=None,
+        class_augmentations=None,
+    ):
+        super(SyntheticClassDataset, self).__init__(
+            meta_train=meta_train,
+            meta_val=meta_val,
+            meta_test=meta_test,
+            meta_split=meta_split,
+            class_augmentations=class_augmentations,
+        )
+        self.generator = generator
+        self.samples_per_class = samples_per_class
+        self.transform = transform
+        self._num_classes = (
+            NUM_CLASSES[self.meta_split] if num_classes is None else num_classes
+        )
+
+    @property
+    def num_classes(self):
+        return self._num_classes
+
+    def __getitem__(self, index):
+        label = index % self.num_classes
+        transform = self.get_transform(index, self.transform)
+        return SyntheticClass(
+            index,
+            self.meta_split,
+            label,
+            self.samples_per_class,
+            self.generator,
+            transform=transform,
+        )
+
+
+class SyntheticSpikes(CombinationMetaDataset):
+    """In-memory spiking meta-dataset of random classes, with the same interface
+    as the torchneuromorphic meta-datasets (e.g. `DoubleNMNIST`). Samples are
+    `[chunk_size] + input_shape` count frames.
+
+    Meta-train, meta-val and meta-test classes are disjoint (64, 16 and 20
+    classes by default, as in `DoubleNMNIST`). Extra keyword arguments are
+    passed to `SyntheticSpikeGenerator`.
+    """
+
+    def __init__(
+        self,
+        input_shape,
+        chunk_size,
+        num_classes_per_task=None,
+        meta_train=False,
+        meta_val=False,
+        meta_test=False,
+        meta_split=None,
+        num_classes=None,
+        samples_per_class=100,
+        transform=None,
+        target_transform=None,
+        dataset_transform=None,
+        class_augmentations=None,
+        **kwargs,
+    ):
+        generator = SyntheticSpikeGenerator(input_shape, chunk_size, **kwargs)
+        dataset = SyntheticClassDataset(
+            generator,
+            num_classes=num_classes,
+            samples_per_class=samples_per_class,
+            meta_train=meta_train,
+            meta_val=meta_val,
+            meta_test=meta_test,
+            meta_split=meta_split,
+            transform=transform,
+            class_augmentations=class_augmentations,
+        )
+        super(SyntheticSpikes, self).__init__(
+            dataset,
+            num_classes_per_task,
+            target_transform=target_transform,
+            dataset_transform=dataset_transform,
+        )
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+
+import torch
+
+
+class _LayerStats(object):
+    """Running sums of one layer, kept on the device of its outputs"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.neuron_spikes = None
+        self.sums = None
+        self.grad_sums = None
+
+    def update(self, s, u, time_dim=None):
+        s = s.detach()
+        u = u.detach()
+        if time_dim is not None:
+            # [batch, neurons..., time] -> per-neuron counts over batch and time
+            neuron_spikes = s.sum(dim=(0, time_dim))
+        else:
+            neuron_spikes = s.sum(dim=0)
+        sums = torch.stack(
+            [
+                s.sum(),
+                torch.tensor(float(s.numel()), device=s.device),
+                u.sum(),
+                (u * u).sum(),
+                u.max(),
+            ]
+        ).float()
+        if self.sums is None:
+            self.neuron_spikes = neuron_spikes.float()
+            self.sums = sums
+        else:
+            self.neuron_spikes += neuron_spikes
+            self.sums[:4] += sums[:4]
+            self.sums[4] = torch.maximum(self.sums[4], sums[4])
+
+    def update_grad(self, grad):
+        grad = grad.detach()
+        sums = torch.stack(
+            [
+                grad.abs().sum(),
+                (grad != 0).sum().float(),
+                torch.tensor(float(grad.numel()), device=grad.device),
+            ]
+        ).float()
+        self.grad_sums = sums if self.grad_sums is None else self.grad_sums + sums
+
+    def values(self):
+        """Scalar statistics, as tensors on the device"""
+        spikes, count, u_sum, u_sq, u_max = self.sums
+        u_mean = u_sum / count
+        values = OrderedDict(
+            [
+                ("spike_rate", spikes / count),
+                ("dead_fraction", (self.neuron_spikes == 0).float().mean()),
+                ("u_mean", u_mean),
+                ("u_std", (u_sq / count - u_mean * u_mean).clamp(min=0).sqrt()),
+                ("u_max", u_max),
+            ]
+        )
+        if self.grad_sums is not None:
+            g_abs, g_nonzero, g_count = self.grad_sums
+            values["grad_abs_mean"] = g_abs / g_count
+            values["grad_active_fraction"] = g_nonzero / g_count
+        return values
+
+
+class SpikeTelemetry(object):
+    """Per-layer spiking statistics of a `MetaLenetDECOLLE` or a `MetaLavaNet`,
+    accumulated on the device over all the timesteps of all the forward
+    passes until `report`.
+
+    For every spiking layer (`LIF_layers.<i>` or `blocks.<i>`), `report`
+    returns the spike rate, the fraction of dead neurons (that did not spike
+    at all since the last report), the mean, standard deviation and maximum of
+    the membrane potential and, when `gradients` is set, the mean magnitude of
+    the (surrogate) gradients of the loss with respect to the membrane
+    potential and the fraction of them that are non-zero. Gradients are
+    accumulated over every backward pass, including those of the inner loop.
+
+    The statistics of all the layers are transferred with a single
+    synchronization per `report`, e.g. once per batch.
+
+    Parameters
+    ----------
+    model : `MetaLenetDECOLLE` or `MetaLavaNet` instance
+        The network, observed with forward hooks on its layers.
+
+    gradients : bool (default: True)
+        Also record the gradients with respect to the membrane potentials.
+    """
+
+    def __init__(self, model, gradients=True):
+        self.gradients = gradients
+        self.stats = OrderedDict()
+        self.handles = []
+        if hasattr(model, "LIF_layers"):
+            # One call per timestep, outputs (S, U) of shape [batch] + layer shape
+            layers = [("LIF_layers.{0}".format(i), l) for i, l in enumerate(model.LIF_layers)]
+            time_dim = None
+        elif hasattr(model, "blocks"):
+            # One call per sequence, outputs (spike, voltage) with time last
+            layers = [
+                ("blocks.{0}".format(i), b)
+                for i, b in enumerate(model.blocks)
+                if hasattr(b, "neuron")
+            ]
+            time_dim = -1
+        else:
+            raise ValueError("No spiking layers found in {0}.".format(type(model).__name__))
+
+        for name, layer in layers:
+            self.stats[name] = _LayerStats()
+            self.handles.append(layer.register_forward_hook(self._hook(name, time_dim)))
+
+    def _hook(self, name, time_dim):
+        stats = self.stats[name]
+
+        def hook(module, inputs, output):
+            if not isinstance(output, tuple) or len(output) < 2:
+                return
+            s, u = output[0], output[1]
+            stats.update(s, u, time_dim=time_dim)
+            if self.gradients and u.requires_grad:
+                u.register_hook(stats.update_grad)
+
+        return hook
+
+    def report(self, reset=True):
+        """Statistics since the last report, `{"<layer>/<statistic>": float}`"""
+        names, tensors = [], []
+        for layer, stats in self.stats.items():
+            if stats.sums is None:
+                continue
+            for key, value in stats.values().items():
+                names.append("{0}/{1}".format(layer, key))
+                tensors.append(value.float())
+        values = torch.stack(tensors).tolist() if tensors else []
+        if reset:
+            self.reset()
+        return OrderedDict(zip(names, values))
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats.reset()
+
+    def remove(self):
+        """Remove the hooks from the model"""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
@@ -0,0 +1,417 @@
+import os
+import pickle
+import warnings
+
+import numpy as np
+import torch
+import torch.utils.data
+from torchvision import transforms as trn
+
+from .utils import time_one_hot
+
+
+def _frame_dtype(frames):
+    """Smallest dtype that stores `frames` without loss"""
+    if frames.size > 0 and frames.min() >= 0 and np.array_equal(frames, np.floor(frames)):
+        if frames.max() <= np.iinfo(np.uint8).max:
+            return np.uint8
+        if frames.max() <= np.iinfo(np.uint16).max:
+            return np.uint16
+    return np.float32
+
+
+def _pack(data):
+    """Dense float frames stored with the smallest lossless dtype, see `_unpack`"""
+    if isinstance(data, torch.Tensor) and data.layout == torch.strided and data.is_floating_point():
+        frames = data.numpy()
+        return "tensor", data.dtype, frames.astype(_frame_dtype(frames))
+    if isinstance(data, np.ndarray) and data.dtype.kind == "f":
+        return "array", data.dtype, data.astype(_frame_dtype(data))
+    return None, None, data
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a private file then rename, so that concurrent workers never
+    # read a partially written entry
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _unpack(kind, dtype, data):
+    if kind == "tensor":
+        return torch.from_numpy(data).to(dtype)
+    if kind == "array":
+        return data.astype(dtype)
+    return data
+
+
+class ClassDatasetWrapper(object):
+    """Base class of the wrappers of a torchmeta `ClassDataset` that change how
+    the samples of each class are loaded.
+
+    Subclasses override `load(c, j)`, sample `j` of class `c` as returned by
+    the wrapped dataset. Per-class datasets are built once per process and only
+    when `load` or `size` need them. Task-level target transforms (see
+    `ConcatTask`) are applied on top of `load`, so wrappers always see the
+    targets of the class dataset. Wrappers can be nested.
+
+    Parameters
+    ----------
+    class_dataset : `torchmeta.utils.data.ClassDataset` instance
+        The dataset of classes, e.g. `DoubleNMNIST(...).dataset`.
+    """
+
+    def __init__(self, class_dataset):
+        self.class_dataset = class_dataset
+        self._datasets = {}
+        self._sizes = {}
+
+    def __getattr__(self, name):
+        # `num_classes`, `labels`, `meta_split`... of the wrapped dataset
+        if "class_dataset" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.class_dataset, name)
+
+    def __len__(self):
+        return len(self.class_dataset)
+
+    def get(self, c):
+        """Dataset of class `c`"""
+        if c not in self._datasets:
+            self._datasets[c] = self.class_dataset[c]
+        return self._datasets[c]
+
+    def size(self, c):
+        """Number of samples of class `c`"""
+        if c not in self._sizes:
+            self._sizes[c] = len(self.get(c))
+        return self._sizes[c]
+
+    def load(self, c, j):
+        return self.get(c)[j]
+
+    def __getitem__(self, c):
+        return _WrappedClass(self, c)
+
+    def __getstate__(self):
+        # Per-class datasets may hold open file handles, rebuild them in workers
+        state = self.__dict__.copy()
+        state["_datasets"] = {}
+        return state
+
+
+class _WrappedClass(torch.utils.data.Dataset):
+    """Samples of class `index` of a `ClassDatasetWrapper`"""
+
+    def __init__(self, wrapper, index):
+        self.wrapper = wrapper
+        self.index = index
+        self.target_transform = None
+
+    def target_transform_append(self, transform):
+        if transform is None:
+            return
+        if self.target_transform is None:
+            self.target_transform = transform
+        else:
+            self.target_transform = trn.Compose([self.target_transform, transform])
+
+    def __len__(self):
+        return self.wrapper.size(self.index)
+
+    def __getitem__(self, j):
+        data, target = self.wrapper.load(self.index, j)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return data, target
+
+
+class TransformedClassDataset(ClassDatasetWrapper):
+    """Applies `transform` to the inputs of a `ClassDataset` as a whole, e.g.
+    `ToSparse` after the two digits of a `DoubleNMNIST` sample are joined,
+    which per-sample transforms run before."""
+
+    def __init__(self, class_dataset, transform):
+        super(TransformedClassDataset, self).__init__(class_dataset)
+        self.transform = transform
+
+    def load(self, c, j):
+        data, target = self.get(c)[j]
+        return self.transform(data), target
+
+
+class EventPairsClassDataset(ClassDatasetWrapper):
+    """Joins the two samples of each input of a double dataset (`DoubleNMNIST`,
+    `DoubleDVSSign`) as raw events, to be binned on the device by
+    `EventsToFrames`.
+
+    Double datasets stack the frames of the left sample and of the right one
+    along `x`. Here the `x` of the events of the right sample are shifted by
+    `offset` instead, all events are shifted by `shift` in `(x, y)` and
+    `transform`, usually `ToEventTensor`, is applied to the joined events. The
+    per-sample transform of the wrapped dataset must return raw event arrays,
+    e.g. `CropDims` alone.
+    """
+
+    def __init__(self, class_dataset, offset, transform, shift=(0, 0)):
+        super(EventPairsClassDataset, self).__init__(class_dataset)
+        self.offset = offset
+        self.transform = transform
+        self.shift = shift
+
+    def load(self, c, j):
+        dataset = self.get(c)
+        # Same pairing as `DoubleNMNISTClassDataset.__getitem__`
+        keys_by_label = dataset.data_orig.keys_by_label
+        key_l = keys_by_label[dataset.labels_left][j // dataset.nl]
+        key_r = keys_by_label[dataset.labels_right][j % dataset.nl]
+        left = np.asarray(dataset.data_orig[key_l][0], dtype=np.int64)
+        right = np.array(dataset.data_orig[key_r][0], dtype=np.int64)
+        right[:, 2] += self.offset
+        events = np.concatenate([left, right])
+        events = events[np.argsort(events[:, 0], kind="stable")]
+        events[:, 2:4] += self.shift
+        return self.transform(events), dataset.target_transform(dataset.label_u)
+
+
+class CachedClassDataset(ClassDatasetWrapper):
+    """Persistent on-disk cache of the samples of a torchmeta `ClassDataset`.
+
+    Sample `j` of class `c` is written to `<folder>/<c>/<j>.pkl` the first time
+    it is loaded. Later accesses, in any epoch or data-loader worker, read that
+    file instead, without building the dataset of class `c`, so the HDF5 file
+    and the event-to-frame transforms are not touched at all. Count frames are
+    stored as `uint8`/`uint16` whenever the counts allow it and restored to
+    their original type and dtype, so hits and misses return the same samples.
+
+    Only use it with deterministic transforms, e.g. `Compose([CropDims,
+    Downsample, ToCountFrame, ToTensor])`.
+
+    Parameters
+    ----------
+    class_dataset : `torchmeta.utils.data.ClassDataset` instance
+        The dataset of classes, e.g. `DoubleNMNIST(...).dataset`.
+
+    folder : str
+        Folder of the entries. It must identify the dataset, its split and its
+        transforms, see `cache_key`, so that changing any of them never serves
+        stale samples.
+    """
+
+    def __init__(self, class_dataset, folder):
+        super(CachedClassDataset, self).__init__(class_dataset)
+        self.folder = folder
+
+    def size(self, c):
+        """Number of samples of class `c`, also cached on disk"""
+        if c not in self._sizes:
+            path = os.path.join(self.folder, str(c), "size")
+            try:
+                with open(path) as f:
+                    self._sizes[c] = int(f.read())
+                os.utime(path)
+            except (OSError, ValueError):
+                self._sizes[c] = len(self.get(c))
+                _write(path, str(self._sizes[c]).encode())
+        return self._sizes[c]
+
+    def load(self, c, j):
+        path = os.path.join(self.folder, str(c), "{0}.pkl".format(j))
+        try:
+            with open(path, "rb") as f:
+                kind, dtype, data, target = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, pickle.UnpicklingError):
+            warnings.warn("Ignoring the unreadable cache entry {0}.".format(path))
+        else:
+            try:
+                # Recently used entries are evicted last, see `prune_cache`
+                os.utime(path)
+            except OSError:
+                pass
+            return _unpack(kind, dtype, data), target
+
+        data, target = self.get(c)[j]
+        _write(path, pickle.dumps(_pack(data) + (target,), protocol=pickle.HIGHEST_PROTOCOL))
+        return data, target
+
+
+def prune_cache(cache_dir, max_size):
+    """Deletes the least recently used files of `cache_dir` until it holds at
+    most `max_size` bytes"""
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def cache_key(name, chunk_size, dt, ds):
+    """Folder name of the sample cache of a benchmark configuration"""
+    ds = "x".join(str(d) for d in ds) if isinstance(ds, (list, tuple)) else ds
+    return "{0}_T{1}_dt{2}_ds{3}".format(name, chunk_size, dt, ds)
+
+
+class ToSparse(object):
+    """Convert a dense frame tensor to a sparse COO tensor.
+
+    Count frames of event cameras are overwhelmingly zero, so the sparse
+    layout cuts host memory, pinned memory and host-to-device traffic. Batches
+    of sparse samples must be collated with `SparseBatchMetaDataLoader` and are
+    densified on the device by `tensors_to_device`.
+    """
+
+    def __call__(self, frames):
+        if not isinstance(frames, torch.Tensor):
+            frames = torch.from_numpy(np.asarray(frames, dtype=np.float32))
+        return frames.to_sparse().coalesce()
+
+    def __repr__(self):
+        return self.__class__.__name__ + "()"
+
+
+class RepeatOneHot(object):
+    """Target transform replacing `Compose([Repeat(chunk_size),
+    toOneHot(num_classes)])`: the label as a `[chunk_size, num_classes]` one-hot
+    sequence, built without going through numpy"""
+
+    def __init__(self, chunk_size, num_classes):
+        self.chunk_size = chunk_size
+        self.num_classes = num_classes
+
+    def __call__(self, target):
+        target = torch.as_tensor(target).squeeze()
+        return time_one_hot(target, self.num_classes, self.chunk_size).contiguous()
+
+    def __repr__(self):
+        return "{0}(chunk_size={1}, num_classes={2})".format(
+            self.__class__.__name__, self.chunk_size, self.num_classes
+        )
+
+
+class ToEventTensor(object):
+    """Convert a raw `(t, p, x, y)` event array to a fixed-size `int32` tensor
+    of shape `[max_events, 4]`, so that event lists can be batched and binned
+    into frames on the device with `EventsToFrames`.
+
+    Events later than `window` (in the raw time unit) after the first event are
+    dropped, then the list is truncated or padded to `max_events` rows. Padding
+    rows have `t = -1`. Truncation drops the last events of the window and is
+    reported with a warning; raise `max_events` (`--max-events`) if it occurs.
+    """
+
+    def __init__(self, max_events, window=None):
+        self.max_events = max_events
+        self.window = window
+
+    def __call__(self, events):
+        events = np.asarray(events)
+        if self.window is not None and len(events) > 0:
+            events = events[events[:, 0] - events[0, 0] < self.window]
+        if len(events) > self.max_events:
+            warnings.warn(
+                "{0} events in the window, only the first max_events={1} are kept".format(
+                    len(events), self.max_events
+                )
+            )
+            events = events[: self.max_events]
+        out = np.full((self.max_events, 4), -1, dtype=np.int32)
+        out[: len(events)] = events[:, :4]
+        return torch.from_numpy(out)
+
+    def __repr__(self):
+        return "{0}(max_events={1}, window={2})".format(
+            self.__class__.__name__, self.max_events, self.window
+        )
+
+
+class EventsToFrames(object):
+    """Bin batched event lists into count frames with a scatter-add, on the
+    device the events live on.
+
+    Equivalent to `Downsample(factor=[dt, 1, ds, ds])` followed by
+    `ToCountFrame(T=chunk_size, size=size)`, but for a whole meta-batch at once.
+    `chunk_size` and `dt` can be changed between calls.
+
+    Parameters
+    ----------
+    chunk_size : int
+        Number of time bins `T`.
+
+    dt : int
+        Width of a time bin, in the raw time unit of the events.
+
+    ds : int or tuple
+        Spatial downsampling factor of `x` and `y`.
+
+    size : list
+        `[polarities, width, height]` of the frames, after downsampling.
+
+    Inputs have shape `[..., max_events, 4]` (see `ToEventTensor`), outputs
+    have shape `[..., chunk_size] + size`. `offset` and `length` select the
+    bins `offset` to `offset + length` of the recording instead; `chunks`
+    iterates over windows of the `chunk_size` bins, so that the whole frame
+    sequence is never in memory.
+    """
+
+    def __init__(self, chunk_size, dt, ds, size):
+        self.chunk_size = chunk_size
+        self.dt = dt
+        self.ds = tuple(ds) if isinstance(ds, (list, tuple)) else (ds, ds)
+        self.size = list(size)
+
+    def __call__(self, events, offset=0, length=None):
+        length = self.chunk_size if length is None else length
+        lead_shape, num_events = events.shape[:-2], events.shape[-2]
+        events = events.reshape(-1, num_events, 4).long()
+        num_samples = events.shape[0]
+        num_pol, width, height = self.size
+
+        t, p, x, y = events.unbind(-1)
+        t_bin = t // self.dt - (t[:, :1] // self.dt) - offset
+        x, y = x // self.ds[0], y // self.ds[1]
+        valid = (
+            (t >= 0)
+            & (t_bin >= 0)
+            & (t_bin < length)
+            & (p >= 0)
+            & (p < num_pol)
+            & (x < width)
+            & (y < height)
+        )
+
+        sample = torch.arange(num_samples, device=events.device).unsqueeze(1)
+        index = (((sample * length + t_bin) * num_pol + p) * width + x) * height + y
+        index = index[valid]
+
+        frames = torch.zeros(num_samples * length * num_pol * width * height, device=events.device)
+        frames.index_add_(0, index, torch.ones(index.shape, device=events.device))
+        return frames.view(*lead_shape, length, num_pol, width, height)
+
+    def chunks(self, events, chunk_length):
+        """Yield the frames of the `chunk_size` bins in successive windows of
+        `chunk_length` bins (the last one may be shorter)"""
+        for offset in range(0, self.chunk_size, chunk_length):
+            yield self(events, offset=offset, length=min(chunk_length, self.chunk_size - offset))
+
+    def __repr__(self):
+        return "{0}(chunk_size={1}, dt={2}, ds={3}, size={4})".format(
+            self.__class__.__name__, self.chunk_size, self.dt, self.ds, self.size
+        )
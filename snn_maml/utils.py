@@ -1,3 +1,5 @@
+import os
+import copy
 import typing
 import torch
 import numpy as np
@@ -5,6 +7,21 @@ import numpy as np
 from collections import OrderedDict
 
 
+_params_cache = {}
+
+
+def load_params(params_file):
+    """Parse a YAML parameter file. Files are parsed once per process (until
+    modified) and a copy is returned, so callers may modify it"""
+    key = (os.path.realpath(params_file), os.stat(params_file).st_mtime_ns)
+    if key not in _params_cache:
+        import yaml
+
+        with open(params_file, "r") as f:
+            _params_cache[key] = yaml.safe_load(f)
+    return copy.deepcopy(_params_cache[key])
+
+
 def compute_accuracy(logits, targets, first_spike_fn=None):
     """Compute the accuracy"""
 
@@ -20,6 +37,15 @@ def compute_accuracy(logits, targets, first_spike_fn=None):
     return accuracy.item()
 
 
+def confidence_interval(values, z=1.96):
+    """Half-width of the (default: 95%) normal confidence interval of the
+    mean of `values`"""
+    values = np.asarray(values, dtype=np.float64)
+    if values.size < 2:
+        return float("nan")
+    return float(z * values.std(ddof=1) / np.sqrt(values.size))
+
+
 def compute_accuracy_lava(logits, targets):
     """Compute the accuracy of lava spike train using rate coding"""
     # Assuming that the spike train in its entirety is given
@@ -63,20 +89,57 @@ def to_numpy(x):
             return x.cpu().data.numpy()
 
 
-def tensors_to_device(tensors, device=torch.device("cpu")):
-    """Place a collection of tensors in a specific device"""
+def tensors_to_device(tensors, device=torch.device("cpu"), densify=True):
+    """Place a collection of tensors in a specific device. Sparse tensors are
+    transferred as is and, if `densify`, converted to dense on the device"""
     if isinstance(tensors, torch.Tensor):
-        return tensors.to(device=device)
+        tensors = tensors.to(device=device)
+        if densify and tensors.is_sparse:
+            tensors = tensors.to_dense()
+        return tensors
     elif isinstance(tensors, (list, tuple)):
-        return type(tensors)(tensors_to_device(tensor, device=device) for tensor in tensors)
+        return type(tensors)(
+            tensors_to_device(tensor, device=device, densify=densify) for tensor in tensors
+        )
     elif isinstance(tensors, (dict, OrderedDict)):
         return type(tensors)(
-            [(name, tensors_to_device(tensor, device=device)) for (name, tensor) in tensors.items()]
+            [
+                (name, tensors_to_device(tensor, device=device, densify=densify))
+                for (name, tensor) in tensors.items()
+            ]
         )
     else:
         raise NotImplementedError()
 
 
+def time_chunks(inputs, chunk_size, dim=1):
+    """Yield successive slices of `inputs` of length `chunk_size` along `dim`.
+    The last one may be shorter."""
+    length = inputs.size(dim)
+    for start in range(0, length, chunk_size):
+        yield inputs.narrow(dim, start, min(chunk_size, length - start))
+
+
+def batch_one_hot(targets, num_classes=10, dtype=torch.float32):
+    """One-hot encoding of integer `targets` of any shape, `[..., num_classes]`,
+    on the device of `targets`"""
+    return torch.nn.functional.one_hot(targets.long(), num_classes).to(dtype)
+
+
+def undo_onehot(targets):
+    """Class indices of one-hot `targets`, over the last dimension"""
+    return targets.argmax(dim=-1)
+
+
+def time_one_hot(targets, num_classes, chunk_size, dtype=torch.float32):
+    """One-hot `targets` repeated over `chunk_size` timesteps, `[..., chunk_size,
+    num_classes]`, for per-timestep losses. Same values as the torchneuromorphic
+    target transform `Compose([Repeat(chunk_size), toOneHot(num_classes)])`.
+    The result is an expanded view."""
+    one_hot = batch_one_hot(targets, num_classes, dtype=dtype).unsqueeze(-2)
+    return one_hot.expand(*one_hot.shape[:-2], chunk_size, num_classes)
+
+
 class ToTensor1D(object):
     """Convert a `numpy.ndarray` to tensor. Unlike `ToTensor` from torchvision,
     this converts numpy arrays regardless of the number of dimensions.
@@ -210,7 +273,105 @@ def matrix_evaluator(inner_loss, params, regu_coef=1.0, lamda=0.0, lam_damping=1
     return evaluator
 
 
-def create_fixed_quantizers():
+class _FixedPointFunction(torch.autograd.Function):
+    """Fake quantization with a straight-through gradient, zeroed where clamped"""
+
+    @staticmethod
+    def forward(ctx, input, quantizer):
+        output, in_range = quantizer.quantize(input)
+        ctx.clamping_grad_zero = quantizer.clamping_grad_zero
+        if quantizer.clamping_grad_zero:
+            ctx.save_for_backward(in_range)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if ctx.clamping_grad_zero:
+            (in_range,) = ctx.saved_tensors
+            grad_output = grad_output * in_range
+        return grad_output, None
+
+
+class FixedPointQuantizer(object):
+    """Fixed-point fake quantizer, same numbers as `qtorch.FixedPoint(wl, fl,
+    clamp=True, symmetric)` with `clamping_grad_zero=True`, in plain torch.
+
+    Values are rounded to multiples of `2 ** -fl` (`"nearest"`, or
+    `"stochastic"` rounding) and clamped to the range of a signed `wl`-bit
+    word. The gradient is passed straight through, and zeroed where values are
+    clamped. `quantize_all` quantizes a list of tensors in one call.
+    """
+
+    def __init__(self, wl, fl, rounding="nearest", symmetric=False, clamping_grad_zero=True):
+        if rounding not in ("nearest", "stochastic"):
+            raise ValueError("Unknown rounding `{0}`.".format(rounding))
+        self.wl = wl
+        self.fl = fl
+        self.rounding = rounding
+        self.symmetric = symmetric
+        self.clamping_grad_zero = clamping_grad_zero
+        self.scale = 2.0**fl
+        self.t_max = 2.0 ** (wl - fl - 1) - 2.0**-fl
+        self.t_min = -self.t_max if symmetric else -(2.0 ** (wl - fl - 1))
+
+    def quantize(self, input):
+        """Quantized `input` and mask of the values within range (no gradient)"""
+        with torch.no_grad():
+            scaled = input * self.scale
+            if self.rounding == "nearest":
+                scaled = torch.floor(scaled + 0.5)
+            else:
+                scaled = torch.floor(scaled + torch.rand_like(scaled))
+            output = scaled / self.scale
+            in_range = (output >= self.t_min) & (output <= self.t_max)
+            return output.clamp_(self.t_min, self.t_max), in_range.to(input.dtype)
+
+    def __call__(self, input):
+        return _FixedPointFunction.apply(input, self)
+
+    def quantize_all(self, tensors):
+        """Quantize all `tensors` in one call per device and dtype"""
+        groups = OrderedDict()
+        for i, t in enumerate(tensors):
+            groups.setdefault((t.device, t.dtype), []).append(i)
+        out = [None] * len(tensors)
+        for idx in groups.values():
+            flat = self(torch.cat([tensors[i].reshape(-1) for i in idx]))
+            chunks = flat.split([tensors[i].numel() for i in idx])
+            for i, chunk in zip(idx, chunks):
+                out[i] = chunk.view_as(tensors[i])
+        return out
+
+    def __repr__(self):
+        return "{0}(wl={1}, fl={2}, rounding={3!r}, symmetric={4})".format(
+            self.__class__.__name__, self.wl, self.fl, self.rounding, self.symmetric
+        )
+
+
+# Word length, fraction length and symmetry of the fixed-point formats
+FIXED_POINT_FORMATS = {
+    "16": (16, 15, False),
+    "8": (8, 7, False),
+    "4": (4, 3, True),
+    "3": (3, 1, True),
+    "2": (2, 1, True),
+}
+
+
+def create_fixed_quantizers(backend="native"):
+    """Fixed-point quantizers by name: `"16"`, `"8"`, `"4"`, `"3"` and `"2"`
+    bits with nearest rounding, and with stochastic rounding (`"16s"`, ...).
+    `backend="qtorch"` builds the equivalent qtorch quantizers."""
+    if backend == "qtorch":
+        return create_qtorch_quantizers()
+    fixed_quantizers = {}
+    for name, (wl, fl, symmetric) in FIXED_POINT_FORMATS.items():
+        fixed_quantizers[name] = FixedPointQuantizer(wl, fl, "nearest", symmetric)
+        fixed_quantizers[name + "s"] = FixedPointQuantizer(wl, fl, "stochastic", symmetric)
+    return fixed_quantizers
+
+
+def create_qtorch_quantizers():
     import qtorch
     from qtorch import FixedPoint
     from qtorch.quant import quantizer
@@ -288,6 +449,11 @@ def create_fixed_quantizers():
 
 
 def quantize_parameters(params: OrderedDict, quantizer: typing.Callable):
+    if isinstance(quantizer, FixedPointQuantizer):
+        names = list(params.keys())
+        for name, param in zip(names, quantizer.quantize_all([params[n] for n in names])):
+            params[name] = param
+        return params
     for name, param in params.items():
         params[name] = quantizer(param)
     return params
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+
+from snn_maml.sweep import (
+    DEFAULT_OPTIONS,
+    config_id,
+    grid,
+    hyperband,
+    sample,
+    successive_halving,
+    sweep,
+)
+
+parser = argparse.ArgumentParser("Hyperparameter sweep")
+
+parser.add_argument(
+    "--output-folder",
+    type=str,
+    default="logs/sweep",
+    help="Folder of the results store (results.jsonl) and of the generated parameter files. "
+    "Configurations already in the store are skipped (default: logs/sweep).",
+)
+parser.add_argument(
+    "--space",
+    type=str,
+    default='{"meta_lr": [0.001, 0.002, 0.005], "step_size": [0.5, 1.0]}',
+    help="Search space, as JSON or a JSON file: {name: [values]} or {name: {low, high, log}}. "
+    "meta_lr, step_size, num_steps, first_order, batch_size and params_file are training "
+    "options, other names override the parameter file (e.g. act_rate, burnin_steps, "
+    "current_decay, voltage_decay, neuron_model.tau_grad).",
+)
+parser.add_argument(
+    "--num-samples",
+    type=int,
+    default=None,
+    help="Number of random configurations (default: None, the whole grid).",
+)
+parser.add_argument(
+    "--num-processes",
+    type=int,
+    default=None,
+    help="Number of worker processes (default: as many as the cores allow).",
+)
+parser.add_argument(
+    "--threads-per-process",
+    type=int,
+    default=1,
+    help="Number of torch threads of each worker process (default: 1).",
+)
+parser.add_argument(
+    "--devices",
+    type=str,
+    default="cpu",
+    help='Comma-separated devices assigned to the workers in turn, e.g. "cuda:0,cuda:1" '
+    "(default: cpu).",
+)
+parser.add_argument(
+    "--schedule",
+    type=str,
+    default="full",
+    choices=["full", "halving", "hyperband"],
+    help="full: train every configuration for num-epochs x num-batches batches. halving: "
+    "successive halving, train all for min-batches, keep the best 1/eta, train them eta times "
+    "longer, and so on. hyperband: successive halving brackets over random configurations "
+    "of the space, from many with min-batches to a few with the full budget (default: full).",
+)
+parser.add_argument(
+    "--min-batches",
+    type=int,
+    default=10,
+    help="Training batches of the first rung of successive halving (default: 10).",
+)
+parser.add_argument(
+    "--eta",
+    type=int,
+    default=3,
+    help="Successive halving keeps the best 1/eta configurations at each rung (default: 3).",
+)
+
+# Options of each run, as in train.py
+for name, default in DEFAULT_OPTIONS.items():
+    flag = "--" + (name if name == "params_file" else name.replace("_", "-"))
+    if isinstance(default, bool):
+        parser.add_argument(flag, action="store_true")
+    else:
+        parser.add_argument(flag, type=type(default) if default is not None else str, default=default)
+
+args = parser.parse_args()
+
+if os.path.exists(args.space):
+    with open(args.space) as f:
+        space = json.load(f)
+else:
+    space = json.loads(args.space)
+
+options = {name: getattr(args, name) for name in DEFAULT_OPTIONS}
+parallel = dict(
+    num_workers=args.num_processes,
+    threads_per_worker=args.threads_per_process,
+    devices=args.devices.split(","),
+)
+
+if args.schedule == "hyperband":
+    best = hyperband(
+        space,
+        options,
+        args.output_folder,
+        min_batches=args.min_batches,
+        eta=args.eta,
+        seed=args.seed,
+        **parallel,
+    )
+    print("Best configuration:", best)
+else:
+    if args.num_samples is None:
+        configs = grid(space)
+    else:
+        configs = sample(space, args.num_samples, seed=args.seed)
+    print("Evaluating {0} configurations".format(len(configs)))
+
+    if args.schedule == "halving":
+        ranked = successive_halving(
+            configs,
+            options,
+            args.output_folder,
+            min_batches=args.min_batches,
+            eta=args.eta,
+            **parallel,
+        )
+        print("Best configuration:", ranked[0] if ranked else None)
+    else:
+        store = sweep(configs, options, args.output_folder, **parallel)
+        ids = {config_id(c, options) for c in configs}
+        print("Best configuration:", store.best(ids=ids))
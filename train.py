@@ -1,6 +1,9 @@
 import torch
 import math
 import os
+import random
+import signal
+import sys
 import time
 import json
 import logging
@@ -13,6 +16,16 @@ from torchmeta.utils.data import BatchMetaDataLoader
 from snn_maml.utils import tensors_to_device, compute_accuracy
 
 from snn_maml.benchmarks import get_benchmark_by_name
+from snn_maml.sampling import MetaBatchIndexSampler
+from snn_maml.checkpoint import (
+    CheckpointManager,
+    load_checkpoint,
+    restore_step_size,
+    resume_iterator,
+    rng_state,
+    seed_everything,
+    set_rng_state,
+)
 import snn_maml.utils as utils
 
 import argparse
@@ -57,7 +70,10 @@ parser.add_argument(
     help="Number of test example per class. If negative, same as the number of training examples `--num-shots` (default: 15).",
 )
 parser.add_argument(
-    "--warm-start", type=str, default="", help="model file to load for warm start"
+    "--warm-start",
+    type=str,
+    default="",
+    help="Checkpoint to load for warm start, or the folder of a run (best.th or model.th)",
 )
 parser.add_argument("--boil", action="store_true", help="body only in inner loop")
 parser.add_argument("--quantize", type=str, default=None, help="quantize weights")
@@ -84,7 +100,21 @@ parser.add_argument(
     "--load-model",
     type=str,
     default="",
-    help='Path to the model file to load (default: "")',
+    help="Checkpoint to load, best.th or last-<step>.th of a run, or an older model.th "
+    '(default: "")',
+)
+parser.add_argument(
+    "--resume",
+    type=str,
+    default=None,
+    help="Checkpoint (last-<step>.th) to resume the interrupted run from, at the same epoch and "
+    "batch, with the same data order and random state (default None).",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=None,
+    help="Seed of the run; each epoch is seeded with seed + epoch (default None, random).",
 )
 
 # Optimization
@@ -202,11 +232,159 @@ parser.add_argument(
     help="Which gpu to use if multiple available (default 0).",
 )
 parser.add_argument("--no-log", action="store_true")
+parser.add_argument(
+    "--frame-cache",
+    type=str,
+    default=None,
+    help="Folder of the persistent count-frame cache for spiking benchmarks (default None, no cache).",
+)
+parser.add_argument(
+    "--frame-cache-size",
+    type=float,
+    default=20,
+    help="Size limit of the count-frame cache in GiB, least recently used samples are evicted first (default 20).",
+)
+parser.add_argument(
+    "--sparse-frames",
+    action="store_true",
+    help="Load count frames as sparse tensors, densified on the device.",
+)
+parser.add_argument(
+    "--device-binning",
+    action="store_true",
+    help="Load raw events and bin them into count frames on the device.",
+)
+parser.add_argument(
+    "--max-events",
+    type=int,
+    default=16384,
+    help="With --device-binning, events kept per sample and binning window; samples with "
+    "more are truncated, with a warning (default 16384).",
+)
+parser.add_argument(
+    "--fast-sampler",
+    action="store_true",
+    help="Sample whole meta-batches at once from a precomputed per-class index.",
+)
+parser.add_argument(
+    "--shared-store",
+    type=str,
+    nargs="?",
+    const="",
+    default=None,
+    help="Read HDF5 datasets once into a memory-mapped store shared by all workers, "
+    "optionally in the given folder (default ~/.cache/snn_maml/h5store).",
+)
+parser.add_argument(
+    "--stream-chunk-size",
+    type=int,
+    default=None,
+    help="Feed the model its inputs in time chunks of this length, carrying the LIF state "
+    "across chunks (default None, whole sequences). With --device-binning, events are binned "
+    "chunk by chunk and the frames of whole sequences are never in memory.",
+)
+parser.add_argument(
+    "--tbptt",
+    action="store_true",
+    help="Truncate backpropagation through time at streamed chunk boundaries.",
+)
+parser.add_argument(
+    "--int-eval",
+    type=str,
+    default=None,
+    choices=["16", "8", "4", "3", "2"],
+    help="After testing, evaluate the model with integer fixed-point inference, with weights "
+    "in this format (default None).",
+)
+parser.add_argument(
+    "--keep-checkpoints",
+    type=int,
+    default=2,
+    help="Number of rotating last-<step>.th checkpoints kept, besides best.th (default 2).",
+)
+parser.add_argument(
+    "--checkpoint-every",
+    type=int,
+    default=None,
+    help="Also checkpoint every this many training batches (default None, once per epoch). "
+    "A checkpoint is always written on SIGTERM/SIGUSR1 before exiting.",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Time the phases of the meta-learning loop, print them every epoch and write "
+    "profile.json and a Chrome trace (profile_trace.json) to the output folder.",
+)
+parser.add_argument(
+    "--telemetry",
+    action="store_true",
+    help="Record per-layer spike rates, membrane statistics, dead neurons and surrogate "
+    "gradients, reported (and logged) after every training batch.",
+)
+parser.add_argument(
+    "--profile-cuda-events",
+    action="store_true",
+    help="Also record the GPU time of each phase with CUDA events (with --profile).",
+)
+parser.add_argument(
+    "--eval-pool",
+    action="store_true",
+    help="Sample num-batches-test validation (and test) batches once, keep them (see "
+    "--eval-pool-location) and evaluate every epoch on exactly these tasks.",
+)
+parser.add_argument(
+    "--eval-pool-location",
+    type=str,
+    default="device",
+    choices=["device", "host", "disk"],
+    help="Where the tasks of --eval-pool are kept: on the device (no transfers), in pinned "
+    "host memory, or on disk, memory-mapped from --eval-pool-dir (required). Batches kept "
+    "on the host or on disk are moved to the device one at a time.",
+)
+parser.add_argument(
+    "--eval-pool-dir",
+    type=str,
+    default=None,
+    help="Load the evaluation tasks of --eval-pool from this folder (val.th, test.th) if they "
+    "exist, otherwise save them there, so that runs are evaluated on the same tasks "
+    "(implies --eval-pool).",
+)
+parser.add_argument(
+    "--amp",
+    type=str,
+    default=None,
+    choices=["bf16", "fp16"],
+    help="Mixed precision: run the forward passes of the inner and outer loops under autocast, "
+    "with parameters, step sizes and LIF states in fp32. fp16 scales the gradients with a "
+    "dynamic loss scale (default None, fp32).",
+)
+parser.add_argument(
+    "--adaptation-cache-mb",
+    type=float,
+    default=None,
+    help="Cache the adapted parameters of the tasks of the evaluation pool (up to this many MB) "
+    "and reuse them while the model is unchanged, i.e. when only testing. Requires --eval-pool "
+    "or --eval-pool-dir (default None, no cache).",
+)
 
 
 # parser.add_argument('--deltaw', type=float, default=None, help='Force larger weight changes. The larger the value the larger the deltaw needs to be for params to update. (default None)')
 
 args = parser.parse_args()
+if args.eval_pool_location == "disk" and args.eval_pool_dir is None:
+    parser.error("--eval-pool-location=disk requires --eval-pool-dir.")
+if args.adaptation_cache_mb is not None and not (args.eval_pool or args.eval_pool_dir is not None):
+    parser.error("--adaptation-cache-mb requires --eval-pool or --eval-pool-dir.")
+
+resume = None
+if args.resume is not None:
+    resume = torch.load(args.resume, map_location="cpu")
+    if "run" not in resume:
+        raise ValueError("`{0}` has no run state to resume from.".format(args.resume))
+    args.seed = resume["run"]["seed"]
+if args.seed is None:
+    args.seed = random.SystemRandom().randrange(2**31)
+seed_everything(args.seed)
 
 
 if args.metalearner == "MAML":
@@ -257,9 +435,6 @@ if args.output_folder is not None:
     logging.debug("Creating folder `{0}`".format(output_folder))
 
     args.folder = os.path.abspath(args.folder)
-    args.model_path = os.path.abspath(os.path.join(output_folder, "model.th"))
-    args.opt_path = os.path.abspath(os.path.join(output_folder, "optim.th"))
-    args.stepsize_path = os.path.abspath(os.path.join(output_folder, "stepsize.th"))
     # Save the configuration in a config.json file
     json_file_path = os.path.join(output_folder, "config.json")
     with open(json_file_path, "w") as f:
@@ -287,35 +462,76 @@ benchmark = get_benchmark_by_name(
     params_file=args.params_file,
     device=device,
     non_spiking=args.nonspiking,
+    frame_cache=args.frame_cache,
+    frame_cache_size=args.frame_cache_size,
+    sparse_frames=args.sparse_frames,
+    device_binning=args.device_binning,
+    max_events=args.max_events,
+    shared_store=args.shared_store,
 )
 net = benchmark.model
 
-meta_train_dataloader = BatchMetaDataLoader(
-    benchmark.meta_train_dataset,
-    batch_size=args.batch_size,
-    shuffle=True,
-    num_workers=args.num_workers,
-    pin_memory=True,
-)
+if args.sparse_frames:
+    from snn_maml.dataloaders import SparseBatchMetaDataLoader as BatchMetaDataLoader
+if args.fast_sampler:
+    from snn_maml.dataloaders import TaskIndexDataLoader as BatchMetaDataLoader
 
-meta_val_dataloader = BatchMetaDataLoader(
-    benchmark.meta_val_dataset,
-    batch_size=args.batch_size,
-    shuffle=True,
-    num_workers=args.num_workers,
-    pin_memory=True,
-)
 
-if args.do_test:
-    meta_test_dataloader = BatchMetaDataLoader(
-        benchmark.meta_test_dataset,
+def meta_dataloader(meta_dataset):
+    # Tasks of the fast sampler are drawn from the seed of the run
+    kwargs = {"seed": args.seed} if args.fast_sampler else {}
+    return BatchMetaDataLoader(
+        meta_dataset,
         batch_size=args.batch_size,
         shuffle=True,
         num_workers=args.num_workers,
         pin_memory=True,
+        **kwargs,
     )
 
 
+# Only build the splits that are used, see `Benchmark`
+meta_train_dataloader = meta_dataloader(benchmark.meta_train_dataset) if args.do_train else None
+meta_val_dataloader = meta_dataloader(benchmark.meta_val_dataset)
+
+if args.do_test:
+    meta_test_dataloader = meta_dataloader(benchmark.meta_test_dataset)
+
+
+def eval_pool(dataloader, split):
+    """Fixed evaluation tasks of `split`, see `--eval-pool`"""
+    from snn_maml.dataloaders import TaskPool
+
+    on_disk = args.eval_pool_location == "disk"
+    path, pool = None, None
+    if args.eval_pool_dir is not None:
+        path = os.path.join(args.eval_pool_dir, split + ".th")
+        if os.path.exists(path):
+            logging.info("Loading the {0} tasks from `{1}`".format(split, path))
+            pool = TaskPool.load(path, mmap=on_disk)
+    if pool is None:
+        pool = TaskPool.sample(dataloader, args.num_batches_test, seed=args.seed)
+        if path is not None:
+            os.makedirs(args.eval_pool_dir, exist_ok=True)
+            pool.save(path)
+            if on_disk:
+                pool = TaskPool.load(path, mmap=True)
+    if args.eval_pool_location == "device":
+        return pool.to(device)
+    if args.eval_pool_location == "host":
+        return pool.pin_memory()
+    return pool
+
+
+# Evaluation tasks, a fixed pool or new tasks every epoch
+meta_val_tasks = meta_val_dataloader
+meta_test_tasks = meta_test_dataloader if args.do_test else None
+if args.eval_pool or args.eval_pool_dir is not None:
+    meta_val_tasks = eval_pool(meta_val_dataloader, "val")
+    if args.do_test:
+        meta_test_tasks = eval_pool(meta_test_dataloader, "test")
+
+
 if hasattr(benchmark.model, "get_trainable_parameters"):
     print(
         "Using get_trainable_parameters instead of parameters for optimization parameters"
@@ -352,6 +568,26 @@ else:
 
 print(benchmark.model)
 
+profiler = None
+if args.profile:
+    from snn_maml.profiler import PhaseProfiler
+
+    profiler = PhaseProfiler(
+        device=device, cuda_events=args.profile_cuda_events, trace=args.output_folder is not None
+    )
+
+telemetry = None
+if args.telemetry:
+    from snn_maml.telemetry import SpikeTelemetry
+
+    telemetry = SpikeTelemetry(benchmark.model)
+
+adaptation_cache = None
+if args.adaptation_cache_mb is not None:
+    from snn_maml.adaptation_cache import AdaptationCache
+
+    adaptation_cache = AdaptationCache(max_bytes=int(args.adaptation_cache_mb * 2**20))
+
 metalearner = metalearner_model(
     benchmark.model,
     meta_optimizer,
@@ -366,85 +602,207 @@ metalearner = metalearner_model(
     boil=args.boil,
     outer_loop_quantizer=quantizer_out,
     inner_loop_quantizer=quantizer_in,
+    input_transform=benchmark.input_transform,
+    stream_chunk_size=args.stream_chunk_size,
+    tbptt=args.tbptt,
+    profiler=profiler,
+    adaptation_cache=adaptation_cache,
+    amp=args.amp,
     **add_kwargs,
 )
 
 
 print("Using metalearner ", metalearner)
-best_value = None
-
-out = next(iter(meta_train_dataloader))
-out_c = tensors_to_device(out, device=device)
 
+checkpoints = None
+if args.output_folder is not None:
+    checkpoints = CheckpointManager(args.output_folder, keep_last=args.keep_checkpoints)
 
 if args.warm_start != "":
-    net.load_state_dict(torch.load(args.warm_start + "model.th"))
-    # try:
-    #    metalearner.optimizer.load_state_dict(torch.load(args.warm_start+'optim.th'))
-    # except:
-    #    warnings.warn('No optimization loading')
-    try:
-        step_size = torch.load(args.warm_start + "stepsize.th")
-        metalearner.step_size.data = step_size
-    except FileNotFoundError:
+    # A checkpoint file, or the folder of a run: best.th, or an older model.th
+    path = args.warm_start
+    if not os.path.isfile(path):
+        path = args.warm_start + "best.th"
+        if not os.path.exists(path):
+            path = args.warm_start + "model.th"
+    checkpoint = load_checkpoint(path, map_location=device)
+    net.load_state_dict(checkpoint["model"])
+    if "step_size" in checkpoint:
+        restore_step_size(metalearner, checkpoint["step_size"])
+    else:
         warnings.warn("No step size loading")
 
 elif hasattr(net, "LIF_layers"):
     if args.params_file is not None:
-        with open(args.params_file, "r") as f:
-            import yaml
-
-            params = yaml.load(f, Loader=yaml.FullLoader)
+        params = utils.load_params(args.params_file)
         if args.burnin != -1:
             params["burnin_steps"] = args.burnin
             net.burnin = params["burnin_steps"]
     else:
         raise Exception("Must provide params_file")
 
-    from decolle.init_functions import init_LSUV_actrate
+    from snn_maml.init_functions import init_LSUV_actrate
 
-    dd = out_c["train"][0].reshape(
-        -1, params["chunk_size_train"], *params["input_shape"]
-    )
-    if not args.nonspiking:
-        init_LSUV_actrate(
-            net, dd, params["act_rate"]
-        )  # 0.288 is hard coded from params['actrate']
+    # Loaded weights replace the LSUV initialization, skip it (and the
+    # meta-training batch it needs) in that case
+    if not args.nonspiking and not (args.load_model or args.resume):
+        dataloader = meta_train_dataloader
+        if dataloader is None:
+            dataloader = meta_dataloader(benchmark.meta_train_dataset)
+        out = next(iter(dataloader))
+        out_c = metalearner.transform_inputs(tensors_to_device(out, device=device))
+        dd = out_c["train"][0].reshape(-1, params["chunk_size_train"], *params["input_shape"])
+        init_LSUV_actrate(net, dd, params["act_rate"])  # 0.288 is hard coded from params['actrate']
 
-if args.load_model:
+if args.load_model and resume is None:
     print("loading model")
-    with open(args.load_model, "rb") as f:
-        benchmark.model.load_state_dict(torch.load(f, map_location=device))
-        print(benchmark.model)
-        if os.path.exists(args.load_model[:-8] + "optim.th"):
-            metalearner.optimizer.load_state_dict(
-                torch.load(args.load_model[:-8] + "optim.th")
-            )  # -8 because we need to remove model.th
+    # Checkpoint bundle, or model.th with optim.th and stepsize.th next to it
+    checkpoint = load_checkpoint(args.load_model, map_location=device)
+    benchmark.model.load_state_dict(checkpoint["model"])
+    print(benchmark.model)
+    if "optimizer" in checkpoint:
+        metalearner.optimizer.load_state_dict(checkpoint["optimizer"])
+    if "step_size" in checkpoint:
+        restore_step_size(metalearner, checkpoint["step_size"])
 
 epoch_desc = "Epoch {{0: <{0}d}}".format(1 + int(math.log10(args.num_epochs)))
 results_accuracy_after = []
 
+
+def fast_sampler_loaders():
+    """Data loaders of `--fast-sampler`, whose task samplers have a position"""
+    loaders = {"train": meta_train_dataloader, "val": meta_val_dataloader}
+    if args.do_test:
+        loaders["test"] = meta_test_dataloader
+    return {
+        split: loader
+        for split, loader in loaders.items()
+        if loader is not None and isinstance(loader.sampler, MetaBatchIndexSampler)
+    }
+
+
+def sampler_states():
+    return {split: loader.sampler.state_dict() for split, loader in fast_sampler_loaders().items()}
+
+
+def load_sampler_states(states):
+    loaders = fast_sampler_loaders()
+    for split, state in states.items():
+        if split in loaders:
+            loaders[split].sampler.load_state_dict(state)
+
+
 all_test = np.zeros(args.num_epochs)
 all_train = np.zeros(args.num_epochs)
 
+start_epoch, start_batch = 0, 0
+if resume is not None:
+    print("resuming from", args.resume)
+    benchmark.model.load_state_dict(resume["model"])
+    metalearner.optimizer.load_state_dict(resume["optimizer"])
+    restore_step_size(metalearner, resume["step_size"])
+    run = resume["run"]
+    meta_scheduler.load_state_dict(run["scheduler"])
+    start_epoch, start_batch = run["epoch"], run["batch"]
+    results_accuracy_after = list(run["results_accuracy_after"])
+    all_train[: len(run["all_train"])] = run["all_train"][: args.num_epochs]
+    all_test[: len(run["all_test"])] = run["all_test"][: args.num_epochs]
+    if checkpoints is not None:
+        checkpoints.best_metric = run["best_metric"]
+    if metalearner.grad_scaler is not None and "grad_scaler" in run:
+        metalearner.grad_scaler.load_state_dict(run["grad_scaler"])
+    load_sampler_states(run.get("samplers", {}))
+
+
+def save_checkpoint(epoch, batch, metric=None):
+    """Checkpoint the run, to be resumed at `batch` of `epoch`"""
+    if checkpoints is None:
+        return
+    run = {
+        "epoch": epoch,
+        "batch": batch,
+        "seed": args.seed,
+        "scheduler": meta_scheduler.state_dict(),
+        "rng": rng_state(),
+        "best_metric": checkpoints.best_metric,
+        "results_accuracy_after": list(results_accuracy_after),
+        "all_train": all_train,
+        "all_test": all_test,
+        "samplers": epoch_samplers if batch > 0 else sampler_states(),
+    }
+    if metalearner.grad_scaler is not None:
+        run["grad_scaler"] = metalearner.grad_scaler.state_dict()
+    checkpoints.save(
+        epoch * args.num_batches + batch,
+        benchmark.model,
+        optimizer=metalearner.optimizer,
+        step_size=metalearner.step_size,
+        metric=metric,
+        run=run,
+    )
+
+
+# Preemption: checkpoint after the current training batch, then exit
+preempted = []
+for signum in (signal.SIGTERM, signal.SIGUSR1):
+    signal.signal(signum, lambda signum, frame: preempted.append(signum))
+
+
+def exit_if_preempted(epoch, batch):
+    """Exit once the checkpoint at `batch` of `epoch` is written, if a signal was received"""
+    if preempted:
+        if checkpoints is not None:
+            checkpoints.close()
+        print(
+            "Interrupted by signal {0}, checkpointed at epoch {1}, batch {2}".format(
+                preempted[0], epoch, batch
+            )
+        )
+        sys.exit(0)
+
 
-for epoch in range(args.num_epochs):
+def on_batch_end(epoch, num_batches):
+    if telemetry is not None:
+        report = telemetry.report()
+        logging.debug("Telemetry, epoch {0}, batch {1}: {2}".format(epoch, num_batches, report))
+        if not args.no_log:
+            wandb.log(dict(report, epoch=epoch, batch=num_batches))
+    if preempted or (args.checkpoint_every and num_batches % args.checkpoint_every == 0):
+        save_checkpoint(epoch, num_batches)
+    exit_if_preempted(epoch, num_batches)
+
+
+for epoch in range(start_epoch, args.num_epochs):
+    # Each epoch has its own data order and random state, given the seed
+    seed_everything(args.seed + epoch)
+    # Sampler positions at the start of the epoch, from which an interrupted epoch is replayed
+    epoch_samplers = sampler_states()
+    first_batch = start_batch if epoch == start_epoch else 0
     print(epoch, meta_scheduler.get_last_lr())
-    if args.do_train:
+    if args.do_train and first_batch < args.num_batches:
+        if telemetry is not None:
+            telemetry.reset()  # drop the activity of the evaluations
+        dataloader = meta_train_dataloader
+        if first_batch > 0:
+            dataloader = resume_iterator(dataloader, first_batch, resume["run"]["rng"])
         results_train = metalearner.train(
-            meta_train_dataloader,
+            dataloader,
             max_batches=args.num_batches,
             verbose=args.verbose,
             desc="Training",
             leave=False,
             epoch=epoch,
+            start_batch=first_batch,
+            on_batch_end=lambda num_batches: on_batch_end(epoch, num_batches),
         )  # ,
         # deltaw=args.deltaw)
 
         if results_train is not None:
             all_train[epoch] = np.mean(results_train["accuracies_after"])
+    elif first_batch > 0:
+        set_rng_state(resume["run"]["rng"])
     results = metalearner.evaluate(
-        meta_val_dataloader,
+        meta_val_tasks,
         max_batches=args.num_batches_test,
         verbose=args.verbose,
         desc=epoch_desc.format(epoch + 1),
@@ -452,59 +810,79 @@ for epoch in range(args.num_epochs):
 
     if "accuracies_after" in results:
         results_accuracy_after.append(results["accuracies_after"])
+        logging.info(
+            "Validation accuracy: {0:.4f} +- {1:.4f} (95% CI)".format(
+                results["accuracies_after"], results["accuracies_after_ci95"]
+            )
+        )
         if not args.no_log:
             wandb.log(
-                {"accuracies_after/": results["accuracies_after"], "epoch": epoch}
+                {
+                    "accuracies_after/": results["accuracies_after"],
+                    "accuracies_after_ci95/": results["accuracies_after_ci95"],
+                    "epoch": epoch,
+                }
+            )
+        if checkpoints is not None:
+            checkpoints.save_array(
+                os.path.join(args.output_folder, "test_acc.npy"), results_accuracy_after
             )
-        np.save(args.output_folder + "test_acc.npy", results_accuracy_after)
-        save_model = True
-
-        if save_model and (args.output_folder is not None):
-            with open(args.model_path, "wb") as f:
-                torch.save(benchmark.model.state_dict(), f)
-            with open(args.opt_path, "wb") as f:
-                torch.save(metalearner.optimizer.state_dict(), f)
-            with open(args.stepsize_path, "wb") as f:
-                torch.save(metalearner.step_size, f)
 
     if args.do_test:
         results_test = metalearner.evaluate(
-            meta_test_dataloader,
+            meta_test_tasks,
             max_batches=args.num_batches_test,
             verbose=args.verbose,
             desc=epoch_desc.format(epoch + 1),
         )  # ,
         # deltaw=args.deltaw)
 
-        print("Test results: ", np.mean(results_test["accuracies_after"]))
+        print(
+            "Test results: ",
+            np.mean(results_test["accuracies_after"]),
+            "+-",
+            results_test["accuracies_after_ci95"],
+            "(95% CI)",
+        )
 
         all_test[epoch] = np.mean(results_test["accuracies_after"])
 
+    if adaptation_cache is not None:
+        logging.info("Adaptation cache: {0}".format(adaptation_cache.stats()))
+
+    if profiler is not None:
+        print(profiler.format())
+        profiler.end_epoch(epoch)
+
+    save_checkpoint(epoch + 1, 0, metric=results.get("accuracies_after"))
+    exit_if_preempted(epoch + 1, 0)
+
 if args.do_train:
     print("mean train", np.mean(all_train))
     print("stddev train", np.std(all_train))
 
-    if (best_value is None) or (best_value < results["accuracies_after"]):
-        best_value = results["accuracies_after"]
-        save_model = True
-    elif (best_value is None) or (best_value > results["mean_outer_loss"]):
-        best_value = results["mean_outer_loss"]
-        save_model = True
-    else:
-        save_model = False
-
-    if save_model and (args.output_folder is not None):
-        with open(args.model_path, "wb") as f:
-            torch.save(benchmark.model.state_dict(), f)
-        with open(args.opt_path, "wb") as f:
-            torch.save(metalearner.optimizer.state_dict(), f)
-        with open(args.stepsize_path, "wb") as f:
-            torch.save(metalearner.step_size, f)
-
 if args.do_test:
     print("mean test", np.mean(all_test))
     print("stddev test", np.std(all_test))
 
-if hasattr(benchmark.meta_train_dataset, "close"):
-    benchmark.meta_train_dataset.close()
-    benchmark.meta_val_dataset.close()
+    if args.int_eval is not None:
+        from snn_maml.int_inference import evaluate_integer
+
+        results_int = evaluate_integer(
+            metalearner,
+            meta_test_tasks,
+            max_batches=args.num_batches_test,
+            weight_format=args.int_eval,
+        )
+        print("Integer test results ({0} bits): ".format(args.int_eval), results_int)
+
+if profiler is not None and args.output_folder is not None:
+    profiler.export_json(os.path.join(args.output_folder, "profile.json"))
+    profiler.export_chrome_trace(os.path.join(args.output_folder, "profile_trace.json"))
+
+if checkpoints is not None:
+    checkpoints.close()
+
+for dataloader in (meta_train_dataloader, meta_val_dataloader):
+    if dataloader is not None and hasattr(dataloader.dataset, "close"):
+        dataloader.dataset.close()
@@ -23,7 +23,7 @@ import argparse
 
 import pdb
 
-from comet_ml import Experiment
+from snn_maml.sweep import ResultsStore
 
 from snn_maml.lava_dl_plasticity.loihi_plasticity import LoihiPlasticity
 
@@ -56,7 +56,9 @@ parser.add_argument('--hidden-size', type=int, default=64,
     help='Number of channels in each convolution layer of the VGG network '
     '(default: 64).')
 
-parser.add_argument('--sweep', action='store_true', help='perform a hyperparamter sweep')
+parser.add_argument('--sweep', action='store_true',
+    help='Append the validation accuracy of every epoch to results.jsonl in the '
+    'output folder, shared by the runs of a sweep (see sweep.py).')
 
 parser.add_argument('--load-model',type=str, default='', help='Path to the model file to load (default: "")')
 
@@ -95,6 +97,20 @@ parser.add_argument('--detach-at', type=int, default=None, help='Detach part of
 
 parser.add_argument('--device', type=int, default=0, help='Which gpu to use if multiple available (default 0).')
 
+parser.add_argument('--frame-cache', type=str, default=None, help='Folder of the persistent count-frame cache for spiking benchmarks (default None, no cache).')
+
+parser.add_argument('--frame-cache-size', type=float, default=20, help='Size limit of the count-frame cache in GiB, least recently used samples are evicted first (default 20).')
+
+parser.add_argument('--sparse-frames', action='store_true', help='Load count frames as sparse tensors, densified on the device.')
+
+parser.add_argument('--device-binning', action='store_true', help='Load raw events and bin them into count frames on the device.')
+
+parser.add_argument('--max-events', type=int, default=16384, help='With --device-binning, events kept per sample and binning window; samples with more are truncated, with a warning (default 16384).')
+
+parser.add_argument('--fast-sampler', action='store_true', help='Sample whole meta-batches at once from a precomputed per-class index.')
+
+parser.add_argument('--shared-store', type=str, nargs='?', const='', default=None, help='Read HDF5 datasets once into a memory-mapped store shared by all workers, optionally in the given folder (default ~/.cache/snn_maml/h5store).')
+
 # parser.add_argument('--deltaw', type=float, default=None, help='Force larger weight changes. The larger the value the larger the deltaw needs to be for params to update. (default None)')
 
 args = parser.parse_args()
@@ -106,18 +122,6 @@ if args.num_shots_test <= 0:
     args.num_shots_test = args.num_shots
     
 
-if args.sweep:
-    print("performing sweep")
-    # Create an experiment with your api key
-    experiment = Experiment(
-        api_key="b0lVLjVZobevu5hLzc6EsverV",
-        project_name="meta",
-        workspace="kennetms",
-    )
-
-    #experiment.log_parameters(hyper_params)
-
-
 logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 device = f'cuda:{args.device}' #torch.device(f'cuda:{args.device}' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
 
@@ -142,6 +146,11 @@ if (args.output_folder is not None):
     logging.info('Saving configuration file in `{0}`'.format(
                  os.path.abspath(os.path.join(output_folder, 'config.json'))))
 
+if args.sweep:
+    # One store for all the runs written to the same output folder
+    sweep_folder = os.path.dirname(args.output_folder) if args.output_folder is not None else '.'
+    results_store = ResultsStore(os.path.join(sweep_folder, 'results.jsonl'))
+
 
 
 benchmark = get_benchmark_by_name(name = args.benchmark,
@@ -153,9 +162,20 @@ benchmark = get_benchmark_by_name(name = args.benchmark,
                                   detach_at=args.detach_at,
                                   hidden_size=args.hidden_size,
                                   params_file = args.params_file,
-                                  device=device)
+                                  device=device,
+                                  frame_cache=args.frame_cache,
+                                  frame_cache_size=args.frame_cache_size,
+                                  sparse_frames=args.sparse_frames,
+                                  device_binning=args.device_binning,
+                                  max_events=args.max_events,
+                                  shared_store=args.shared_store)
 net = benchmark.model
 
+if args.sparse_frames:
+    from snn_maml.dataloaders import SparseBatchMetaDataLoader as BatchMetaDataLoader
+if args.fast_sampler:
+    from snn_maml.dataloaders import TaskIndexDataLoader as BatchMetaDataLoader
+
 meta_train_dataloader = BatchMetaDataLoader(benchmark.meta_train_dataset,
                                             batch_size=args.batch_size,
                                             shuffle=True,
@@ -284,7 +304,8 @@ metalearner = ModelAgnosticMetaLearning_Lava(benchmark.model,
                                         outer_loop_quantizer = quantizer_out,
                                         inner_loop_quantizer = quantizer_in,
                                             use_soel=args.use_soel,
-                                            learning_engine=learning_engine)
+                                            learning_engine=learning_engine,
+                                            input_transform=benchmark.input_transform)
 
 best_value = None
 
@@ -318,7 +339,7 @@ elif args.load_model:
 
 elif hasattr(net, 'LIF_layers'):
     out = next(iter(meta_train_dataloader))
-    out_c = tensors_to_device(out, device=device)
+    out_c = metalearner.transform_inputs(tensors_to_device(out, device=device))
     if args.params_file is not None:
         with open(args.params_file, 'r') as f:
             import yaml
@@ -327,23 +348,23 @@ elif hasattr(net, 'LIF_layers'):
         raise Exception('Must provide params_file')
     
     params['input_shape'] = benchmark.input_size
-    from decolle.init_functions import init_LSUV_actrate
+    from snn_maml.init_functions import init_LSUV_actrate
     dd=out_c['train'][0].reshape(-1,params['chunk_size_train'],*[2,32,16])#params['input_shape'])
     #print("skipping init for debugging/compare")
     init_LSUV_actrate(net, dd, params['act_rate']) #0.288 is hard coded from params['actrate']
     
 elif hasattr(net, 'blocks'):
-    from snn_maml.snn_model_lava import torch_init_LSUV
+    from snn_maml.init_functions import init_LSUV_lava
     out = next(iter(meta_train_dataloader))
-    out_c = tensors_to_device(out, device=device)
+    out_c = metalearner.transform_inputs(tensors_to_device(out, device=device))
     data_batch = out_c['train'][0]
     data_batch = data_batch.reshape(data_batch.shape[0]*data_batch.shape[1],*data_batch.shape[2:])
 
-    tr_l = [int(k[7])  for k  in OrderedDict(benchmark.model.meta_named_parameters()).keys()]
+    tr_l = sorted({int(k.split('.')[1]) for k in OrderedDict(benchmark.model.meta_named_parameters()).keys()})
     
     print(tr_l)
 
-    torch_init_LSUV(benchmark.model,data_batch, tr_l)
+    init_LSUV_lava(benchmark.model,data_batch, tr_l)
     
 
 #pdb.set_trace()           
@@ -391,7 +412,10 @@ for epoch in range(args.num_epochs):
         all_train[epoch] = np.mean(results['accuracies_after'])
         
         if args.sweep:
-            experiment.log_metric("accuracy", all_train[epoch], step=epoch)
+            results_store.append({'id': os.path.basename(str(args.output_folder)),
+                                  'config': vars(args),
+                                  'epoch': epoch,
+                                  'accuracy': float(all_train[epoch])})
         
         
     if args.do_noinner:
@@ -488,7 +512,7 @@ if args.do_train:
 
 if args.do_test:
     # put the weight into loihi compatible format
-    benchmark.model.gen_loihi_params('./loihi_params_mlp_dnmnist')
+    benchmark.model.export_loihi(os.path.join(args.output_folder or '.', 'loihi_params.h5'))
     
     print("mean test", np.mean(all_test))
     print("stddev test", np.std(all_test))